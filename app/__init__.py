@@ -7,18 +7,45 @@ from app.models.user import db
 
 login_manager = LoginManager()
 
-def create_app():
+def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
     
+    # Master key for the encrypted key columns
+    from app.utils.keystore import configure_keystore
+    configure_keystore(app)
+
     # Initialize extensions with app
+    from app.utils.database import configure_pool, init_database
+    configure_pool(app)
     db.init_app(app)
+
+    # WAL and connection pragmas, plus the read-only session
+    init_database(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
+
+    # Request timing and SQL query counts for /metrics
+    from app.utils.metrics import init_metrics
+    init_metrics(app)
+
+    # Select how WireGuard is driven before anything samples or applies peers
+    from app.utils.backends import configure_backend
+    configure_backend(app.config.get('WG_BACKEND', 'subprocess'))
+
+    from app.utils.firewall import configure_firewall
+    configure_firewall(app.config.get('FIREWALL_BACKEND', 'iptables'), app.instance_path)
+
+    # Background repair of drift between the database and the interfaces
+    from app.utils.reconcile import init_reconciler
+    init_reconciler(app)
     
     # Import models AFTER db is initialized
     from app.models.user import User
     from app.models.peer import Peer
+    from app.models.traffic import PeerTraffic
+    from app.models.interface import Interface
+    from app.models.job import Job
     
     @login_manager.user_loader
     def load_user(user_id):
@@ -30,28 +57,15 @@ def create_app():
     
     app.register_blueprint(auth_bp)
     app.register_blueprint(main)
+
+    # Register CLI commands
+    from app.cli import init_db, peers_cli, interfaces_cli
+    app.cli.add_command(init_db)
+    app.cli.add_command(peers_cli)
+    app.cli.add_command(interfaces_cli)
     
-    # Create database tables
-    with app.app_context():
-        db.create_all()
-        
-        # Create default admin user if not exists
-        try:
-            admin = User.query.filter_by(username='admin').first()
-            if not admin:
-                admin = User(
-                    username='admin',
-                    email='admin@vpnmanager.local',
-                    is_admin=True
-                )
-                admin.set_password('admin123')
-                db.session.add(admin)
-                db.session.commit()
-                print("Default admin user created (username: admin, password: admin123)")
-            else:
-                print(f"Admin user already exists: {admin.username}")
-        except Exception as e:
-            print(f"Error creating admin user: {e}")
-            db.session.rollback()
+    # Schema changes and the admin user are applied by `flask init-db`
+    from app.utils.migrations import check_schema
+    check_schema(app)
     
     return app
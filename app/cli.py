@@ -0,0 +1,246 @@
+import os
+import time
+import click
+from flask.cli import AppGroup, with_appcontext
+from app import db
+from app.models.interface import Interface
+from app.models.peer import Peer
+from app.models.user import User
+from app.utils.provisioning import parse_peer_names, create_peers
+from app.utils.interfaces import interface_loads, validate_interface, validate_pools
+from app.utils.jobs import enqueue_apply, get_job_queue
+from app.utils.shaping import parse_limit
+from app.utils.migrations import migrate, schema_version
+from app.utils.keystore import MASTER_KEY_ENV, create_master_key, load_master_key, set_master_key
+from app.utils.rotation import enqueue_rotation, rotation_status
+from app.utils.reconcile import reconcile
+from app.utils.wireguard import WireGuardManager
+
+peers_cli = AppGroup('peers', help='Manage VPN peers.')
+interfaces_cli = AppGroup('interfaces', help='Manage WireGuard interfaces.')
+
+@click.command('init-db')
+@with_appcontext
+@click.option('--admin-password', default='admin123', show_default=True,
+              help='Password for the admin user, if it has to be created.')
+def init_db(admin_password):
+    """Create or upgrade the database schema and the admin user."""
+    from flask import current_app
+
+    if not os.environ.get(MASTER_KEY_ENV):
+        path = current_app.config['MASTER_KEY_FILE']
+        if create_master_key(path):
+            click.echo(f'Master key created at {path}; back it up separately from the database')
+        set_master_key(load_master_key(path))
+
+    for version, description in migrate():
+        click.echo(f'migrated to {version}: {description}')
+    click.echo(f'Schema is at version {schema_version()}')
+
+    if User.query.first() is None:
+        admin = User(username='admin', email='admin@vpnmanager.local', is_admin=True)
+        admin.set_password(admin_password)
+        db.session.add(admin)
+        db.session.commit()
+        click.echo('Default admin user created (username: admin)')
+
+@peers_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']),
+              help='Input format (default: from the file extension).')
+def import_peers(path, fmt):
+    """Create one peer per name listed in a CSV or JSON file."""
+    if not fmt:
+        fmt = 'json' if os.path.splitext(path)[1].lower() == '.json' else 'csv'
+
+    with open(path, 'r') as f:
+        names = parse_peer_names(f.read(), fmt)
+
+    results = create_peers(names)
+
+    # Apply now rather than leaving it to the web app's job worker
+    get_job_queue().run_due(force=True)
+
+    for result in results:
+        if result['status'] == 'created':
+            click.echo(f"created  {result['ip_address']:<15} {result['name']}")
+        else:
+            click.echo(f"failed   {'':<15} {result['name']}: {result['error']}")
+
+    created = sum(1 for result in results if result['status'] == 'created')
+    click.echo(f'{created} created, {len(results) - created} failed')
+
+@peers_cli.command('limit')
+@click.argument('name')
+@click.option('--download', help='Download limit in kbit/s; 0 for unlimited.')
+@click.option('--upload', help='Upload limit in kbit/s; 0 for unlimited.')
+def limit_peer(name, download, upload):
+    """Set a peer's bandwidth limits and apply them."""
+    peer = Peer.query.filter_by(name=name).first()
+    if peer is None:
+        raise click.ClickException(f'No peer named {name}')
+
+    try:
+        if download is not None:
+            peer.download_limit = parse_limit(download)
+        if upload is not None:
+            peer.upload_limit = parse_limit(upload)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    db.session.commit()
+
+    enqueue_apply(WireGuardManager.for_peer(peer).interface)
+    get_job_queue().run_due(force=True)
+
+    click.echo(f"{peer.name}: download {peer.download_limit or 'unlimited'}, "
+               f"upload {peer.upload_limit or 'unlimited'} (kbit/s)")
+
+@peers_cli.command('rotate-keys')
+@click.argument('names', nargs=-1)
+@click.option('--interface', help='Only rotate peers on this interface.')
+@click.option('--keypair', is_flag=True, help='Also give peers new private and public keys.')
+@click.option('--window', 'window_hours', type=float,
+              help='Hours until the server switches to the new keys (default: KEY_ROTATION_WINDOW_HOURS).')
+def rotate_keys(names, interface, keypair, window_hours):
+    """Stage new preshared keys for the named peers, or every peer."""
+    peer_ids = None
+    if names:
+        peers = Peer.query.filter(Peer.name.in_(names)).all()
+        missing = set(names) - {peer.name for peer in peers}
+        if missing:
+            raise click.ClickException(f"No peer named {', '.join(sorted(missing))}")
+        peer_ids = [peer.id for peer in peers]
+
+    try:
+        job = enqueue_rotation(interface, peer_ids, keypair, window_hours)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    # Stage now; the switch-over (and, with --window 0, that too) runs when due
+    get_job_queue().run_due()
+    # The worker thread may have claimed it first
+    while job.status not in ('done', 'failed'):
+        time.sleep(0.2)
+        db.session.refresh(job)
+    if job.status != 'done':
+        raise click.ClickException(f'Staging failed: {job.error}')
+
+    status = rotation_status(interface)
+    if status['pending']:
+        click.echo(f"{job.progress} peers given new keys; the server switches over at {status['next_due']} UTC")
+    else:
+        click.echo(f'{job.progress} peers given new keys and switched over')
+
+@interfaces_cli.command('list')
+def list_interfaces():
+    """Show each interface with its port, pools and peer count."""
+    for interface, peer_count in interface_loads(include_disabled=True):
+        state = 'enabled ' if interface.enabled else 'disabled'
+        click.echo(f"{interface.name:<15} {state} :{interface.listen_port:<6} "
+                   f"{peer_count:>7} peers  {', '.join(interface.pools)}")
+
+@interfaces_cli.command('add')
+@click.argument('name')
+@click.option('--port', type=int, required=True, help='UDP listen port.')
+@click.option('--pool', 'pools', multiple=True, required=True,
+              help='Peer address pool in CIDR notation; repeat for more pools.')
+@click.option('--endpoint', help='Public host:port clients connect to.')
+def add_interface(name, port, pools, endpoint):
+    """Create an interface with its own key and write its config."""
+    try:
+        validate_interface(name, port, pools)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    wg_manager = WireGuardManager(name)
+    keys = wg_manager.generate_keys()
+    if not keys:
+        raise click.ClickException('Failed to generate keys')
+
+    interface = Interface(
+        name=name,
+        listen_port=port,
+        address_pools=','.join(pools),
+        private_key=keys['private_key'],
+        endpoint=endpoint
+    )
+    db.session.add(interface)
+    db.session.commit()
+
+    if not wg_manager.save_server_config():
+        raise click.ClickException(f'Could not write {wg_manager.config_path}')
+
+    click.echo(f'Created {name}; start it with: systemctl enable --now wg-quick@{name}')
+
+@interfaces_cli.command('set-pools')
+@click.argument('name')
+@click.option('--pool', 'pools', multiple=True, required=True,
+              help='Peer address pool in CIDR notation; repeat for more pools.')
+def set_pools(name, pools):
+    """Replace an interface's address pools; peers keep their addresses."""
+    interface = Interface.query.filter_by(name=name).first()
+    if interface is None:
+        raise click.ClickException(f'No interface named {name}')
+
+    try:
+        validate_pools(interface, pools)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    interface.address_pools = ','.join(pools)
+    db.session.commit()
+
+    enqueue_apply(name)
+    get_job_queue().run_due(force=True)
+
+    click.echo(f"{name} now allocates from {', '.join(interface.pools)}; "
+               f"restart it to move the server addresses: systemctl restart wg-quick@{name}")
+
+@interfaces_cli.command('disable')
+@click.argument('name')
+def disable_interface(name):
+    """Stop placing new peers on an interface; existing peers keep working."""
+    interface = Interface.query.filter_by(name=name).first()
+    if interface is None:
+        raise click.ClickException(f'No interface named {name}')
+
+    interface.enabled = False
+    db.session.commit()
+    click.echo(f'{name} no longer accepts new peers')
+
+@interfaces_cli.command('reconcile')
+@click.option('--interface', help='Only check this interface.')
+@click.option('--apply', 'repair', is_flag=True, help='Repair the drift instead of only reporting it.')
+def reconcile_interfaces(interface, repair):
+    """Compare each interface's config and running peers with the database.
+
+    Exits with status 1 if there is drift it didn't repair, or an interface
+    or its config couldn't be read.
+    """
+    try:
+        reports = reconcile(interface, dry_run=not repair)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    found = failed = False
+    for report in reports:
+        for source in ('config', 'kernel'):
+            for kind, entries in (report[source] or {}).items():
+                for entry in entries:
+                    peer = f"{entry['name']} (id {entry['peer_id']})" if entry['peer_id'] else 'unknown peer'
+                    fields = f" [{', '.join(entry['fields'])}]" if 'fields' in entry else ''
+                    click.echo(f"{report['interface']:<15} {source:<6} {kind:<10} {entry['public_key']}  {peer}{fields}")
+                    found = True
+                    failed = failed or not report['repaired']
+        for error in report['errors']:
+            click.echo(f"{report['interface']:<15} error: {error}")
+            failed = True
+        if report['skipped']:
+            click.echo(f"{report['interface']:<15} not repaired: {report['skipped']}")
+        elif report['repaired']:
+            click.echo(f"{report['interface']:<15} repaired")
+
+    if failed:
+        raise SystemExit(1)
+    if not found:
+        click.echo('No drift')
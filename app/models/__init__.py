@@ -1,4 +1,7 @@
 from app.models.user import db, User
 from app.models.peer import Peer
+from app.models.traffic import PeerTraffic
+from app.models.interface import Interface
+from app.models.job import Job
 
-__all__ = ['db', 'User', 'Peer']
+__all__ = ['db', 'User', 'Peer', 'PeerTraffic', 'Interface', 'Job']
@@ -0,0 +1,29 @@
+from datetime import datetime
+from app.models.user import db
+from app.utils.keystore import EncryptedString
+
+class Interface(db.Model):
+    """A WireGuard device on this host, each with its own port, pools and config file"""
+    __tablename__ = 'interfaces'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(15), nullable=False, unique=True)  # Kernel limit is 15 characters
+    listen_port = db.Column(db.Integer, nullable=False, unique=True)
+    address_pools = db.Column(db.String(500), nullable=False)  # Comma-separated CIDRs
+    private_key = db.Column(EncryptedString(200, 'interfaces.private_key'))  # Unset: read from the interface's config file
+    endpoint = db.Column(db.String(255))  # Unset: WG_SERVER_ENDPOINT's host with listen_port
+    enabled = db.Column(db.Boolean, default=True, nullable=False)  # Accepts new peers
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    peers = db.relationship('Peer', backref='interface', lazy='dynamic')
+
+    @property
+    def pools(self):
+        return [cidr.strip() for cidr in self.address_pools.split(',') if cidr.strip()]
+
+    @property
+    def config_path(self):
+        return f'/etc/wireguard/{self.name}.conf'
+
+    def __repr__(self):
+        return f'<Interface {self.name}:{self.listen_port}>'
@@ -0,0 +1,31 @@
+from datetime import datetime
+from app.models.user import db
+
+class Job(db.Model):
+    """Deferred work, such as applying an interface's config, run by the job worker
+
+    Jobs with the same kind and key coalesce while queued: one run covers
+    every request that came in before it started.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_after', 'status', 'run_after'),
+        db.Index('ix_jobs_kind_key_status', 'kind', 'key', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(100))  # Coalescing key, e.g. the interface name
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    progress = db.Column(db.Integer)  # Items done so far, for jobs that report it
+    total = db.Column(db.Integer)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind}:{self.key} {self.status}>'
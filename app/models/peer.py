@@ -1,22 +1,43 @@
 from datetime import datetime
 from app.models.user import db
+from app.utils.keystore import EncryptedString
 
 class Peer(db.Model):
     __tablename__ = 'peers'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
     ip_address = db.Column(db.String(50), nullable=False, unique=True)
     public_key = db.Column(db.String(200), nullable=False, unique=True)
-    private_key = db.Column(db.String(200), nullable=False)
-    preshared_key = db.Column(db.String(200))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Encrypted at rest, and only loaded when asked for (undefer_group('keys'))
+    # so listings never decrypt them
+    private_key = db.deferred(db.Column(EncryptedString(200, 'peers.private_key'), nullable=False), group='keys')
+    preshared_key = db.deferred(db.Column(EncryptedString(200, 'peers.preshared_key')), group='keys')
+    interface_id = db.Column(db.Integer, db.ForeignKey('interfaces.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     # NEW FIELDS - Add these
-    enabled = db.Column(db.Boolean, default=True, nullable=False)
-    last_seen = db.Column(db.DateTime, nullable=True)
+    enabled = db.Column(db.Boolean, default=True, nullable=False, index=True)
+    last_seen = db.Column(db.DateTime, nullable=True, index=True)
     total_rx = db.Column(db.BigInteger, default=0)  # Bytes received
     total_tx = db.Column(db.BigInteger, default=0)  # Bytes transmitted
 
+    # Bandwidth caps in kbit/s, None for unlimited; enforced with tc on the interface
+    download_limit = db.Column(db.Integer, nullable=True)  # Server to peer
+    upload_limit = db.Column(db.Integer, nullable=True)  # Peer to server
+
+    # Keys staged by a rotation, which the server switches to at
+    # key_rotation_due; configs only carry them when asked with ?pending=1
+    pending_private_key = db.deferred(
+        db.Column(EncryptedString(200, 'peers.pending_private_key'), nullable=True), group='keys')
+    pending_public_key = db.Column(db.String(200), nullable=True)  # Only set when the keypair rotates
+    pending_preshared_key = db.deferred(
+        db.Column(EncryptedString(200, 'peers.pending_preshared_key'), nullable=True), group='keys')
+    key_rotation_due = db.Column(db.DateTime, nullable=True, index=True)
+    keys_rotated_at = db.Column(db.DateTime, nullable=True)
+
     def __repr__(self):
         return f'<Peer {self.name} - {self.ip_address}>'
+
+# Backs sorting the dashboard by traffic
+db.Index('ix_peers_total_bytes', Peer.total_rx + Peer.total_tx)
@@ -0,0 +1,19 @@
+from app.models.user import db
+
+class PeerTraffic(db.Model):
+    """Bytes transferred by a peer during one time bucket
+
+    Every sample is added to the 1m, 1h and 1d buckets it falls in, so each
+    resolution is a running rollup and old fine-grained rows can be pruned
+    without losing totals.
+    """
+    __tablename__ = 'peer_traffic'
+
+    peer_id = db.Column(db.Integer, db.ForeignKey('peers.id', ondelete='CASCADE'), primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)  # Bucket width in seconds
+    bucket = db.Column(db.Integer, primary_key=True)  # Bucket start, unix time
+    rx_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    tx_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+
+    def __repr__(self):
+        return f'<PeerTraffic {self.peer_id} {self.resolution}s @ {self.bucket}>'
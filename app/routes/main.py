@@ -1,11 +1,27 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_file, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_file, jsonify, abort, current_app, stream_with_context
 from app.models.peer import Peer
 from app.models.user import User
+from app.models.job import Job
 from app.utils.wireguard import WireGuardManager
+from app.utils.stats import get_stats_collector
+from app.utils.provisioning import parse_peer_names, create_peers, commit_new_peers, AddressPoolExhausted
+from app.utils.qr import get_qrcode_cache, MIMETYPES
+from app.utils.traffic import RESOLUTIONS, query_traffic, delete_traffic
+from app.utils.interfaces import interface_loads
+from app.utils.jobs import enqueue_apply, job_to_dict
+from app.utils.metrics import render_metrics
+from app.utils.database import read_session
+from app.utils.listing import list_peers, count_peers, peer_to_dict, SORTS, STATUSES
+from app.utils.export import iter_export_peers, stream_peer_configs
+from app.utils.shaping import parse_limit
+from app.utils.rotation import enqueue_rotation, rotation_status
+from app.utils.reconcile import reconcile
 from app import db
 from werkzeug.security import check_password_hash
-from datetime import datetime
-import os
+import io
+import hmac
+import json
+import time
 
 main = Blueprint('main', __name__)
 
@@ -42,30 +58,68 @@ def logout():
     flash('You have been logged out.', 'info')
     return redirect(url_for('main.login'))
 
+OFFLINE_STATS = {
+    'online': False,
+    'rx_bytes': 0,
+    'tx_bytes': 0
+}
+
+def _listing_args():
+    """Read the search, filter, sort and paging query parameters"""
+    return {
+        'search': request.args.get('q', '').strip() or None,
+        'status': request.args.get('status') if request.args.get('status') in STATUSES else None,
+        'sort': request.args.get('sort') if request.args.get('sort') in SORTS else 'created',
+        'cursor': request.args.get('cursor') or None,
+        'per_page': request.args.get('per_page', type=int)
+    }
+
 @main.route('/dashboard')
 def dashboard():
     """Dashboard page"""
     if 'user_id' not in session:
         return redirect(url_for('main.login'))
 
-    peers = Peer.query.order_by(Peer.created_at.desc()).all()
+    listing = _listing_args()
+    try:
+        page = list_peers(**listing, session=read_session())
+    except ValueError:
+        flash('Invalid page cursor, showing the first page', 'warning')
+        listing['cursor'] = None
+        page = list_peers(**listing, session=read_session())
 
-    # Get WireGuard stats
-    wg_manager = WireGuardManager()
-    stats = wg_manager.get_peer_stats()
+    # Get WireGuard stats from the shared background snapshot
+    stats, stats_age = get_stats_collector().snapshot()
 
     # Update peer stats in context
-    for peer in peers:
-        if peer.public_key in stats:
-            peer.stats = stats[peer.public_key]
-        else:
-            peer.stats = {
-                'online': False,
-                'rx_bytes': 0,
-                'tx_bytes': 0
-            }
+    for peer in page.peers:
+        peer.stats = stats.get(peer.public_key, OFFLINE_STATS)
+
+    counts = count_peers(read_session())
+    counts['online'] = sum(1 for peer_stats in stats.values() if peer_stats['online'])
+
+    return render_template('dashboard.html', peers=page.peers, next_cursor=page.next_cursor,
+                           counts=counts, listing=listing,
+                           username=session.get('username'), stats_age=stats_age)
+
+@main.route('/api/peers')
+def api_peers():
+    """API endpoint to list peers a page at a time"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        page = list_peers(**_listing_args(), session=read_session())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    return render_template('dashboard.html', peers=peers, username=session.get('username'))
+    stats, stats_age = get_stats_collector().snapshot()
+
+    return jsonify({
+        'peers': [peer_to_dict(peer, stats.get(peer.public_key, OFFLINE_STATS)) for peer in page.peers],
+        'next_cursor': page.next_cursor,
+        'stats_age': round(stats_age, 1)
+    })
 
 @main.route('/peer/new', methods=['GET', 'POST'])
 def new_peer():
@@ -80,6 +134,13 @@ def new_peer():
             flash('Peer name is required', 'danger')
             return redirect(url_for('main.new_peer'))
 
+        try:
+            download_limit = parse_limit(request.form.get('download_limit'))
+            upload_limit = parse_limit(request.form.get('upload_limit'))
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('main.new_peer'))
+
         # Initialize WireGuard manager
         wg_manager = WireGuardManager()
 
@@ -89,40 +150,31 @@ def new_peer():
             flash('Failed to generate keys', 'danger')
             return redirect(url_for('main.new_peer'))
 
-        # Get next available IP
-        ip_address = wg_manager.get_next_ip()
-        if not ip_address:
-            flash('No available IP addresses', 'danger')
-            return redirect(url_for('main.new_peer'))
-
         # Create peer in database
         peer = Peer(
             name=name,
-            ip_address=ip_address,
             public_key=keys['public_key'],
             private_key=keys['private_key'],
             preshared_key=keys['preshared_key'],
-            enabled=True
+            enabled=True,
+            download_limit=download_limit,
+            upload_limit=upload_limit
         )
 
         try:
-            db.session.add(peer)
-            db.session.commit()
+            # Places the peer on an interface and allocates the next free IP address
+            commit_new_peers([peer])
+            wg_manager = WireGuardManager.for_peer(peer)
 
-            # Generate peer config
-            config_content = wg_manager.generate_peer_config(peer)
-            wg_manager.save_peer_config(peer, config_content)
-
-            # Generate QR code
-            wg_manager.generate_qrcode(config_content, peer.id)
-
-            # Update server config
-            wg_manager.save_server_config()
-            wg_manager.reload_wireguard()
+            # Update server config and the running interface in the background
+            enqueue_apply(wg_manager.interface)
 
             flash(f'Peer "{name}" created successfully!', 'success')
             return redirect(url_for('main.dashboard'))
 
+        except AddressPoolExhausted:
+            flash('No available IP addresses', 'danger')
+            return redirect(url_for('main.new_peer'))
         except Exception as e:
             db.session.rollback()
             flash(f'Error creating peer: {str(e)}', 'danger')
@@ -130,6 +182,59 @@ def new_peer():
 
     return render_template('add_peer.html')
 
+@main.route('/api/peers/bulk', methods=['POST'])
+def bulk_create_peers():
+    """Create many peers from a JSON list or CSV of names"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    upload = request.files.get('file')
+    try:
+        if upload:
+            fmt = 'json' if upload.filename.lower().endswith('.json') else 'csv'
+            names = parse_peer_names(upload.read().decode('utf-8'), fmt)
+        elif request.is_json:
+            names = parse_peer_names(request.get_data(as_text=True), 'json')
+        else:
+            names = parse_peer_names(request.get_data(as_text=True), 'csv')
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Invalid peer list: {e}'}), 400
+
+    if not names:
+        return jsonify({'error': 'No peer names given'}), 400
+
+    results = create_peers(names)
+    created = sum(1 for result in results if result['status'] == 'created')
+
+    return jsonify({
+        'created': created,
+        'failed': len(results) - created,
+        'jobs': sorted({result['job'] for result in results if 'job' in result}),
+        'results': results
+    })
+
+@main.route('/api/jobs')
+def list_jobs():
+    """API endpoint to list recent background jobs"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    jobs = Job.query
+    status = request.args.get('status')
+    if status:
+        jobs = jobs.filter(Job.status == status)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+
+    return jsonify({'jobs': [job_to_dict(job) for job in jobs.order_by(Job.id.desc()).limit(limit)]})
+
+@main.route('/api/jobs/<int:job_id>')
+def job_status(job_id):
+    """API endpoint to poll a background job"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    return jsonify(job_to_dict(Job.query.get_or_404(job_id)))
+
 @main.route('/peer/<int:peer_id>/delete', methods=['POST'])
 def delete_peer(peer_id):
     """Delete a peer"""
@@ -138,19 +243,22 @@ def delete_peer(peer_id):
 
     peer = Peer.query.get_or_404(peer_id)
     peer_name = peer.name
+    ip_address = peer.ip_address
+    wg_manager = WireGuardManager.for_peer(peer)
 
     try:
         # Delete from database
+        delete_traffic(peer_id)
         db.session.delete(peer)
         db.session.commit()
+        wg_manager.allocator().release(ip_address)
 
         # Delete peer files
-        wg_manager = WireGuardManager()
         wg_manager.delete_peer_files(peer_id)
 
-        # Update server config
-        wg_manager.save_server_config()
-        wg_manager.reload_wireguard()
+        # Update server config and drop the peer from the running interface
+        # in the background
+        enqueue_apply(wg_manager.interface)
 
         flash(f'Peer "{peer_name}" deleted successfully!', 'success')
     except Exception as e:
@@ -167,10 +275,10 @@ def toggle_peer(peer_id):
 
     peer = Peer.query.get_or_404(peer_id)
 
-    wg_manager = WireGuardManager()
-    success = wg_manager.toggle_peer(peer_id, not peer.enabled)
+    wg_manager = WireGuardManager.for_peer(peer)
+    job = wg_manager.toggle_peer(peer_id, not peer.enabled)
 
-    if success:
+    if job:
         status = "enabled" if peer.enabled else "disabled"
         flash(f'Peer "{peer.name}" has been {status}!', 'success')
     else:
@@ -178,6 +286,89 @@ def toggle_peer(peer_id):
 
     return redirect(url_for('main.dashboard'))
 
+@main.route('/api/peer/<int:peer_id>/limits', methods=['PUT'])
+def set_peer_limits(peer_id):
+    """Set a peer's download and upload limits in kbit/s; null or 0 removes a limit"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    peer = Peer.query.get_or_404(peer_id)
+    data = request.get_json(silent=True) or {}
+
+    try:
+        if 'download_limit' in data:
+            peer.download_limit = parse_limit(data['download_limit'])
+        if 'upload_limit' in data:
+            peer.upload_limit = parse_limit(data['upload_limit'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    db.session.commit()
+
+    # Only this peer's tc class and filter are touched
+    job = enqueue_apply(WireGuardManager.for_peer(peer).interface)
+
+    return jsonify({
+        'id': peer.id,
+        'download_limit': peer.download_limit,
+        'upload_limit': peer.upload_limit,
+        'job': job_to_dict(job)
+    })
+
+@main.route('/api/peers/rotate-keys', methods=['POST'])
+def rotate_keys():
+    """Stage new preshared keys (and keypairs, if asked) for peers; the server switches after the window"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    peer_ids = data.get('peer_ids')
+    window_hours = data.get('window_hours')
+    if peer_ids is not None and not (isinstance(peer_ids, list) and all(isinstance(i, int) for i in peer_ids)):
+        return jsonify({'error': 'peer_ids must be a list of peer ids'}), 400
+    if window_hours is not None and (isinstance(window_hours, bool) or not isinstance(window_hours, (int, float))):
+        return jsonify({'error': 'window_hours must be a number'}), 400
+
+    try:
+        job = enqueue_rotation(
+            interface=data.get('interface'),
+            peer_ids=peer_ids,
+            keypair=bool(data.get('keypair')),
+            window_hours=window_hours
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'job': job_to_dict(job)}), 202
+
+@main.route('/api/peers/rotation')
+def key_rotation_status():
+    """API endpoint for how many peers have a staged key rotation"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    return jsonify(rotation_status(request.args.get('interface')))
+
+@main.route('/api/reconcile', methods=['GET', 'POST'])
+def reconcile_interfaces():
+    """API endpoint for drift between the database, server configs and running interfaces
+
+    GET reports it (a dry run); POST repairs it and reports what was found.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        reports = reconcile(request.args.get('interface'), dry_run=request.method == 'GET')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+    return jsonify({'interfaces': reports})
+
+def _wants_pending_keys():
+    """?pending=1 asks for the keys of a staged rotation rather than the current ones"""
+    return request.args.get('pending') == '1'
+
 @main.route('/peer/<int:peer_id>/qrcode')
 def show_qrcode(peer_id):
     """Show QR code page for a peer"""
@@ -185,9 +376,28 @@ def show_qrcode(peer_id):
         return redirect(url_for('main.login'))
 
     peer = Peer.query.get_or_404(peer_id)
-    qr_filename = f'peer_{peer.id}.png'
 
-    return render_template('qrcode.html', peer=peer, qr_filename=qr_filename)
+    return render_template('qrcode.html', peer=peer)
+
+@main.route('/peer/<int:peer_id>/qrcode.<fmt>')
+def qrcode_image(peer_id, fmt):
+    """Render a peer's QR code on demand (SVG or PNG)"""
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+
+    if fmt not in MIMETYPES:
+        abort(404)
+
+    peer = Peer.query.get_or_404(peer_id)
+
+    wg_manager = WireGuardManager.for_peer(peer)
+    config_content = wg_manager.generate_peer_config(peer, pending=_wants_pending_keys())
+    key, image = get_qrcode_cache().get(config_content, fmt)
+
+    response = current_app.response_class(image, mimetype=MIMETYPES[fmt])
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 @main.route('/peer/<int:peer_id>/download')
 def download_config(peer_id):
@@ -197,58 +407,187 @@ def download_config(peer_id):
 
     peer = Peer.query.get_or_404(peer_id)
 
-    from flask import current_app
-    config_dir = current_app.config.get('CONFIG_DIR')
-    config_path = os.path.join(config_dir, f'peer_{peer.id}.conf')
-
-    if not os.path.exists(config_path):
-        flash('Configuration file not found', 'danger')
-        return redirect(url_for('main.dashboard'))
+    # Rendered from the database so it always has the current server key and endpoint
+    wg_manager = WireGuardManager.for_peer(peer)
+    config_content = wg_manager.generate_peer_config(peer, pending=_wants_pending_keys())
 
     return send_file(
-        config_path,
+        io.BytesIO(config_content.encode('utf-8')),
         as_attachment=True,
         download_name=f'{peer.name}.conf',
         mimetype='text/plain'
     )
 
+@main.route('/peers/export.zip')
+def export_peers():
+    """Download the configs of every peer matching the dashboard filters as one ZIP"""
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+
+    qr_format = request.args.get('qr') or None
+    if qr_format is not None and qr_format not in MIMETYPES:
+        return jsonify({'error': f"qr must be one of: {', '.join(MIMETYPES)}"}), 400
+
+    listing = _listing_args()
+    peers = iter_export_peers(read_session(), listing['search'], listing['status'],
+                              request.args.get('interface') or None)
+
+    response = current_app.response_class(
+        stream_with_context(stream_peer_configs(peers, qr_format, _wants_pending_keys())),
+        mimetype='application/zip'
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename=peers-{time.strftime("%Y%m%d-%H%M%S")}.zip'
+    return response
+
 @main.route('/api/peer-stats')
 def peer_stats():
     """API endpoint to get peer statistics"""
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    wg_manager = WireGuardManager()
-    stats = wg_manager.get_peer_stats()
-
-    # Update last_seen and bandwidth for online peers
-    peers = Peer.query.all()
+    stats, stats_age = get_stats_collector().snapshot()
 
-    for peer in peers:
-        if peer.public_key in stats:
-            peer_stat = stats[peer.public_key]
-            if peer_stat['online']:
-                peer.last_seen = datetime.utcnow()
-            peer.total_rx = peer_stat['rx_bytes']
-            peer.total_tx = peer_stat['tx_bytes']
-
-    db.session.commit()
+    # Read-only: last_seen and totals are saved by the stats collector.
+    # Limited to the peers shown on the current dashboard page if ids are given
+    peers = read_session().query(Peer.id, Peer.public_key, Peer.total_rx, Peer.total_tx)
+    peer_ids = [int(peer_id) for peer_id in request.args.get('ids', '').split(',') if peer_id.isdigit()]
+    if peer_ids:
+        peers = peers.filter(Peer.id.in_(peer_ids))
 
     # Return stats mapped to peer IDs
     result = {}
-    for peer in peers:
-        if peer.public_key in stats:
-            result[peer.id] = stats[peer.public_key]
+    for peer_id, public_key, total_rx, total_tx in peers:
+        if public_key in stats:
+            result[peer_id] = stats[public_key]
         else:
-            result[peer.id] = {
+            result[peer_id] = {
                 'online': False,
-                'rx_bytes': peer.total_rx,
-                'tx_bytes': peer.total_tx,
+                'rx_bytes': total_rx,
+                'tx_bytes': total_tx,
                 'endpoint': None,
                 'latest_handshake': 0
             }
 
-    return jsonify(result)
+    response = jsonify(result)
+    response.headers['X-Stats-Age'] = f'{stats_age:.1f}'
+    response.headers['X-Online-Count'] = str(sum(1 for peer_stats in stats.values() if peer_stats['online']))
+    return response
+
+# Seconds between keep-alive comments on an idle stats stream
+STREAM_KEEPALIVE = 15
+
+@main.route('/api/peer-stats/stream')
+def peer_stats_stream():
+    """Server-Sent Events stream of peer status changes
+
+    The first event is a full snapshot; later events only carry peers whose
+    state changed. Pass ?ids= to limit the stream to the peers on a page.
+    The stream ends after STATS_STREAM_MAX_AGE seconds so it doesn't hold a
+    worker forever; EventSource reconnects on its own.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not current_app.config.get('STATS_STREAM', False):
+        return jsonify({'error': 'Streaming is disabled, poll /api/peer-stats'}), 404
+
+    collector = get_stats_collector()
+    max_age = current_app.config.get('STATS_STREAM_MAX_AGE', 300)
+    wanted_ids = {int(peer_id) for peer_id in request.args.get('ids', '').split(',') if peer_id.isdigit()}
+
+    def load_peer_ids():
+        query = read_session().query(Peer.public_key, Peer.id)
+        if wanted_ids:
+            query = query.filter(Peer.id.in_(wanted_ids))
+        peer_ids = dict(query.all())
+        # Don't hold a connection open for the life of the stream
+        read_session().close()
+        return peer_ids
+
+    def event(name, stats, peer_ids):
+        peers = {}
+        for public_key, peer_stats in stats.items():
+            peer_id = peer_ids.get(public_key)
+            if peer_id is not None:
+                peers[peer_id] = peer_stats if peer_stats is not None else OFFLINE_STATS
+        if not peers and name == 'update':
+            return None
+        data = json.dumps({'peers': peers, 'online_count': collector.online_count()})
+        return f'event: {name}\ndata: {data}\n\n'
+
+    @stream_with_context
+    def generate():
+        peer_ids = load_peer_ids()
+        stats, version = collector.versioned_snapshot()
+
+        yield f'retry: {STREAM_KEEPALIVE * 1000}\n\n'
+        yield event('snapshot', stats, peer_ids)
+        last_sent = time.monotonic()
+        closes_at = last_sent + max_age
+
+        while time.monotonic() < closes_at:
+            wait = min(STREAM_KEEPALIVE, max(closes_at - time.monotonic(), 0))
+            version, changes = collector.wait_for_changes(version, wait)
+            message = None
+            if changes is None:
+                # Fell behind the change history, start over from a snapshot
+                peer_ids = load_peer_ids()
+                stats, version = collector.versioned_snapshot()
+                message = event('snapshot', stats, peer_ids)
+            elif changes:
+                if not wanted_ids and changes.keys() - peer_ids.keys():
+                    # A peer created since the stream started
+                    peer_ids = load_peer_ids()
+                message = event('update', changes, peer_ids)
+
+            if message:
+                yield message
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= STREAM_KEEPALIVE:
+                yield ': keep-alive\n\n'
+                last_sent = time.monotonic()
+
+    response = current_app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@main.route('/api/peer/<int:peer_id>/traffic')
+def peer_traffic(peer_id):
+    """API endpoint to get a peer's bandwidth history"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if read_session().get(Peer, peer_id) is None:
+        abort(404)
+
+    resolution = request.args.get('resolution', '1h')
+    if resolution not in RESOLUTIONS:
+        return jsonify({'error': f'resolution must be one of {", ".join(RESOLUTIONS)}'}), 400
+
+    # Default to everything still retained at this resolution
+    retention = current_app.config.get('TRAFFIC_RETENTION', {}).get(resolution, 86400)
+    end = request.args.get('end', type=int) or int(time.time())
+    start = request.args.get('start', type=int) or end - retention
+
+    return jsonify({
+        'peer_id': peer_id,
+        'resolution': resolution,
+        'start': start,
+        'end': end,
+        'points': query_traffic(peer_id, resolution, start, end, read_session())
+    })
+
+@main.route('/metrics')
+def metrics():
+    """Prometheus metrics, summed over every worker process"""
+    token = current_app.config.get('METRICS_TOKEN')
+    authorized = 'user_id' in session or (
+        token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    )
+    if not authorized:
+        return current_app.response_class('Unauthorized\n', status=401, mimetype='text/plain')
+
+    return current_app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @main.route('/settings')
 def settings():
@@ -265,7 +604,17 @@ def settings():
         'interface': wg_manager.get_main_interface(),
         'total_peers': Peer.query.count(),
         'enabled_peers': Peer.query.filter_by(enabled=True).count(),
-        'disabled_peers': Peer.query.filter_by(enabled=False).count()
+        'disabled_peers': Peer.query.filter_by(enabled=False).count(),
+        'interfaces': [
+            {
+                'name': interface.name,
+                'listen_port': interface.listen_port,
+                'address_pools': ', '.join(interface.pools),
+                'enabled': interface.enabled,
+                'peers': peer_count
+            }
+            for interface, peer_count in interface_loads(include_disabled=True)
+        ]
     }
 
     return render_template('settings.html', settings=settings_data)
@@ -0,0 +1,448 @@
+import base64
+import copy
+import ipaddress
+import os
+import socket
+import struct
+import threading
+from app.utils.metrics import run_command, timed_command
+
+# WireGuard treats an all-zero preshared key as none; setting it clears the key
+NO_PRESHARED_KEY = base64.b64encode(bytes(32)).decode('ascii')
+
+# [Interface] keys understood by wg-quick but not by `wg setconf`/`wg syncconf`
+WG_QUICK_KEYS = {'address', 'dns', 'mtu', 'table', 'preup', 'postup', 'predown', 'postdown', 'saveconfig'}
+
+def strip_config(config):
+    """Drop wg-quick-only settings from a config, like `wg-quick strip`"""
+    lines = []
+    section = None
+    for line in config.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('['):
+            section = stripped.lower()
+        elif section == '[interface]' and '=' in stripped and not stripped.startswith('#'):
+            if stripped.split('=', 1)[0].strip().lower() in WG_QUICK_KEYS:
+                continue
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+def parse_config_peers(config):
+    """Return {public_key: {'allowed_ips': [...], 'preshared_key': ...}} from a wg config"""
+    peers = {}
+    current = None
+    for line in config.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith('['):
+            current = {'allowed_ips': [], 'preshared_key': None} if line.lower() == '[peer]' else None
+            continue
+        if current is None or '=' not in line:
+            continue
+
+        key, value = (part.strip() for part in line.split('=', 1))
+        key = key.lower()
+        if key == 'publickey':
+            peers[value] = current
+        elif key == 'allowedips':
+            current['allowed_ips'] += [ip.strip() for ip in value.split(',') if ip.strip()]
+        elif key == 'presharedkey':
+            current['preshared_key'] = value
+    return peers
+
+class WireGuardBackend:
+    """How WireGuardManager reads and changes a running WireGuard interface
+
+    Peers are keyed by their base64 public key. dump() returns, per peer:
+    preshared_key, endpoint, allowed_ips, latest_handshake, rx_bytes, tx_bytes.
+    """
+
+    def dump(self, interface):
+        raise NotImplementedError
+
+    def public_key(self, interface):
+        raise NotImplementedError
+
+    def set_peer(self, interface, public_key, allowed_ips, preshared_key=None):
+        """Add a peer or replace its allowed IPs (and preshared key, if given)
+
+        A preshared_key of None leaves the peer's key alone; NO_PRESHARED_KEY clears it.
+        """
+        raise NotImplementedError
+
+    def remove_peer(self, interface, public_key):
+        raise NotImplementedError
+
+    def sync(self, interface, config):
+        """Make the interface's peers match a wg config, touching only peers that differ"""
+        desired = parse_config_peers(config)
+        current = self.dump(interface)
+
+        for public_key in current.keys() - desired.keys():
+            self.remove_peer(interface, public_key)
+
+        for public_key, peer in desired.items():
+            live = current.get(public_key)
+            if (live is None
+                    or sorted(live['allowed_ips']) != sorted(peer['allowed_ips'])
+                    or live['preshared_key'] != peer['preshared_key']):
+                self.set_peer(interface, public_key, peer['allowed_ips'], peer['preshared_key'] or NO_PRESHARED_KEY)
+
+class SubprocessBackend(WireGuardBackend):
+    """Drives the interface through `sudo wg`"""
+
+    def _wg(self, *args, input=None):
+        result = run_command(
+            ['/usr/bin/sudo', '/usr/bin/wg', *args],
+            input=input,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return result.stdout
+
+    def dump(self, interface):
+        peers = {}
+        lines = self._wg('show', interface, 'dump').strip().split('\n')
+
+        # Skip the interface line
+        for line in lines[1:]:
+            parts = line.split('\t')
+            if len(parts) < 7:
+                continue
+            peers[parts[0]] = {
+                'preshared_key': parts[1] if parts[1] not in ('(none)', '') else None,
+                'endpoint': parts[2] if parts[2] != '(none)' else None,
+                'allowed_ips': [ip for ip in parts[3].split(',') if ip and ip != '(none)'],
+                'latest_handshake': int(parts[4]) if parts[4] else 0,
+                'rx_bytes': int(parts[5]) if parts[5] else 0,
+                'tx_bytes': int(parts[6]) if parts[6] else 0
+            }
+        return peers
+
+    def public_key(self, interface):
+        return self._wg('show', interface, 'public-key').strip() or None
+
+    def set_peer(self, interface, public_key, allowed_ips, preshared_key=None):
+        args = ['set', interface, 'peer', public_key, 'allowed-ips', ','.join(allowed_ips)]
+        if preshared_key:
+            # wg only reads the preshared key from a file; hand it over on stdin
+            args += ['preshared-key', '/dev/stdin']
+        self._wg(*args, input=preshared_key or '')
+
+    def remove_peer(self, interface, public_key):
+        self._wg('set', interface, 'peer', public_key, 'remove')
+
+    def sync(self, interface, config):
+        # One `wg syncconf` beats a `wg set` per changed peer
+        self._wg('syncconf', interface, '/dev/stdin', input=strip_config(config))
+
+# Generic netlink constants (linux/netlink.h, linux/genetlink.h)
+NETLINK_GENERIC = 16
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+
+# WireGuard generic netlink API (linux/wireguard.h)
+WG_GENL_NAME = 'wireguard'
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WG_CMD_SET_DEVICE = 1
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PUBLIC_KEY = 4
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_FLAGS = 3
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGPEER_F_REMOVE_ME = 1
+WGPEER_F_REPLACE_ALLOWEDIPS = 2
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+def nl_attr(attr_type, payload):
+    length = 4 + len(payload)
+    return struct.pack('=HH', length, attr_type) + payload + b'\0' * (-length % 4)
+
+def nl_nest(attr_type, attrs):
+    return nl_attr(attr_type | NLA_F_NESTED, b''.join(attrs))
+
+def nl_parse(data):
+    """Yield (type, payload) for each attribute in a buffer"""
+    offset = 0
+    while offset + 4 <= len(data):
+        length, attr_type = struct.unpack_from('=HH', data, offset)
+        if length < 4:
+            break
+        yield attr_type & NLA_TYPE_MASK, data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+
+def _decode_endpoint(payload):
+    family = struct.unpack_from('=H', payload)[0]
+    port = struct.unpack_from('!H', payload, 2)[0]
+    if family == socket.AF_INET:
+        return f'{ipaddress.IPv4Address(payload[4:8])}:{port}'
+    if family == socket.AF_INET6:
+        return f'[{ipaddress.IPv6Address(payload[8:24])}]:{port}'
+    return None
+
+def _decode_allowed_ip(payload):
+    attrs = dict(nl_parse(payload))
+    family = struct.unpack('=H', attrs[WGALLOWEDIP_A_FAMILY])[0]
+    cidr = attrs[WGALLOWEDIP_A_CIDR_MASK][0]
+    if family == socket.AF_INET:
+        return f'{ipaddress.IPv4Address(attrs[WGALLOWEDIP_A_IPADDR])}/{cidr}'
+    return f'{ipaddress.IPv6Address(attrs[WGALLOWEDIP_A_IPADDR])}/{cidr}'
+
+def _encode_allowed_ip(cidr):
+    network = ipaddress.ip_network(cidr, strict=False)
+    family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+    return [
+        nl_attr(WGALLOWEDIP_A_FAMILY, struct.pack('=H', family)),
+        nl_attr(WGALLOWEDIP_A_IPADDR, network.network_address.packed),
+        nl_attr(WGALLOWEDIP_A_CIDR_MASK, struct.pack('=B', network.prefixlen))
+    ]
+
+def decode_device(messages, peers=None):
+    """Merge WG_CMD_GET_DEVICE dump messages into (public_key, peers)
+
+    A peer's allowed IPs may be split across messages; they are merged by key.
+    """
+    peers = {} if peers is None else peers
+    public_key = None
+
+    for payload in messages:
+        for attr_type, value in nl_parse(payload):
+            if attr_type == WGDEVICE_A_PUBLIC_KEY:
+                public_key = base64.b64encode(value).decode('ascii')
+            elif attr_type == WGDEVICE_A_PEERS:
+                for _, peer_payload in nl_parse(value):
+                    peer_attrs = list(nl_parse(peer_payload))
+                    key = next((v for t, v in peer_attrs if t == WGPEER_A_PUBLIC_KEY), None)
+                    if key is None:
+                        continue
+                    peer = peers.setdefault(base64.b64encode(key).decode('ascii'), {
+                        'preshared_key': None,
+                        'endpoint': None,
+                        'allowed_ips': [],
+                        'latest_handshake': 0,
+                        'rx_bytes': 0,
+                        'tx_bytes': 0
+                    })
+                    for peer_type, peer_value in peer_attrs:
+                        if peer_type == WGPEER_A_PRESHARED_KEY and any(peer_value):
+                            peer['preshared_key'] = base64.b64encode(peer_value).decode('ascii')
+                        elif peer_type == WGPEER_A_ENDPOINT:
+                            peer['endpoint'] = _decode_endpoint(peer_value)
+                        elif peer_type == WGPEER_A_LAST_HANDSHAKE_TIME:
+                            peer['latest_handshake'] = struct.unpack_from('=q', peer_value)[0]
+                        elif peer_type == WGPEER_A_RX_BYTES:
+                            peer['rx_bytes'] = struct.unpack('=Q', peer_value)[0]
+                        elif peer_type == WGPEER_A_TX_BYTES:
+                            peer['tx_bytes'] = struct.unpack('=Q', peer_value)[0]
+                        elif peer_type == WGPEER_A_ALLOWEDIPS:
+                            peer['allowed_ips'] += [_decode_allowed_ip(ip) for _, ip in nl_parse(peer_value)]
+
+    return public_key, peers
+
+def encode_set_peer(interface, public_key, allowed_ips=None, preshared_key=None, remove=False):
+    """WG_CMD_SET_DEVICE attributes that change (or remove) a single peer"""
+    peer = [nl_attr(WGPEER_A_PUBLIC_KEY, base64.b64decode(public_key))]
+    if remove:
+        peer.append(nl_attr(WGPEER_A_FLAGS, struct.pack('=I', WGPEER_F_REMOVE_ME)))
+    else:
+        if preshared_key:
+            peer.append(nl_attr(WGPEER_A_PRESHARED_KEY, base64.b64decode(preshared_key)))
+        peer.append(nl_attr(WGPEER_A_FLAGS, struct.pack('=I', WGPEER_F_REPLACE_ALLOWEDIPS)))
+        peer.append(nl_nest(WGPEER_A_ALLOWEDIPS, [
+            nl_nest(index, _encode_allowed_ip(cidr)) for index, cidr in enumerate(allowed_ips or [])
+        ]))
+
+    return [
+        nl_attr(WGDEVICE_A_IFNAME, interface.encode('utf-8') + b'\0'),
+        nl_nest(WGDEVICE_A_PEERS, [nl_nest(0, peer)])
+    ]
+
+class NetlinkBackend(WireGuardBackend):
+    """Talks to the kernel's WireGuard generic netlink family directly
+
+    No process is spawned per call, but the app needs CAP_NET_ADMIN (for
+    example AmbientCapabilities=CAP_NET_ADMIN in its systemd unit).
+    """
+
+    def __init__(self):
+        self._family_id = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _request(self, family_id, command, version, attrs, flags):
+        """Send one request and return the genl payloads of its replies"""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+
+        body = struct.pack('=BBH', command, version, 0) + b''.join(attrs)
+        header = struct.pack('=IHHII', 16 + len(body), family_id, NLM_F_REQUEST | flags, seq, 0)
+        dump = flags & NLM_F_DUMP == NLM_F_DUMP
+
+        if family_id == GENL_ID_CTRL:
+            name = 'netlink getfamily'
+        else:
+            name = 'netlink get_device' if command == WG_CMD_GET_DEVICE else 'netlink set_device'
+
+        with timed_command(name):
+            return self._exchange(header + body, seq, dump)
+
+    def _exchange(self, message, seq, dump):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_GENERIC)
+        try:
+            sock.bind((0, 0))
+            sock.send(message)
+
+            replies = []
+            while True:
+                data = sock.recv(1 << 16)
+                offset = 0
+                while offset + 16 <= len(data):
+                    length, msg_type, _, msg_seq, _ = struct.unpack_from('=IHHII', data, offset)
+                    if length < 16:
+                        break
+                    message = data[offset + 16:offset + length]
+                    offset += (length + 3) & ~3
+                    if msg_seq != seq:
+                        continue
+
+                    if msg_type == NLMSG_ERROR:
+                        error = struct.unpack_from('=i', message)[0]
+                        if error:
+                            raise OSError(-error, os.strerror(-error))
+                        # Plain ACK ends a non-dump request
+                        if not dump:
+                            return replies
+                    elif msg_type == NLMSG_DONE:
+                        return replies
+                    else:
+                        # Skip the genl header
+                        replies.append(message[4:])
+        finally:
+            sock.close()
+
+    def _wireguard_family(self):
+        if self._family_id is None:
+            replies = self._request(
+                GENL_ID_CTRL, CTRL_CMD_GETFAMILY, 1,
+                [nl_attr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME.encode('ascii') + b'\0')],
+                NLM_F_ACK
+            )
+            for payload in replies:
+                for attr_type, value in nl_parse(payload):
+                    if attr_type == CTRL_ATTR_FAMILY_ID:
+                        self._family_id = struct.unpack('=H', value)[0]
+            if self._family_id is None:
+                raise OSError('WireGuard generic netlink family not found')
+        return self._family_id
+
+    def _get_device(self, interface):
+        replies = self._request(
+            self._wireguard_family(), WG_CMD_GET_DEVICE, WG_GENL_VERSION,
+            [nl_attr(WGDEVICE_A_IFNAME, interface.encode('utf-8') + b'\0')],
+            NLM_F_DUMP
+        )
+        return decode_device(replies)
+
+    def dump(self, interface):
+        return self._get_device(interface)[1]
+
+    def public_key(self, interface):
+        return self._get_device(interface)[0]
+
+    def set_peer(self, interface, public_key, allowed_ips, preshared_key=None):
+        self._request(
+            self._wireguard_family(), WG_CMD_SET_DEVICE, WG_GENL_VERSION,
+            encode_set_peer(interface, public_key, allowed_ips, preshared_key),
+            NLM_F_ACK
+        )
+
+    def remove_peer(self, interface, public_key):
+        self._request(
+            self._wireguard_family(), WG_CMD_SET_DEVICE, WG_GENL_VERSION,
+            encode_set_peer(interface, public_key, remove=True),
+            NLM_F_ACK
+        )
+
+class FakeBackend(WireGuardBackend):
+    """In-memory interfaces for tests and benchmarks; nothing touches the kernel"""
+
+    def __init__(self):
+        self.interfaces = {}
+        self._lock = threading.Lock()
+
+    def _interface(self, interface):
+        return self.interfaces.setdefault(interface, {'public_key': None, 'peers': {}})
+
+    def dump(self, interface):
+        with self._lock:
+            return copy.deepcopy(self._interface(interface)['peers'])
+
+    def public_key(self, interface):
+        with self._lock:
+            return self._interface(interface)['public_key']
+
+    def set_peer(self, interface, public_key, allowed_ips, preshared_key=None):
+        with self._lock:
+            peers = self._interface(interface)['peers']
+            peer = peers.setdefault(public_key, {
+                'preshared_key': None,
+                'endpoint': None,
+                'allowed_ips': [],
+                'latest_handshake': 0,
+                'rx_bytes': 0,
+                'tx_bytes': 0
+            })
+            peer['allowed_ips'] = list(allowed_ips)
+            if preshared_key:
+                peer['preshared_key'] = None if preshared_key == NO_PRESHARED_KEY else preshared_key
+
+    def remove_peer(self, interface, public_key):
+        with self._lock:
+            self._interface(interface)['peers'].pop(public_key, None)
+
+    def set_traffic(self, interface, public_key, **values):
+        """Simulate activity: set endpoint, latest_handshake, rx_bytes or tx_bytes"""
+        with self._lock:
+            self._interface(interface)['peers'][public_key].update(values)
+
+BACKENDS = {
+    'subprocess': SubprocessBackend,
+    'netlink': NetlinkBackend,
+    'fake': FakeBackend
+}
+
+_backend = None
+
+def configure_backend(name):
+    """Select the backend used by every WireGuardManager in this process"""
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown WG_BACKEND '{name}', expected one of: {', '.join(BACKENDS)}")
+    _backend = BACKENDS[name]()
+    return _backend
+
+def get_backend():
+    if _backend is None:
+        configure_backend('subprocess')
+    return _backend
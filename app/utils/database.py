@@ -0,0 +1,81 @@
+from functools import partial
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from app import db
+
+def _apply_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+def _is_file_database(url):
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+def configure_pool(app):
+    """Pool sizes for a file-backed SQLite database; call before db.init_app()
+
+    In-memory databases keep Flask-SQLAlchemy's single shared connection.
+    """
+    if not _is_file_database(make_url(app.config['SQLALCHEMY_DATABASE_URI'])):
+        return
+
+    options = {
+        'pool_size': app.config.get('SQLITE_POOL_SIZE', 5),
+        'max_overflow': app.config.get('SQLITE_POOL_SIZE', 5),
+        'pool_timeout': 10
+    }
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+def _app_context_id():
+    from flask.globals import app_ctx
+    return id(app_ctx._get_current_object())
+
+def init_database(app):
+    """Tune SQLite connections and set up the read-only session
+
+    Every connection gets SQLITE_PRAGMAS (WAL, synchronous=NORMAL, busy
+    timeout, mmap). Reads that don't need to write go through
+    read_session(): a separate query_only engine and pool, so dashboards
+    and stats polling never hold or wait on the write lock.
+    """
+    pragmas = app.config.get('SQLITE_PRAGMAS', {})
+
+    with app.app_context():
+        engine = db.engine
+        if not _is_file_database(engine.url):
+            # Nothing to tune, and a second engine would be a second database
+            app.extensions['read_session'] = db.session
+            return
+
+        event.listen(engine, 'connect', partial(_apply_pragmas, pragmas))
+        # journal_mode is stored in the file; switch it before readers connect
+        with engine.connect():
+            pass
+
+    read_pragmas = {name: value for name, value in pragmas.items() if name != 'journal_mode'}
+    read_pragmas['query_only'] = 'ON'
+
+    read_engine = create_engine(
+        engine.url,
+        pool_size=app.config.get('SQLITE_READ_POOL_SIZE', 10),
+        max_overflow=app.config.get('SQLITE_READ_POOL_SIZE', 10),
+        connect_args={'check_same_thread': False}
+    )
+    event.listen(read_engine, 'connect', partial(_apply_pragmas, read_pragmas))
+
+    session = scoped_session(sessionmaker(bind=read_engine), scopefunc=_app_context_id)
+    app.extensions['read_session'] = session
+
+    @app.teardown_appcontext
+    def remove_read_session(exception=None):
+        session.remove()
+
+def read_session():
+    """Session for queries that never write, e.g. read_session().query(Peer)"""
+    from flask import current_app
+    return current_app.extensions['read_session']
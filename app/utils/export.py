@@ -0,0 +1,98 @@
+import re
+import time
+import zipfile
+from sqlalchemy.orm import undefer_group
+from app.models.interface import Interface
+from app.models.peer import Peer
+from app.utils.listing import filter_peers
+
+# Peers loaded per query while exporting
+EXPORT_BATCH = 500
+
+class _StreamBuffer:
+    """Write-only file object for ZipFile that hands written bytes to the caller
+
+    It has no seek() or tell(), so ZipFile writes each entry's sizes in a
+    data descriptor after its data instead of going back to patch the header.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def safe_filename(name):
+    """A peer name reduced to characters that are safe in an archive path"""
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('._') or 'peer'
+
+def iter_export_peers(session, search=None, status=None, interface=None):
+    """Yield matching peers ordered by id, a batch at a time"""
+    # Keys come in with the rows rather than one query per peer
+    query = filter_peers(session.query(Peer).options(undefer_group('keys')), search, status)
+    if interface:
+        query = query.join(Interface, Peer.interface_id == Interface.id).filter(Interface.name == interface)
+
+    last_id = 0
+    while True:
+        batch = query.filter(Peer.id > last_id).order_by(Peer.id).limit(EXPORT_BATCH).all()
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+        # Peers already written don't need to stay in the identity map
+        session.expunge_all()
+
+def stream_peer_configs(peers, qr_format=None, pending=False):
+    """Yield a ZIP of each peer's client config, rendered now, as chunks of bytes
+
+    Entries are `<interface>/<name>_<id>.conf`, plus a QR code image next to
+    each config if qr_format is 'png' or 'svg'. With pending=True, peers with
+    a staged key rotation get configs with their new keys. Only the archive's central
+    directory grows with the peer count; configs and images are written out
+    one peer at a time.
+    """
+    from app.utils.qr import render_qrcode
+    from app.utils.wireguard import WireGuardManager
+
+    # One manager, and one server public key lookup, per interface
+    managers = {}
+    date_time = time.localtime()[:6]
+
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for peer in peers:
+            if peer.interface_id not in managers:
+                wg_manager = WireGuardManager.for_peer(peer)
+                managers[peer.interface_id] = (wg_manager, wg_manager.get_server_public_key())
+            wg_manager, server_public_key = managers[peer.interface_id]
+
+            config_content = wg_manager.generate_peer_config(peer, server_public_key, pending)
+            path = f'{wg_manager.interface}/{safe_filename(peer.name)}_{peer.id}'
+
+            entry = zipfile.ZipInfo(f'{path}.conf', date_time)
+            entry.compress_type = zipfile.ZIP_DEFLATED
+            entry.external_attr = 0o600 << 16  # Private keys: owner-only when extracted
+            archive.writestr(entry, config_content)
+
+            if qr_format:
+                entry = zipfile.ZipInfo(f'{path}.{qr_format}', date_time)
+                # PNGs are already compressed
+                entry.compress_type = zipfile.ZIP_STORED if qr_format == 'png' else zipfile.ZIP_DEFLATED
+                entry.external_attr = 0o600 << 16
+                archive.writestr(entry, render_qrcode(config_content, qr_format))
+
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+
+    yield buffer.drain()
@@ -0,0 +1,284 @@
+"""Firewall rules for peer traffic
+
+'iptables' is the original setup: wg-quick's PostUp appends a FORWARD
+accept and a MASQUERADE rule when the interface comes up. 'nftables'
+manages one table, inet vpn_manager, whose named sets and maps are keyed by
+peer address:
+
+- allowed4/allowed6: enabled peers, whose forwarded traffic is accepted
+  and masqueraded
+- disabled4/disabled6: disabled peers, dropped
+- rx4/rx6 and tx4/tx6: address to a named counter per peer and direction
+
+Every change is one `nft -f` transaction. Disabling a peer moves its address
+between two sets, so nothing else is touched and per-peer counters keep
+counting in the kernel.
+"""
+import fcntl
+import ipaddress
+import json
+import os
+from collections import namedtuple
+from app.utils.metrics import run_command
+
+NFT = ['/usr/bin/sudo', '/usr/sbin/nft']
+TABLE = 'vpn_manager'
+
+# Loaded by PostUp when the table is missing, e.g. after a reboot
+RULESET_PATH = '/etc/wireguard/vpn-manager.nft'
+
+FirewallPeer = namedtuple('FirewallPeer', 'peer_id ip_address enabled')
+
+def _family(ip_address):
+    return '4' if ipaddress.ip_address(ip_address).version == 4 else '6'
+
+def _quote(name):
+    return '"' + name.replace('"', '') + '"'
+
+class IptablesFirewall:
+    """Rules appended by wg-quick on interface up; nothing to do per peer"""
+    name = 'iptables'
+
+    def __init__(self, state_dir=None):
+        pass
+
+    def post_up(self, interface, main_interface):
+        return (f'iptables -A FORWARD -i {interface} -j ACCEPT; '
+                f'iptables -t nat -A POSTROUTING -o {main_interface} -j MASQUERADE')
+
+    def post_down(self, interface, main_interface):
+        return (f'iptables -D FORWARD -i {interface} -j ACCEPT; '
+                f'iptables -t nat -D POSTROUTING -o {main_interface} -j MASQUERADE')
+
+    def sync(self, interfaces, main_interface, peers):
+        return 0
+
+    def peer_counters(self):
+        return {}
+
+class NftablesFirewall:
+    """Keeps the vpn_manager table in line with the peers in the database
+
+    The last applied state is kept in a state file, so a sync sends only the
+    set and map elements of peers that changed. If the table is missing, or
+    the interfaces or uplink changed, the whole table is replaced in one
+    transaction instead.
+    """
+    name = 'nftables'
+
+    def __init__(self, state_dir=None, nft=None, ruleset_path=RULESET_PATH):
+        self.state_path = os.path.join(state_dir or '.', 'firewall.json')
+        self.nft = nft or NFT
+        self.ruleset_path = ruleset_path
+
+    def post_up(self, interface, main_interface):
+        # Rules live in their own table, not on the interface; restore them only if they're gone
+        return f'nft list table inet {TABLE} > /dev/null 2>&1 || nft -f {self.ruleset_path}'
+
+    def post_down(self, interface, main_interface):
+        return None
+
+    def _nft(self, *args, input=None):
+        result = run_command([*self.nft, *args], input=input, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"nft {' '.join(args)} failed: {result.stderr.strip()}")
+        return result.stdout
+
+    def table_exists(self):
+        return f'table inet {TABLE}' in self._nft('list', 'tables')
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            peers = {int(peer_id): FirewallPeer(int(peer_id), *values) for peer_id, values in state['peers'].items()}
+            return state['interfaces'], state['main_interface'], peers
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None, {}
+
+    def _save_state(self, interfaces, main_interface, peers):
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'interfaces': interfaces,
+                'main_interface': main_interface,
+                'peers': {str(peer.peer_id): [peer.ip_address, peer.enabled] for peer in peers.values()}
+            }, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _clear_state(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def render_ruleset(self, interfaces, main_interface, peers):
+        """The whole table as one transaction that replaces any existing one"""
+        elements = {name: [] for name in ('allowed4', 'allowed6', 'disabled4', 'disabled6', 'rx4', 'rx6', 'tx4', 'tx6')}
+        counters = []
+        for peer in sorted(peers.values()):
+            family = _family(peer.ip_address)
+            elements[('allowed' if peer.enabled else 'disabled') + family].append(peer.ip_address)
+            elements['rx' + family].append(f'{peer.ip_address} : "rx_{peer.peer_id}"')
+            elements['tx' + family].append(f'{peer.ip_address} : "tx_{peer.peer_id}"')
+            counters += [f'rx_{peer.peer_id}', f'tx_{peer.peer_id}']
+
+        def body(type_, values):
+            if not values:
+                return f'type {type_};'
+            return f"type {type_}; elements = {{ {', '.join(values)} }}"
+
+        lines = [
+            # Declaring the table first makes the delete valid when it doesn't exist yet
+            f'table inet {TABLE}',
+            f'delete table inet {TABLE}',
+            f'table inet {TABLE} {{',
+            f"    set interfaces {{ {body('ifname', [_quote(name) for name in interfaces])} }}"
+        ]
+        for family, type_ in (('4', 'ipv4_addr'), ('6', 'ipv6_addr')):
+            lines += [
+                f"    set allowed{family} {{ {body(type_, elements['allowed' + family])} }}",
+                f"    set disabled{family} {{ {body(type_, elements['disabled' + family])} }}",
+                f"    map rx{family} {{ {body(f'{type_} : counter', elements['rx' + family])} }}",
+                f"    map tx{family} {{ {body(f'{type_} : counter', elements['tx' + family])} }}"
+            ]
+        lines += [f'    counter {name} {{ }}' for name in counters]
+        lines += [
+            '    chain forward {',
+            '        type filter hook forward priority filter; policy accept;',
+            '        iifname @interfaces ip saddr @disabled4 drop',
+            '        iifname @interfaces ip6 saddr @disabled6 drop',
+            '        iifname @interfaces counter name ip saddr map @rx4',
+            '        iifname @interfaces counter name ip6 saddr map @rx6',
+            '        oifname @interfaces counter name ip daddr map @tx4',
+            '        oifname @interfaces counter name ip6 daddr map @tx6',
+            '        iifname @interfaces ip saddr @allowed4 accept',
+            '        iifname @interfaces ip6 saddr @allowed6 accept',
+            '        iifname @interfaces drop',
+            '    }',
+            '    chain postrouting {',
+            '        type nat hook postrouting priority srcnat; policy accept;',
+            f'        oifname {_quote(main_interface)} ip saddr @allowed4 masquerade',
+            f'        oifname {_quote(main_interface)} ip6 saddr @allowed6 masquerade',
+            '    }',
+            '}'
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def _peer_commands(self, old, new):
+        """(removals, additions) taking one peer from `old` to `new`; either may be None"""
+        removals, additions = [], []
+        if old and new and old.ip_address == new.ip_address:
+            # Only enabled changed: move the address between sets
+            family = _family(new.ip_address)
+            removals.append(f"delete element inet {TABLE} {'allowed' if old.enabled else 'disabled'}{family} {{ {old.ip_address} }}")
+            additions.append(f"add element inet {TABLE} {'allowed' if new.enabled else 'disabled'}{family} {{ {new.ip_address} }}")
+            return removals, additions
+
+        if old:
+            family = _family(old.ip_address)
+            removals += [
+                f"delete element inet {TABLE} {'allowed' if old.enabled else 'disabled'}{family} {{ {old.ip_address} }}",
+                f'delete element inet {TABLE} rx{family} {{ {old.ip_address} }}',
+                f'delete element inet {TABLE} tx{family} {{ {old.ip_address} }}'
+            ]
+            if new is None:
+                removals += [
+                    f'delete counter inet {TABLE} rx_{old.peer_id}',
+                    f'delete counter inet {TABLE} tx_{old.peer_id}'
+                ]
+
+        if new:
+            family = _family(new.ip_address)
+            if old is None:
+                additions += [
+                    f'add counter inet {TABLE} rx_{new.peer_id}',
+                    f'add counter inet {TABLE} tx_{new.peer_id}'
+                ]
+            # A moved peer keeps its counters under the new address
+            additions += [
+                f'add element inet {TABLE} rx{family} {{ {new.ip_address} : "rx_{new.peer_id}" }}',
+                f'add element inet {TABLE} tx{family} {{ {new.ip_address} : "tx_{new.peer_id}" }}',
+                f"add element inet {TABLE} {'allowed' if new.enabled else 'disabled'}{family} {{ {new.ip_address} }}"
+            ]
+        return removals, additions
+
+    def sync(self, interfaces, main_interface, peers):
+        """Apply the interfaces, uplink and [FirewallPeer]; returns how many peers changed
+
+        Raises if nft fails, leaving the previous rules in place; the next
+        sync then replaces the whole table.
+        """
+        desired = {peer.peer_id: peer for peer in peers}
+        interfaces = sorted(interfaces)
+
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(f'{self.state_path}.lock', 'a') as lock_file:
+            # One transaction at a time, across processes
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            applied_interfaces, applied_main_interface, applied = self._load_state()
+            if (applied_interfaces != interfaces or applied_main_interface != main_interface
+                    or not self.table_exists()):
+                ruleset = self.render_ruleset(interfaces, main_interface, desired)
+                changed = len(desired)
+            else:
+                removals, additions = [], []
+                changed = 0
+                for peer_id in sorted(applied.keys() | desired.keys()):
+                    old, new = applied.get(peer_id), desired.get(peer_id)
+                    if old != new:
+                        peer_removals, peer_additions = self._peer_commands(old, new)
+                        removals += peer_removals
+                        additions += peer_additions
+                        changed += 1
+                if not changed:
+                    return 0
+                # Removals first: a new peer may take an address another peer just gave up
+                ruleset = '\n'.join(removals + additions) + '\n'
+
+            try:
+                self._nft('-f', '-', input=ruleset)
+            except Exception:
+                self._clear_state()
+                raise
+
+            self._save_state(interfaces, main_interface, desired)
+
+        # Keep the copy PostUp restores from in step with the kernel
+        from app.utils.wireguard import write_file_atomic
+        write_file_atomic(self.ruleset_path, self.render_ruleset(interfaces, main_interface, desired))
+        return changed
+
+    def peer_counters(self):
+        """{peer_id: {'rx_bytes': ..., 'tx_bytes': ...}} forwarded to and from each peer"""
+        listing = json.loads(self._nft('-j', 'list', 'counters', 'table', 'inet', TABLE))
+        counters = {}
+        for entry in listing.get('nftables', []):
+            counter = entry.get('counter')
+            if not counter:
+                continue
+            direction, _, peer_id = counter['name'].partition('_')
+            if direction in ('rx', 'tx') and peer_id.isdigit():
+                counters.setdefault(int(peer_id), {'rx_bytes': 0, 'tx_bytes': 0})[f'{direction}_bytes'] = counter['bytes']
+        return counters
+
+FIREWALLS = {
+    'iptables': IptablesFirewall,
+    'nftables': NftablesFirewall
+}
+
+_firewall = None
+
+def configure_firewall(name, state_dir=None):
+    """Select the firewall backend used by this process"""
+    global _firewall
+    if name not in FIREWALLS:
+        raise ValueError(f"Unknown FIREWALL_BACKEND '{name}', expected one of: {', '.join(FIREWALLS)}")
+    _firewall = FIREWALLS[name](state_dir)
+    return _firewall
+
+def get_firewall():
+    if _firewall is None:
+        configure_firewall('iptables')
+    return _firewall
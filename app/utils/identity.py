@@ -0,0 +1,123 @@
+import os
+import socket
+import threading
+
+# Multicast groups for route changes (linux/rtnetlink.h)
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_ROUTE = 0x400
+
+class RouteWatcher:
+    """Reports whether the routing table may have changed since the last check
+
+    Subscribes to rtnetlink route notifications on a non-blocking socket, so
+    a check is a single recv() that normally returns nothing. Without netlink
+    every check reports a change and callers simply don't cache.
+    """
+
+    def __init__(self):
+        self._socket = None
+        self._pid = None
+
+    def _open(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK, socket.NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_ROUTE))
+        return sock
+
+    def changed(self):
+        if self._pid != os.getpid():
+            # Each process needs its own subscription; until then we know nothing
+            self._pid = os.getpid()
+            try:
+                self._socket = self._open()
+            except (OSError, AttributeError):
+                self._socket = None
+            return True
+
+        if self._socket is None:
+            return True
+
+        changed = False
+        while True:
+            try:
+                if not self._socket.recv(65536):
+                    break
+                changed = True
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS: notifications were dropped, assume the worst
+                return True
+        return changed
+
+_lock = threading.Lock()
+_route_watcher = RouteWatcher()
+_file_facts = {}
+_host_facts = {}
+_MISSING = object()
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+def file_fact(path, name, compute):
+    """Return a value derived from the file at `path`
+
+    The value is recomputed only when the file's mtime or size changes, or
+    after invalidate(). None results are not cached.
+    """
+    stat = _file_stat(path)
+    with _lock:
+        cached_stat, facts = _file_facts.get(path, (_MISSING, {}))
+        if cached_stat != stat:
+            facts = {}
+            _file_facts[path] = (stat, facts)
+        if name in facts:
+            return facts[name]
+
+    value = compute()
+    if value is not None:
+        with _lock:
+            if _file_facts.get(path, (None, None))[1] is facts:
+                facts[name] = value
+    return value
+
+def host_fact(name, compute):
+    """Return a host-level value, recomputed after a route change or invalidate()"""
+    with _lock:
+        if _route_watcher.changed():
+            _host_facts.clear()
+        if name in _host_facts:
+            return _host_facts[name]
+
+    value = compute()
+    if value is not None:
+        with _lock:
+            _host_facts[name] = value
+    return value
+
+def invalidate(path=None):
+    """Forget cached facts for one file, or for every file and the host"""
+    with _lock:
+        if path is None:
+            _file_facts.clear()
+            _host_facts.clear()
+        else:
+            _file_facts.pop(path, None)
+
+def default_route_interface():
+    """Interface of the lowest-metric IPv4 default route, read from /proc"""
+    best = None
+    with open('/proc/net/route', 'r') as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            iface, destination, metric, mask = fields[0], fields[1], int(fields[6]), fields[7]
+            if destination == '00000000' and mask == '00000000':
+                if best is None or metric < best[1]:
+                    best = (iface, metric)
+    return best[0] if best else None
@@ -0,0 +1,132 @@
+import heapq
+import ipaddress
+from sqlalchemy import func
+from app import db
+from app.models.interface import Interface
+from app.models.peer import Peer
+from app.utils.ipam import AddressPool, get_allocator
+
+DEFAULT_INTERFACE = 'wg0'
+DEFAULT_LISTEN_PORT = 51820
+
+def interface_names():
+    """Names of every configured interface, for sampling and syncing"""
+    names = [name for (name,) in db.session.query(Interface.name).order_by(Interface.id)]
+    return names or [DEFAULT_INTERFACE]
+
+def interface_loads(include_disabled=False):
+    """Return [(interface, peer count)] for interfaces accepting new peers, or all of them"""
+    query = (
+        db.session.query(Interface, func.count(Peer.id))
+        .outerjoin(Peer, Peer.interface_id == Interface.id)
+        .group_by(Interface.id)
+        .order_by(Interface.id)
+    )
+    if not include_disabled:
+        query = query.filter(Interface.enabled.is_(True))
+    return query.all()
+
+def _least_loaded(loads, count):
+    """Spread new peers so interface peer counts even out"""
+    heap = [(load, interface.id, interface) for interface, load in loads]
+    heapq.heapify(heap)
+
+    shares = {}
+    for _ in range(count):
+        load, interface_id, interface = heapq.heappop(heap)
+        shares[interface] = shares.get(interface, 0) + 1
+        heapq.heappush(heap, (load + 1, interface_id, interface))
+    return shares
+
+def _fill_first(loads, count):
+    """Put new peers on the first interface until its pools run out"""
+    return {loads[0][0]: count}
+
+PLACEMENT_POLICIES = {
+    'least-loaded': _least_loaded,
+    'fill-first': _fill_first
+}
+
+def place_peers(count, policy='least-loaded'):
+    """Choose an interface and address for up to `count` new peers
+
+    Returns [(interface, address)], shorter than `count` when every
+    interface's pools are full. The policy picks each interface's share;
+    shares an interface can't fit spill over to the others.
+    """
+    loads = interface_loads()
+    if not loads:
+        return []
+
+    shares = PLACEMENT_POLICIES.get(policy, _least_loaded)(loads, count)
+
+    placed = []
+    full = set()
+    for interface, share in shares.items():
+        addresses = get_allocator(interface.pools).allocate(share)
+        if len(addresses) < share:
+            full.add(interface.id)
+        placed += [(interface, address) for address in addresses]
+
+    if policy != 'fill-first':
+        loads = sorted(loads, key=lambda item: item[1])
+    for interface, _ in loads:
+        if len(placed) >= count:
+            break
+        if interface.id in full:
+            # Already reseeded and still short; asking again can't find more
+            continue
+        in_flight = [address for placed_on, address in placed if placed_on.id == interface.id]
+        addresses = get_allocator(interface.pools).allocate(count - len(placed), exclude=in_flight)
+        placed += [(interface, address) for address in addresses]
+
+    return placed
+
+def _check_pools(networks, skip=None):
+    """Raise ValueError if pools overlap each other or another interface's pools"""
+    if not networks:
+        raise ValueError('At least one address pool is required')
+
+    for index, network in enumerate(networks):
+        for other in networks[index + 1:]:
+            if network.version == other.version and network.overlaps(other):
+                raise ValueError(f'{network} overlaps {other}')
+
+    for interface in Interface.query.all():
+        if interface.name == skip:
+            continue
+        for cidr in interface.pools:
+            existing = ipaddress.ip_network(cidr, strict=False)
+            for network in networks:
+                if network.version == existing.version and network.overlaps(existing):
+                    raise ValueError(f'{network} overlaps {existing} on {interface.name}')
+
+def validate_interface(name, listen_port, pools):
+    """Raise ValueError if a new interface would clash with an existing one"""
+    if not name or len(name) > 15:
+        raise ValueError('Interface names must be 1-15 characters')
+
+    networks = [ipaddress.ip_network(cidr, strict=False) for cidr in pools]
+
+    for interface in Interface.query.all():
+        if interface.name == name:
+            raise ValueError(f'Interface {name} already exists')
+        if interface.listen_port == listen_port:
+            raise ValueError(f'Port {listen_port} is already used by {interface.name}')
+    _check_pools(networks)
+
+def validate_pools(interface, pools):
+    """Raise ValueError if an interface can't switch to `pools`
+
+    The new pools must not overlap other interfaces' pools, and every peer
+    already on the interface must keep an address inside them.
+    """
+    networks = [ipaddress.ip_network(cidr, strict=False) for cidr in pools]
+    _check_pools(networks, skip=interface.name)
+
+    new_pools = [AddressPool(network) for network in networks]
+    addresses = db.session.query(Peer.name, Peer.ip_address).filter(Peer.interface_id == interface.id)
+    for name, ip_address in addresses:
+        if all(pool.offset_of(ip_address) is None for pool in new_pools):
+            raise ValueError(f'Peer {name} ({ip_address}) is outside the new pools; '
+                             f'move or delete it first')
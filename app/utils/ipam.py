@@ -0,0 +1,172 @@
+import heapq
+import ipaddress
+import threading
+from app import db
+
+# Gaps below the highest used address are only tracked up to this many
+# offsets, so a stray address deep inside an IPv6 /64 can't exhaust memory.
+MAX_TRACKED_GAPS = 1 << 20
+
+def host_cidr(ip_address):
+    """Return the single-host CIDR for an address (/32 or /128)"""
+    ip = ipaddress.ip_address(ip_address)
+    return f'{ip}/{ip.max_prefixlen}'
+
+class AddressPool:
+    """Free-list allocator for one CIDR block
+
+    Addresses are tracked as offsets from the network address. Offset 1 is the
+    server's own address, so peers start at offset 2.
+    """
+
+    FIRST_PEER_OFFSET = 2
+
+    def __init__(self, cidr):
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        self.server_address = self.network.network_address + 1
+
+        # IPv4 pools lose their broadcast address
+        self.size = self.network.num_addresses
+        if self.network.version == 4:
+            self.size -= 1
+
+        self._used = set()
+        self._free = []
+        self._cursor = self.FIRST_PEER_OFFSET
+
+    @property
+    def server_interface_address(self):
+        """Server address with the pool prefix, as used in [Interface] Address"""
+        return f'{self.server_address}/{self.network.prefixlen}'
+
+    def offset_of(self, ip_address):
+        """Return the offset of an address in this pool, or None if it is outside"""
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        if ip.version != self.network.version or ip not in self.network:
+            return None
+        offset = int(ip) - int(self.network.network_address)
+        if offset < self.FIRST_PEER_OFFSET or offset >= self.size:
+            return None
+        return offset
+
+    def seed(self, offsets):
+        """Rebuild the free-list from the offsets currently in use"""
+        self._used = set(offsets)
+        self._cursor = max(self._used, default=self.FIRST_PEER_OFFSET - 1) + 1
+
+        gap_end = min(self._cursor, self.FIRST_PEER_OFFSET + MAX_TRACKED_GAPS)
+        self._free = [
+            offset for offset in range(self.FIRST_PEER_OFFSET, gap_end)
+            if offset not in self._used
+        ]
+        heapq.heapify(self._free)
+
+    def allocate(self):
+        """Take the lowest free offset and return its address, or None when full"""
+        while self._free:
+            offset = heapq.heappop(self._free)
+            if offset not in self._used:
+                return self._take(offset)
+
+        while self._cursor < self.size:
+            offset = self._cursor
+            self._cursor += 1
+            if offset not in self._used:
+                return self._take(offset)
+
+        return None
+
+    def release(self, offset):
+        """Return an offset to the free-list"""
+        if offset in self._used:
+            self._used.discard(offset)
+            if offset < self._cursor:
+                heapq.heappush(self._free, offset)
+
+    def _take(self, offset):
+        self._used.add(offset)
+        return str(self.network.network_address + offset)
+
+class IPAllocator:
+    """Allocates peer addresses from one or more CIDR pools
+
+    The free-lists are seeded from the database once per process. Other
+    workers may allocate concurrently; the unique constraint on
+    Peer.ip_address catches that, and callers reseed and retry.
+    """
+
+    def __init__(self, cidrs):
+        self.pools = [AddressPool(cidr) for cidr in cidrs]
+        self._lock = threading.Lock()
+        self._seeded = False
+
+    def seed(self, exclude=()):
+        """Load the addresses in use from the database, plus `exclude`"""
+        from app.models.peer import Peer
+
+        used = [ip for (ip,) in db.session.query(Peer.ip_address)] + list(exclude)
+        with self._lock:
+            for pool in self.pools:
+                pool.seed(
+                    offset for offset in (pool.offset_of(ip) for ip in used)
+                    if offset is not None
+                )
+            self._seeded = True
+
+    def allocate(self, count=1, exclude=()):
+        """Allocate up to `count` addresses, reseeding once if the pools look full
+
+        `exclude` is addresses the caller already got from earlier calls but
+        hasn't committed yet; a reseed only sees the database, so without
+        them it would hand those addresses out again.
+        """
+        if not self._seeded:
+            self.seed(exclude)
+
+        addresses = self._allocate(count)
+        if len(addresses) < count:
+            # Addresses freed by other workers are only seen after a reseed
+            self.seed(exclude)
+            addresses = self._allocate(count)
+        return addresses
+
+    def _allocate(self, count):
+        addresses = []
+        with self._lock:
+            for pool in self.pools:
+                while len(addresses) < count:
+                    address = pool.allocate()
+                    if address is None:
+                        break
+                    addresses.append(address)
+        return addresses
+
+    def release(self, ip_address):
+        """Make a deleted peer's address available again"""
+        with self._lock:
+            for pool in self.pools:
+                offset = pool.offset_of(ip_address)
+                if offset is not None:
+                    pool.release(offset)
+
+    def server_addresses(self):
+        """Server [Interface] addresses, one per pool"""
+        return [pool.server_interface_address for pool in self.pools]
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+def get_allocator(cidrs=None):
+    """Return the process-wide allocator for a set of pools (default: WG_ADDRESS_POOLS)"""
+    if cidrs is None:
+        from flask import current_app
+        cidrs = current_app.config.get('WG_ADDRESS_POOLS', ['10.0.0.0/24'])
+
+    cidrs = tuple(cidrs)
+    with _allocators_lock:
+        if cidrs not in _allocators:
+            _allocators[cidrs] = IPAllocator(cidrs)
+        return _allocators[cidrs]
@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from app import db
+from app.models.job import Job
+from app.utils.metrics import JOB_DURATION
+
+# Seconds a running job may take before another worker assumes it died
+JOB_TIMEOUT = 300
+
+# How often stuck jobs are requeued and finished jobs pruned, in seconds
+MAINTENANCE_INTERVAL = 60
+
+# Finished jobs are kept this long for the status endpoints
+JOB_RETENTION = timedelta(days=1)
+
+# Jobs claimed per pass over the queue
+CLAIM_BATCH = 10
+
+HANDLERS = {}
+
+# The job this thread is running, for report_progress
+_running = threading.local()
+
+def job_handler(kind):
+    """Register a function as the handler for a job kind
+
+    It is called with the job's payload as keyword arguments, plus
+    retry=True on attempts after the first.
+    """
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+@job_handler('apply_interface')
+def apply_interface(interface, retry=False):
+    """Write an interface's server config, sync the running interface to it, apply bandwidth limits and firewall rules"""
+    from app.utils.wireguard import WireGuardManager
+
+    wg_manager = WireGuardManager(interface)
+    if not wg_manager.save_server_config():
+        raise RuntimeError(f'Could not write {wg_manager.config_path}')
+
+    # On a retry the config may already be written but not yet applied
+    if (wg_manager.config_changed or retry) and not wg_manager.sync_wireguard():
+        raise RuntimeError(f'Could not sync {interface}')
+
+    # Limits and firewall sets aren't part of the config, so these run even when it didn't change
+    wg_manager.apply_shaping()
+    wg_manager.apply_firewall()
+
+def report_progress(progress, total=None):
+    """Record how far the running job has got; a no-op outside a job"""
+    job_id = getattr(_running, 'job_id', None)
+    if job_id is None:
+        return
+    values = {Job.progress: progress}
+    if total is not None:
+        values[Job.total] = total
+    Job.query.filter_by(id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+def job_to_dict(job):
+    """JSON representation of a job for the status endpoints"""
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'key': job.key,
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.error,
+        'progress': job.progress,
+        'total': job.total,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+class JobQueue:
+    """Runs jobs from the jobs table on a background thread in each process
+
+    Jobs live in the database, so any worker process can run a job another
+    one queued, and claiming is an atomic UPDATE so each job runs once.
+    Enqueuing wakes this process's thread at once; other processes pick the
+    job up on their next poll.
+    """
+
+    def __init__(self, coalesce_delay=0.5, poll_interval=1.0, max_attempts=3):
+        self.coalesce_delay = coalesce_delay
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._maintained_at = 0
+        self.app = None
+
+    def start(self):
+        """Start the worker thread once per process"""
+        with self._wakeup:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='job-worker', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, kind, key=None, payload=None, delay=None):
+        """Queue a job, or return the queued job of the same kind and key
+
+        Waiting `delay` seconds (coalesce_delay by default) before running
+        lets a burst of requests share one job.
+        """
+        if key is not None:
+            queued = Job.query.filter_by(kind=kind, key=key, status='queued').first()
+            if queued is not None:
+                return queued
+
+        delay = self.coalesce_delay if delay is None else delay
+        job = Job(
+            kind=kind,
+            key=key,
+            payload=json.dumps(payload or {}),
+            status='queued',
+            run_after=datetime.utcnow() + timedelta(seconds=delay)
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self._maintain()
+                    self.run_due()
+                    wait = self._next_wait()
+            except Exception as e:
+                print(f"Error running jobs: {e}")
+                wait = self.poll_interval
+
+            with self._wakeup:
+                self._wakeup.wait(wait)
+
+    def _next_wait(self):
+        """Seconds until the next queued job is due, capped at poll_interval"""
+        run_after = (
+            db.session.query(Job.run_after)
+            .filter(Job.status == 'queued')
+            .order_by(Job.run_after)
+            .limit(1)
+            .scalar()
+        )
+        db.session.close()
+        if run_after is None:
+            return self.poll_interval
+        due_in = (run_after - datetime.utcnow()).total_seconds()
+        return min(max(due_in, 0), self.poll_interval)
+
+    def run_due(self, force=False):
+        """Claim and run queued jobs that are due (all of them if force); returns how many ran"""
+        ran = 0
+        while True:
+            query = Job.query.filter(Job.status == 'queued')
+            if not force:
+                query = query.filter(Job.run_after <= datetime.utcnow())
+            job_ids = [job.id for job in query.order_by(Job.run_after, Job.id).limit(CLAIM_BATCH)]
+            if not job_ids:
+                return ran
+
+            for job_id in job_ids:
+                if self._claim(job_id):
+                    self._execute(Job.query.get(job_id))
+                    ran += 1
+
+    def _claim(self, job_id):
+        claimed = Job.query.filter_by(id=job_id, status='queued').update({
+            Job.status: 'running',
+            Job.started_at: datetime.utcnow(),
+            Job.attempts: Job.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        return claimed == 1
+
+    def _execute(self, job):
+        start = time.perf_counter()
+        try:
+            handler = HANDLERS.get(job.kind)
+            if handler is None:
+                raise RuntimeError(f'No handler for job kind {job.kind}')
+
+            payload = json.loads(job.payload or '{}')
+            if job.attempts > 1:
+                payload['retry'] = True
+            _running.job_id = job.id
+            try:
+                handler(**payload)
+            finally:
+                _running.job_id = None
+
+            job.status = 'done'
+            job.error = None
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error running job {job.id} ({job.kind}): {e}")
+            job.error = str(e)
+            if job.attempts < self.max_attempts:
+                # Back off before retrying: 2s, 4s, ...
+                job.status = 'queued'
+                job.run_after = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+            else:
+                job.status = 'failed'
+
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        JOB_DURATION.observe(time.perf_counter() - start, kind=job.kind, status=job.status)
+
+    def _maintain(self):
+        """Requeue jobs whose worker died and drop old finished jobs"""
+        now = time.time()
+        if now - self._maintained_at < MAINTENANCE_INTERVAL:
+            return
+        self._maintained_at = now
+
+        utcnow = datetime.utcnow()
+        Job.query.filter(
+            Job.status == 'running',
+            Job.started_at < utcnow - timedelta(seconds=JOB_TIMEOUT)
+        ).update({Job.status: 'queued', Job.run_after: utcnow}, synchronize_session=False)
+        Job.query.filter(
+            Job.status.in_(('done', 'failed')),
+            Job.finished_at < utcnow - JOB_RETENTION
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+job_queue = JobQueue()
+
+def get_job_queue():
+    """Return the process-wide job queue, starting its worker on first use"""
+    from flask import current_app
+
+    job_queue.app = current_app._get_current_object()
+    job_queue.coalesce_delay = current_app.config.get('JOB_COALESCE_DELAY', 0.5)
+    job_queue.poll_interval = current_app.config.get('JOB_POLL_INTERVAL', 1.0)
+    job_queue.max_attempts = current_app.config.get('JOB_MAX_ATTEMPTS', 3)
+    job_queue.start()
+    return job_queue
+
+def enqueue_apply(interface):
+    """Queue a config write and sync for an interface, coalescing with one already queued"""
+    return get_job_queue().enqueue('apply_interface', key=interface, payload={'interface': interface})
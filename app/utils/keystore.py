@@ -0,0 +1,195 @@
+"""Encryption at rest for private and preshared keys
+
+Secret columns are stored as AES-GCM envelopes: each value is encrypted
+with its own random data key, and the data key is wrapped with the master
+key. The master key comes from the VPN_MASTER_KEY environment variable or
+MASTER_KEY_FILE (created by `flask init-db`) and is never stored in the
+database. An envelope records which master key wrapped it, so a wrong key
+fails loudly instead of producing garbage.
+
+Decrypting costs two AES-GCM operations. Config rendering and exports touch
+every peer, so decrypted values are kept in a bounded LRU with a TTL, keyed
+by the stored envelope. A value changes envelope whenever it is written, so
+the cache never serves a stale value.
+"""
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy.types import TypeDecorator, String
+
+MASTER_KEY_ENV = 'VPN_MASTER_KEY'
+
+# Marks an encrypted value; anything else is a plaintext value from before
+# encryption. Base64 never contains ':'.
+PREFIX = 'enc1'
+MARKER = PREFIX + ':'
+
+NONCE_SIZE = 12
+
+_master_key = None
+_key_id = None
+
+def _aesgcm(key):
+    # cryptography is only imported once something is actually encrypted or decrypted
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+def _decode_master_key(value):
+    try:
+        key = base64.b64decode(value.strip(), validate=True)
+    except ValueError:
+        key = b''
+    if len(key) != 32:
+        raise ValueError('The master key must be 32 bytes, base64 encoded')
+    return key
+
+def key_id(key):
+    """Short fingerprint of a master key, stored with each envelope"""
+    return hashlib.sha256(key).hexdigest()[:8]
+
+def create_master_key(path):
+    """Write a new random master key to `path` (mode 600) unless one exists; returns True if created"""
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(base64.b64encode(os.urandom(32)).decode('ascii') + '\n')
+    return True
+
+def load_master_key(path=None):
+    """Read the master key from the environment or `path`; returns None if there is none"""
+    value = os.environ.get(MASTER_KEY_ENV)
+    if value:
+        return _decode_master_key(value)
+    if path:
+        try:
+            with open(path) as f:
+                return _decode_master_key(f.read())
+        except FileNotFoundError:
+            return None
+    return None
+
+def set_master_key(key):
+    global _master_key, _key_id
+    _master_key = key
+    _key_id = key_id(key) if key else None
+
+def is_encrypted(value):
+    return isinstance(value, str) and value.startswith(MARKER)
+
+def encrypt(value, context):
+    """Envelope-encrypt a string; `context` (e.g. 'peers.private_key') is bound as associated data"""
+    if _master_key is None:
+        raise RuntimeError(f'No master key: set {MASTER_KEY_ENV} or run `flask --app run init-db`')
+
+    data_key = os.urandom(32)
+    wrap_nonce = os.urandom(NONCE_SIZE)
+    wrapped = _aesgcm(_master_key).encrypt(wrap_nonce, data_key, context.encode('utf-8'))
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = _aesgcm(data_key).encrypt(nonce, value.encode('utf-8'), context.encode('utf-8'))
+
+    return ':'.join((
+        PREFIX,
+        _key_id,
+        base64.b64encode(wrap_nonce + wrapped).decode('ascii'),
+        base64.b64encode(nonce + ciphertext).decode('ascii')
+    ))
+
+def decrypt(envelope, context):
+    """Open an envelope made by encrypt()"""
+    _, envelope_key_id, wrapped, sealed = envelope.split(':')
+    if _master_key is None:
+        raise RuntimeError(f'No master key: set {MASTER_KEY_ENV} or run `flask --app run init-db`')
+    if envelope_key_id != _key_id:
+        raise RuntimeError(f'Value was encrypted with master key {envelope_key_id}, but {_key_id} is loaded')
+
+    wrapped = base64.b64decode(wrapped)
+    sealed = base64.b64decode(sealed)
+    data_key = _aesgcm(_master_key).decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], context.encode('utf-8'))
+    return _aesgcm(data_key).decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], context.encode('utf-8')).decode('utf-8')
+
+class SecretCache:
+    """Bounded LRU of decrypted values, each kept for at most `ttl` seconds
+
+    Keys are the stored envelopes, so one entry per value as written.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, envelope, context):
+        """Return the decrypted value, decrypting on a miss or once the entry expired"""
+        now = time.monotonic()
+        # Hits skip the lock: both calls are atomic, and an entry evicted in
+        # between is simply not moved
+        entry = self._entries.get(envelope)
+        if entry is not None and entry[0] > now:
+            try:
+                self._entries.move_to_end(envelope)
+            except KeyError:
+                pass
+            return entry[1]
+
+        value = decrypt(envelope, context)
+
+        with self._lock:
+            self._entries[envelope] = (now + self.ttl, value)
+            self._entries.move_to_end(envelope)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_cache = SecretCache()
+
+def get_secret_cache():
+    return _cache
+
+class EncryptedString(TypeDecorator):
+    """A string column stored encrypted; plaintext values from before encryption still read as-is"""
+    impl = String
+    cache_ok = True
+
+    def __init__(self, length=None, context=None):
+        super().__init__(length)
+        self.context = context
+
+    def process_bind_param(self, value, dialect):
+        if value is None or is_encrypted(value):
+            return value
+        return encrypt(value, self.context)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not value.startswith(MARKER):
+            return value
+        return _cache.get(value, self.context)
+
+def configure_keystore(app):
+    """Load the master key and size the decrypted value cache from the app config"""
+    _cache.max_entries = app.config.get('SECRET_CACHE_SIZE', 10000)
+    _cache.ttl = app.config.get('SECRET_CACHE_TTL', 300)
+    _cache.clear()
+
+    try:
+        set_master_key(load_master_key(app.config.get('MASTER_KEY_FILE')))
+    except ValueError as e:
+        print(f"Error loading master key: {e}")
+        set_master_key(None)
+        return
+
+    if _master_key is None:
+        print(f"No master key: set {MASTER_KEY_ENV} or run `flask --app run init-db` "
+              f"before keys can be stored")
@@ -0,0 +1,150 @@
+import base64
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import func, case, and_, or_
+from app import db
+from app.models.peer import Peer
+
+# Peers are considered online if they handshook within this window
+ONLINE_WINDOW = timedelta(seconds=180)
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value)
+
+def _format_datetime(value):
+    return value.isoformat()
+
+# sort name -> (key expression, descending, cursor decoder, cursor encoder).
+# Each key matches an index on peers so a page is an index range scan.
+SORTS = {
+    'created': (Peer.created_at, True, _parse_datetime, _format_datetime),
+    'name': (Peer.name, False, str, str),
+    'online': (Peer.last_seen, True, _parse_datetime, _format_datetime),
+    'traffic': (Peer.total_rx + Peer.total_tx, True, int, int)
+}
+
+STATUSES = ('enabled', 'disabled', 'online', 'offline')
+
+class PeerPage:
+    """One page of peers plus the cursor for the next one"""
+
+    def __init__(self, peers, next_cursor):
+        self.peers = peers
+        self.next_cursor = next_cursor
+
+def encode_cursor(sort_value, peer_id):
+    raw = json.dumps([sort_value, peer_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    """Return (sort_value, peer_id); raises ValueError on a malformed cursor"""
+    try:
+        sort_value, peer_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(peer_id)
+    except Exception as e:
+        raise ValueError(f'Invalid cursor: {e}')
+
+def _after(key, descending, sort_value, last_id):
+    """Keyset predicate for rows after (sort_value, last_id)
+
+    SQLite sorts NULLs as the smallest value: last when descending, first
+    when ascending.
+    """
+    if descending:
+        if sort_value is None:
+            return and_(key.is_(None), Peer.id < last_id)
+        return or_(
+            key < sort_value,
+            and_(key == sort_value, Peer.id < last_id),
+            key.is_(None)
+        )
+
+    if sort_value is None:
+        return or_(and_(key.is_(None), Peer.id > last_id), key.isnot(None))
+    return or_(key > sort_value, and_(key == sort_value, Peer.id > last_id))
+
+def filter_peers(query, search=None, status=None, now=None):
+    """Apply the name/IP search and status filter to a Peer query"""
+    if search:
+        # % and _ in the search are literal characters, not wildcards
+        search = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(or_(
+            Peer.name.ilike(f'%{search}%', escape='\\'),
+            Peer.ip_address.like(f'{search}%', escape='\\')
+        ))
+
+    online_since = (now or datetime.utcnow()) - ONLINE_WINDOW
+    if status == 'enabled':
+        query = query.filter(Peer.enabled.is_(True))
+    elif status == 'disabled':
+        query = query.filter(Peer.enabled.is_(False))
+    elif status == 'online':
+        query = query.filter(Peer.last_seen >= online_since)
+    elif status == 'offline':
+        query = query.filter(or_(Peer.last_seen.is_(None), Peer.last_seen < online_since))
+
+    return query
+
+def list_peers(search=None, status=None, sort='created', cursor=None, per_page=DEFAULT_PER_PAGE, session=None):
+    """Return one keyset-paginated page of peers
+
+    Rows are ordered by the sort key with the peer id as a tie-breaker, and the
+    cursor carries the last row's (key, id). A page costs one index range
+    scan no matter how deep into the listing it is.
+    """
+    key, descending, decode, encode = SORTS.get(sort, SORTS['created'])
+    per_page = max(1, min(per_page or DEFAULT_PER_PAGE, MAX_PER_PAGE))
+
+    query = filter_peers((session or db.session).query(Peer), search, status)
+
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor)
+        try:
+            sort_value = None if sort_value is None else decode(sort_value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Invalid cursor: {e}')
+        query = query.filter(_after(key, descending, sort_value, last_id))
+
+    if descending:
+        query = query.order_by(key.desc(), Peer.id.desc())
+    else:
+        query = query.order_by(key.asc(), Peer.id.asc())
+
+    rows = query.add_columns(key).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last_peer, last_key = rows[-1]
+        next_cursor = encode_cursor(None if last_key is None else encode(last_key), last_peer.id)
+
+    return PeerPage([peer for peer, _ in rows], next_cursor)
+
+def count_peers(session=None):
+    """Return total, enabled and disabled peer counts in one query"""
+    total, enabled = (session or db.session).query(
+        func.count(Peer.id),
+        func.coalesce(func.sum(case((Peer.enabled.is_(True), 1), else_=0)), 0)
+    ).one()
+    return {'total': total, 'enabled': enabled, 'disabled': total - enabled}
+
+def peer_to_dict(peer, stats=None):
+    """JSON representation of a peer for the listing API"""
+    return {
+        'id': peer.id,
+        'name': peer.name,
+        'ip_address': peer.ip_address,
+        'enabled': peer.enabled,
+        'created_at': peer.created_at.isoformat() if peer.created_at else None,
+        'last_seen': peer.last_seen.isoformat() if peer.last_seen else None,
+        'total_rx': peer.total_rx,
+        'total_tx': peer.total_tx,
+        'download_limit': peer.download_limit,
+        'upload_limit': peer.upload_limit,
+        'key_rotation_due': peer.key_rotation_due.isoformat() if peer.key_rotation_due else None,
+        'keys_rotated_at': peer.keys_rotated_at.isoformat() if peer.keys_rotated_at else None,
+        'stats': stats
+    }
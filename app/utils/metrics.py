@@ -0,0 +1,404 @@
+import bisect
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers a fast `wg set` up to a slow restart
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value):
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def sample(name, value, **labels):
+    """One line of Prometheus text format"""
+    return f'{name}{_format_labels(labels.items())} {_format_value(value)}'
+
+class Metric:
+    """A named metric with a fixed set of label names, safe to update from any thread"""
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _labels(self, key):
+        return list(zip(self.label_names, key))
+
+    def values(self):
+        """{label values: value}, copied so it can be used outside the lock"""
+        with self._lock:
+            return {key: self.load(value) for key, value in self._values.items()}
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted((self.values() if values is None else values).items()):
+            lines += self._samples(key, value)
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def load(self, value):
+        return value
+
+    def combine(self, value, other):
+        return value + other
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}']
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def load(self, value):
+        counts, total, count = value
+        return list(counts), total, count
+
+    def combine(self, value, other):
+        if len(value[0]) != len(other[0]):
+            # Buckets changed between releases; keep the newer process's
+            return other
+        return [a + b for a, b in zip(value[0], other[0])], value[1] + other[1], value[2] + other[2]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        labels = self._labels(key)
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", _format_value(bound))])} {cumulative}')
+        lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", "+Inf")])} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+class Registry:
+    """Metrics of this process, plus collectors that produce samples at scrape time
+
+    With share(directory), every process (e.g. each gunicorn worker) dumps
+    its metrics to a file there and render() sums all of them, so counters
+    don't jump between scrapes answered by different workers.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self.shared_dir = None
+        self._shared_file = None
+        self._sharer_pid = None
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Register a function returning extra exposition lines for each scrape"""
+        self._collectors.append(func)
+        return func
+
+    def share(self, directory):
+        """Sum metrics over every process dumping to `directory`; None for this process only"""
+        self.shared_dir = directory
+
+    def _shared_path(self):
+        # The pid alone could be reused later and overwrite a dead worker's totals
+        pid = os.getpid()
+        if self._shared_file is None or self._shared_file[0] != pid:
+            self._shared_file = (pid, os.path.join(self.shared_dir, f'{pid}-{time.time_ns()}.json'))
+        return self._shared_file[1]
+
+    def dump(self):
+        """Write this process's metrics to the shared directory"""
+        path = self._shared_path()
+        data = {metric.name: [[list(key), value] for key, value in metric.values().items()]
+                for metric in self._metrics}
+        os.makedirs(self.shared_dir, exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(f'{path}.tmp', path)
+
+    def start_sharing(self, interval):
+        """Dump this process's metrics every `interval` seconds from a background thread"""
+        with self._lock:
+            if self._sharer_pid == os.getpid():
+                return
+            self._sharer_pid = os.getpid()
+            threading.Thread(target=self._share, args=(interval,), name='metrics-share', daemon=True).start()
+
+    def _share(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump()
+            except OSError as e:
+                print(f"Error sharing metrics: {e}")
+
+    def _shared_values(self):
+        """{metric name: values} summed over every process's dump, this one's refreshed first"""
+        self.dump()
+        metrics = {metric.name: metric for metric in self._metrics}
+        totals = {name: {} for name in metrics}
+        for file_name in os.listdir(self.shared_dir):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, file_name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, items in data.items():
+                if name not in metrics:
+                    continue
+                values = totals[name]
+                for key, value in items:
+                    key, value = tuple(key), metrics[name].load(value)
+                    values[key] = metrics[name].combine(values[key], value) if key in values else value
+        return totals
+
+    def render(self):
+        shared = None
+        if self.shared_dir:
+            try:
+                shared = self._shared_values()
+            except OSError as e:
+                print(f"Error reading shared metrics, serving this worker's only: {e}")
+
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render(shared[metric.name] if shared is not None else None)
+        for collect in self._collectors:
+            try:
+                lines += collect()
+            except Exception as e:
+                print(f"Error collecting metrics from {collect.__name__}: {e}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+REQUEST_DURATION = registry.histogram(
+    'vpn_http_request_duration_seconds', 'Time to build a response, by route.',
+    ('method', 'route', 'status'))
+REQUEST_SQL_QUERIES = registry.histogram(
+    'vpn_http_request_sql_queries', 'SQL statements executed per request, by route.',
+    ('route',), buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500, 1000))
+SQL_QUERIES = registry.counter(
+    'vpn_sql_queries_total', 'SQL statements executed, including background threads.')
+COMMAND_DURATION = registry.histogram(
+    'vpn_command_duration_seconds', 'Time spent in wg, wg-quick, systemctl and netlink calls.',
+    ('command',))
+COMMAND_FAILURES = registry.counter(
+    'vpn_command_failures_total', 'wg, wg-quick, systemctl and netlink calls that failed.',
+    ('command',))
+CONFIG_RENDER_DURATION = registry.histogram(
+    'vpn_config_render_seconds', 'Time to render a server config.', ('interface',))
+STATS_SAMPLE_DURATION = registry.histogram(
+    'vpn_stats_sample_seconds', 'Time to sample peer stats from every interface.')
+JOB_DURATION = registry.histogram(
+    'vpn_job_duration_seconds', 'Background job run time, by kind and outcome.',
+    ('kind', 'status'))
+RECONCILE_DRIFT = registry.counter(
+    'vpn_reconcile_drift_total', 'Peers repaired by reconcile passes, by where they drifted and how.',
+    ('interface', 'source', 'kind'))
+
+# Commands whose first argument is a subcommand worth telling apart
+SUBCOMMAND_PROGRAMS = ('wg', 'wg-quick', 'systemctl')
+
+def command_name(command):
+    """Low-cardinality label for a command line, e.g. 'wg set' for sudo wg set wg0 ..."""
+    args = [os.path.basename(arg) for arg in command]
+    if args and args[0] == 'sudo':
+        args = args[1:]
+    if not args:
+        return 'unknown'
+    if args[0] in SUBCOMMAND_PROGRAMS and len(args) > 1:
+        return f'{args[0]} {args[1]}'
+    return args[0]
+
+@contextmanager
+def timed_command(name):
+    """Record the duration of a call to the system, and count it if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        COMMAND_FAILURES.inc(command=name)
+        raise
+    finally:
+        COMMAND_DURATION.observe(time.perf_counter() - start, command=name)
+
+def run_command(command, **kwargs):
+    """subprocess.run() with its duration and failures recorded
+
+    A non-zero exit counts as a failure even when the caller checks the
+    return code itself rather than passing check=True.
+    """
+    name = command_name(command)
+    with timed_command(name):
+        result = subprocess.run(command, **kwargs)
+    if result.returncode != 0:
+        COMMAND_FAILURES.inc(command=name)
+    return result
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    from flask import g, has_request_context
+
+    SQL_QUERIES.inc()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+
+def init_metrics(app):
+    """Time every request and count the SQL statements it runs, and share metrics between workers"""
+    from flask import g, request
+    from sqlalchemy import event
+    from app import db
+
+    share_interval = app.config.get('METRICS_SHARE_INTERVAL')
+    registry.share(os.path.join(app.instance_path, 'metrics') if share_interval else None)
+
+    @app.before_request
+    def start_request_timer():
+        if share_interval:
+            registry.start_sharing(share_interval)
+        g.metrics_started = time.perf_counter()
+        g.sql_queries = 0
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_DURATION.observe(time.perf_counter() - started, method=request.method,
+                                     route=route, status=response.status_code)
+            REQUEST_SQL_QUERIES.observe(g.get('sql_queries', 0), route=route)
+        return response
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _count_query)
+
+@registry.collector
+def peer_metrics():
+    """Per-peer traffic and handshake from the latest stats snapshot"""
+    from sqlalchemy import func
+    from app.models.interface import Interface
+    from app.models.job import Job
+    from app.models.peer import Peer
+    from app.utils.database import read_session
+    from app.utils.stats import get_stats_collector
+
+    stats, stats_age = get_stats_collector().snapshot()
+    peers = (
+        read_session().query(Peer.id, Peer.name, Peer.public_key, Peer.enabled, Interface.name.label('interface'))
+        .outerjoin(Interface, Peer.interface_id == Interface.id)
+        .order_by(Peer.id)
+        .all()
+    )
+
+    lines = [
+        '# HELP vpn_stats_age_seconds Age of the peer stats snapshot.',
+        '# TYPE vpn_stats_age_seconds gauge',
+        sample('vpn_stats_age_seconds', round(stats_age, 3)),
+        '# HELP vpn_peers Configured peers by state.',
+        '# TYPE vpn_peers gauge',
+        sample('vpn_peers', sum(1 for peer in peers if peer.enabled), state='enabled'),
+        sample('vpn_peers', sum(1 for peer in peers if not peer.enabled), state='disabled'),
+        sample('vpn_peers', sum(1 for peer_stats in stats.values() if peer_stats['online']), state='online')
+    ]
+
+    queued = read_session().query(Job.kind, func.count(Job.id)).filter(Job.status == 'queued').group_by(Job.kind)
+    lines += ['# HELP vpn_jobs_queued Background jobs waiting to run.', '# TYPE vpn_jobs_queued gauge']
+    lines += [sample('vpn_jobs_queued', count, kind=kind) for kind, count in queued]
+
+    families = {
+        'vpn_peer_receive_bytes_total': ('counter', 'Bytes received from the peer since the interface came up.', 'rx_bytes'),
+        'vpn_peer_transmit_bytes_total': ('counter', 'Bytes sent to the peer since the interface came up.', 'tx_bytes'),
+        'vpn_peer_latest_handshake_seconds': ('gauge', 'Unix time of the latest handshake, 0 if none.', 'latest_handshake'),
+        'vpn_peer_online': ('gauge', 'Whether the peer handshook within the last 3 minutes.', 'online')
+    }
+    for name, (kind, help, field) in families.items():
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        for peer in peers:
+            peer_stats = stats.get(peer.public_key)
+            if peer_stats is not None:
+                lines.append(sample(name, int(peer_stats[field]), peer_id=peer.id,
+                                    peer=peer.name, interface=peer.interface or ''))
+
+    return lines
+
+@registry.collector
+def firewall_metrics():
+    """Per-peer forwarded bytes from the nftables counters; nothing with iptables"""
+    from app.models.peer import Peer
+    from app.utils.database import read_session
+    from app.utils.firewall import get_firewall
+
+    counters = get_firewall().peer_counters()
+    if not counters:
+        return []
+
+    names = dict(read_session().query(Peer.id, Peer.name).filter(Peer.id.in_(list(counters))))
+    lines = [
+        '# HELP vpn_peer_forwarded_bytes_total Bytes forwarded to and from the peer, counted by nftables.',
+        '# TYPE vpn_peer_forwarded_bytes_total counter'
+    ]
+    for peer_id, peer_counters in sorted(counters.items()):
+        for direction, field in (('rx', 'rx_bytes'), ('tx', 'tx_bytes')):
+            lines.append(sample('vpn_peer_forwarded_bytes_total', peer_counters[field], peer_id=peer_id,
+                                peer=names.get(peer_id, ''), direction=direction))
+    return lines
+
+def render_metrics():
+    return registry.render()
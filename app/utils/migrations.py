@@ -0,0 +1,218 @@
+"""Versioned schema migrations
+
+The schema version is SQLite's user_version. `flask init-db` applies every
+migration newer than it, each in its own transaction, so the app itself
+never runs DDL on start. Migrations also adopt databases that were created
+by db.create_all() before versioning existed, so each step checks what is
+already there.
+"""
+from app import db
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register a function(conn) as the migration to schema `version`"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+def _columns(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table})')}
+
+def _add_column(conn, table, name, definition):
+    if name not in _columns(conn, table):
+        conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+@migration(1, 'users and peers')
+def create_users_and_peers(conn):
+    conn.exec_driver_sql('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER NOT NULL,
+            username VARCHAR(80) NOT NULL,
+            email VARCHAR(120) NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            is_admin BOOLEAN,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (username),
+            UNIQUE (email)
+        )''')
+    conn.exec_driver_sql('''
+        CREATE TABLE IF NOT EXISTS peers (
+            id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            ip_address VARCHAR(50) NOT NULL,
+            public_key VARCHAR(200) NOT NULL,
+            private_key VARCHAR(200) NOT NULL,
+            preshared_key VARCHAR(200),
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (ip_address),
+            UNIQUE (public_key)
+        )''')
+
+@migration(2, 'peer enabled flag, last handshake and traffic totals')
+def add_peer_state(conn):
+    _add_column(conn, 'peers', 'enabled', 'BOOLEAN NOT NULL DEFAULT 1')
+    _add_column(conn, 'peers', 'last_seen', 'DATETIME')
+    _add_column(conn, 'peers', 'total_rx', 'BIGINT DEFAULT 0')
+    _add_column(conn, 'peers', 'total_tx', 'BIGINT DEFAULT 0')
+
+@migration(3, 'peer traffic rollups')
+def create_peer_traffic(conn):
+    conn.exec_driver_sql('''
+        CREATE TABLE IF NOT EXISTS peer_traffic (
+            peer_id INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            rx_bytes BIGINT NOT NULL,
+            tx_bytes BIGINT NOT NULL,
+            PRIMARY KEY (peer_id, resolution, bucket),
+            FOREIGN KEY(peer_id) REFERENCES peers (id) ON DELETE CASCADE
+        )''')
+
+@migration(4, 'peer listing indexes')
+def create_peer_indexes(conn):
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_name ON peers (name)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_created_at ON peers (created_at)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_enabled ON peers (enabled)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_last_seen ON peers (last_seen)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_total_bytes ON peers (total_rx + total_tx)')
+
+@migration(5, 'interfaces')
+def create_interfaces(conn):
+    from flask import current_app
+    from app.utils.interfaces import DEFAULT_INTERFACE, DEFAULT_LISTEN_PORT
+
+    conn.exec_driver_sql('''
+        CREATE TABLE IF NOT EXISTS interfaces (
+            id INTEGER NOT NULL,
+            name VARCHAR(15) NOT NULL,
+            listen_port INTEGER NOT NULL,
+            address_pools VARCHAR(500) NOT NULL,
+            private_key VARCHAR(200),
+            endpoint VARCHAR(255),
+            enabled BOOLEAN NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (name),
+            UNIQUE (listen_port)
+        )''')
+    _add_column(conn, 'peers', 'interface_id', 'INTEGER REFERENCES interfaces (id)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_interface_id ON peers (interface_id)')
+
+    # Existing single-interface installs become interface wg0
+    interface_id = conn.exec_driver_sql('SELECT id FROM interfaces ORDER BY id LIMIT 1').scalar()
+    if interface_id is None:
+        pools = ','.join(current_app.config.get('WG_ADDRESS_POOLS', ['10.0.0.0/24']))
+        interface_id = conn.exec_driver_sql(
+            "INSERT INTO interfaces (name, listen_port, address_pools, enabled, created_at) "
+            "VALUES (?, ?, ?, 1, datetime('now'))",
+            (DEFAULT_INTERFACE, DEFAULT_LISTEN_PORT, pools)
+        ).lastrowid
+    conn.exec_driver_sql('UPDATE peers SET interface_id = ? WHERE interface_id IS NULL', (interface_id,))
+
+@migration(6, 'background jobs')
+def create_jobs(conn):
+    conn.exec_driver_sql('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER NOT NULL,
+            kind VARCHAR(50) NOT NULL,
+            "key" VARCHAR(100),
+            payload TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            run_after DATETIME NOT NULL,
+            created_at DATETIME,
+            started_at DATETIME,
+            finished_at DATETIME,
+            PRIMARY KEY (id)
+        )''')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs (status, run_after)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_jobs_kind_key_status ON jobs (kind, "key", status)')
+
+@migration(7, 'peer bandwidth limits')
+def add_peer_limits(conn):
+    _add_column(conn, 'peers', 'download_limit', 'INTEGER')
+    _add_column(conn, 'peers', 'upload_limit', 'INTEGER')
+
+@migration(8, 'key rotation and job progress')
+def add_key_rotation(conn):
+    _add_column(conn, 'peers', 'pending_private_key', 'VARCHAR(200)')
+    _add_column(conn, 'peers', 'pending_public_key', 'VARCHAR(200)')
+    _add_column(conn, 'peers', 'pending_preshared_key', 'VARCHAR(200)')
+    _add_column(conn, 'peers', 'key_rotation_due', 'DATETIME')
+    _add_column(conn, 'peers', 'keys_rotated_at', 'DATETIME')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_peers_key_rotation_due ON peers (key_rotation_due)')
+    _add_column(conn, 'jobs', 'progress', 'INTEGER')
+    _add_column(conn, 'jobs', 'total', 'INTEGER')
+
+# Key columns encrypted by migration 9: table -> columns
+ENCRYPTED_COLUMNS = {
+    'peers': ('private_key', 'preshared_key', 'pending_private_key', 'pending_preshared_key'),
+    'interfaces': ('private_key',)
+}
+
+@migration(9, 'encrypt private and preshared keys')
+def encrypt_keys(conn):
+    from app.utils.keystore import MARKER, encrypt
+
+    for table, columns in ENCRYPTED_COLUMNS.items():
+        for column in columns:
+            rows = conn.exec_driver_sql(
+                f"SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL AND {column} NOT LIKE '{MARKER}%'"
+            ).fetchall()
+            for row_id, value in rows:
+                conn.exec_driver_sql(
+                    f'UPDATE {table} SET {column} = ? WHERE id = ?',
+                    (encrypt(value, f'{table}.{column}'), row_id)
+                )
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+def schema_version(conn=None):
+    """The database's current schema version, 0 if it was never migrated"""
+    if conn is None:
+        with db.engine.connect() as conn:
+            return conn.exec_driver_sql('PRAGMA user_version').scalar()
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+def migrate():
+    """Apply pending migrations; returns [(version, description)] of those applied
+
+    Each migration and its version bump commit together. BEGIN IMMEDIATE
+    takes the write lock before the version is read, so two processes
+    migrating at once apply each step only once.
+    """
+    applied = []
+    # Autocommit at the driver level so the transactions below are exactly ours
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for version, description, func in MIGRATIONS:
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                if schema_version(conn) < version:
+                    func(conn)
+                    conn.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+                    applied.append((version, description))
+                conn.exec_driver_sql('COMMIT')
+            except Exception:
+                conn.exec_driver_sql('ROLLBACK')
+                raise
+    return applied
+
+def check_schema(app):
+    """Warn at startup when the database needs `flask init-db`"""
+    with app.app_context():
+        try:
+            version = schema_version()
+        except Exception as e:
+            print(f"Error reading schema version: {e}")
+            return
+
+    if version < latest_version():
+        print(f"Database schema is at version {version}, expected {latest_version()}: "
+              f"run `flask --app run init-db`")
@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models.peer import Peer
+from app.utils.ipam import get_allocator
+from app.utils.interfaces import place_peers
+from app.utils.jobs import enqueue_apply
+from app.utils.wireguard import WireGuardManager
+
+class AddressPoolExhausted(Exception):
+    """Raised when the configured address pools have no free addresses"""
+
+def commit_new_peers(peers, attempts=3):
+    """Place new peers on interfaces, assign addresses and commit them
+
+    Interfaces are chosen by WG_PLACEMENT_POLICY. Returns the peers that were
+    committed. When the pools run out, the remaining peers are left out; if
+    none fit, AddressPoolExhausted is raised.
+
+    Another worker may hand out the same address between our allocation and
+    the commit. The unique constraint on ip_address rejects that; the
+    allocator is then reseeded from the database and the batch retried.
+    """
+    from flask import current_app
+
+    policy = current_app.config.get('WG_PLACEMENT_POLICY', 'least-loaded')
+
+    for attempt in range(attempts):
+        placed = place_peers(len(peers), policy)
+        if not placed:
+            raise AddressPoolExhausted('No available IP addresses')
+
+        pools = {tuple(interface.pools) for interface, address in placed}
+        committed = peers[:len(placed)]
+        for peer, (interface, address) in zip(committed, placed):
+            peer.interface = interface
+            peer.ip_address = address
+        db.session.add_all(committed)
+
+        try:
+            db.session.commit()
+            return committed
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            for cidrs in pools:
+                get_allocator(cidrs).seed()
+
+def parse_peer_names(content, fmt):
+    """Parse peer names from a CSV or JSON document"""
+    if fmt == 'json':
+        data = json.loads(content)
+        if isinstance(data, dict):
+            data = data.get('names') or data.get('peers') or []
+        names = []
+        for item in data:
+            names.append(item.get('name', '') if isinstance(item, dict) else str(item))
+        return names
+
+    names = []
+    for row in csv.reader(io.StringIO(content)):
+        if not row:
+            continue
+        # Skip an optional header row
+        if not names and row[0].strip().lower() == 'name':
+            continue
+        names.append(row[0])
+    return names
+
+def create_peers(names):
+    """Create many peers in one transaction with one config write and apply per interface
+
+    The apply runs as a background job. Returns one result dict per
+    requested name, in order; created peers carry the id of that job.
+    """
+    wg_manager = WireGuardManager()
+
+    names = [name.strip() for name in names]
+
+    results = []
+    created = []
+    for name in names:
+        result = {'name': name, 'status': 'error'}
+        results.append(result)
+
+        if not name:
+            result['error'] = 'Peer name is required'
+            continue
+
+        keys = wg_manager.generate_keys()
+        if not keys:
+            result['error'] = 'Failed to generate keys'
+            continue
+
+        peer = Peer(
+            name=name,
+            public_key=keys['public_key'],
+            private_key=keys['private_key'],
+            preshared_key=keys['preshared_key'],
+            enabled=True
+        )
+        created.append((result, peer))
+
+    if not created:
+        return results
+
+    try:
+        committed = commit_new_peers([peer for result, peer in created])
+    except AddressPoolExhausted:
+        committed = []
+    except Exception as e:
+        db.session.rollback()
+        for result, peer in created:
+            result['error'] = f'Error creating peer: {e}'
+        return results
+
+    for result, peer in created[len(committed):]:
+        result['error'] = 'No available IP addresses'
+    created = created[:len(committed)]
+    if not created:
+        return results
+
+    by_interface = {}
+    for result, peer in created:
+        by_interface.setdefault(peer.interface.name, []).append((result, peer))
+
+    for interface, group in by_interface.items():
+        job = enqueue_apply(interface)
+
+        # Configs are rendered on download; keys are only stored, encrypted, in the database
+        for result, peer in group:
+            result.update({
+                'status': 'created',
+                'id': peer.id,
+                'ip_address': peer.ip_address,
+                'interface': interface,
+                'job': job.id
+            })
+
+    return results
@@ -0,0 +1,106 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml'
+}
+
+def qrcode_key(content, fmt):
+    """Content address of a rendered QR code"""
+    return hashlib.sha256(f'{fmt}\0{content}'.encode('utf-8')).hexdigest()
+
+def _make_qrcode(content):
+    # qrcode/PIL are only needed once a QR code is actually requested
+    import qrcode
+
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(content)
+    qr.make(fit=True)
+    return qr
+
+def _render_svg(qr):
+    """Draw the module matrix as one path of horizontal runs"""
+    matrix = qr.get_matrix()
+    size = len(matrix)
+
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < size and row[x]:
+                x += 1
+            runs.append(f'M{start} {y}h{x - start}v1h-{x - start}z')
+
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+        f'shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/>'
+        f'<path d="{"".join(runs)}" fill="#000"/></svg>'
+    )
+    return svg.encode('utf-8')
+
+def _render_png(qr):
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer)
+    return buffer.getvalue()
+
+def render_qrcode(content, fmt='svg'):
+    """Render a QR code for `content` as PNG or SVG bytes"""
+    qr = _make_qrcode(content)
+    if fmt == 'png':
+        return _render_png(qr)
+    return _render_svg(qr)
+
+class QRCodeCache:
+    """Bounded LRU of rendered QR codes keyed by a hash of the peer config
+
+    A changed config (new keys, endpoint) hashes to a new key, so stale images
+    are never served and simply age out.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, content, fmt='svg'):
+        """Return (key, image bytes), rendering on a cache miss"""
+        key = qrcode_key(content, fmt)
+
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                return key, image
+
+        image = render_qrcode(content, fmt)
+
+        with self._lock:
+            self._entries[key] = image
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return key, image
+
+qrcode_cache = QRCodeCache()
+
+def get_qrcode_cache():
+    """Return the process-wide QR code cache"""
+    from flask import current_app
+
+    qrcode_cache.max_entries = current_app.config.get('QRCODE_CACHE_SIZE', 256)
+    return qrcode_cache
@@ -0,0 +1,242 @@
+"""Finding and repairing drift between the database, server configs and the running interfaces
+
+The database is the source of truth: an interface should run exactly its
+enabled peers, with each peer's address as its only allowed IP and its
+preshared key. Each pass compares, by public key, what the database wants
+with both the config file and `wg show dump`:
+
+- missing: an enabled peer that isn't there
+- extra: a peer that is there but isn't enabled in the database
+- mismatched: a peer whose allowed IPs or preshared key differ
+
+A repair touches only the drifted peers on the running interface, and
+rewrites the config file only when it drifted. Nothing is restarted.
+"""
+import fcntl
+import ipaddress
+import os
+import threading
+import time
+from app import db
+from app.models.job import Job
+from app.utils.backends import NO_PRESHARED_KEY, parse_config_peers
+from app.utils.interfaces import interface_names
+from app.utils.ipam import host_cidr
+from app.utils.jobs import enqueue_apply
+from app.utils.metrics import RECONCILE_DRIFT
+
+def _same_allowed_ips(desired, actual):
+    # Parsing every peer's addresses would dominate a pass; only differing strings are parsed
+    if sorted(desired) == sorted(actual):
+        return True
+    try:
+        return (sorted(ipaddress.ip_network(ip, strict=False) for ip in desired)
+                == sorted(ipaddress.ip_network(ip, strict=False) for ip in actual))
+    except (TypeError, ValueError):
+        return False
+
+def _database_peers(wg_manager):
+    """({public_key: peer} the interface should run, {public_key: (id, name)} of every peer on it)"""
+    from app.models.peer import Peer
+
+    query = db.session.query(Peer.id, Peer.name, Peer.public_key, Peer.ip_address, Peer.enabled)
+    row = wg_manager.interface_row()
+    if row is not None:
+        query = query.filter(Peer.interface_id == row.id)
+
+    known = {}
+    enabled_ids = []
+    for peer_id, name, public_key, ip_address, enabled in query:
+        known[public_key] = (peer_id, name, ip_address)
+        if enabled:
+            enabled_ids.append(peer_id)
+
+    # Only enabled peers' preshared keys are needed, and each one is a decrypt
+    preshared_keys = dict(
+        db.session.query(Peer.id, Peer.preshared_key).filter(Peer.id.in_(enabled_ids))
+    ) if enabled_ids else {}
+
+    desired = {}
+    for public_key, (peer_id, name, ip_address) in known.items():
+        if peer_id in preshared_keys:
+            desired[public_key] = {
+                'allowed_ips': [host_cidr(ip_address)],
+                'preshared_key': preshared_keys[peer_id]
+            }
+    return desired, {public_key: (peer_id, name) for public_key, (peer_id, name, _) in known.items()}
+
+def diff_peers(desired, actual, known):
+    """{'missing': [...], 'extra': [...], 'mismatched': [...]} taking `actual` to `desired`"""
+    def entry(public_key, **extra):
+        peer_id, name = known.get(public_key, (None, None))
+        return {'public_key': public_key, 'peer_id': peer_id, 'name': name, **extra}
+
+    drift = {'missing': [], 'extra': [], 'mismatched': []}
+    for public_key in sorted(desired.keys() - actual.keys()):
+        drift['missing'].append(entry(public_key))
+    for public_key in sorted(actual.keys() - desired.keys()):
+        drift['extra'].append(entry(public_key))
+    for public_key in sorted(desired.keys() & actual.keys()):
+        fields = []
+        if not _same_allowed_ips(desired[public_key]['allowed_ips'], actual[public_key]['allowed_ips']):
+            fields.append('allowed_ips')
+        if desired[public_key]['preshared_key'] != actual[public_key]['preshared_key']:
+            fields.append('preshared_key')
+        if fields:
+            drift['mismatched'].append(entry(public_key, fields=fields))
+    return drift
+
+def _drift_count(drift):
+    return sum(len(entries) for entries in drift.values()) if drift else 0
+
+def _apply_pending(interface):
+    """Whether an apply for the interface is queued or running; it syncs everything anyway"""
+    return db.session.query(Job.id).filter(
+        Job.kind == 'apply_interface',
+        Job.key == interface,
+        Job.status.in_(('queued', 'running'))
+    ).first() is not None
+
+def _repair_kernel(wg_manager, desired, drift):
+    """Add, fix or remove only the drifted peers on the running interface"""
+    backend = wg_manager.backend
+    for entry in drift['extra']:
+        backend.remove_peer(wg_manager.interface, entry['public_key'])
+    for entry in drift['missing'] + drift['mismatched']:
+        peer = desired[entry['public_key']]
+        backend.set_peer(
+            wg_manager.interface, entry['public_key'], peer['allowed_ips'], peer['preshared_key'] or NO_PRESHARED_KEY
+        )
+
+def reconcile_interface(interface, dry_run=True):
+    """Compare an interface's database peers with its config and running state, and repair unless dry_run
+
+    Returns a report: the drift found in 'config' and 'kernel' (None where
+    that side couldn't be read), 'errors', and whether repairs were made.
+    """
+    from app.utils.wireguard import WireGuardManager
+
+    wg_manager = WireGuardManager(interface)
+    report = {'interface': interface, 'config': None, 'kernel': None, 'errors': [], 'repaired': False, 'skipped': None}
+    desired, known = _database_peers(wg_manager)
+
+    try:
+        with open(wg_manager.config_path) as f:
+            report['config'] = diff_peers(desired, parse_config_peers(f.read()), known)
+    except OSError as e:
+        report['errors'].append(f'Could not read {wg_manager.config_path}: {e}')
+
+    try:
+        report['kernel'] = diff_peers(desired, wg_manager.backend.dump(interface), known)
+    except Exception as e:
+        # Bringing a down interface up is wg-quick's job, not ours
+        report['errors'].append(f'Could not read {interface}: {e}')
+
+    if dry_run or not (_drift_count(report['config']) or _drift_count(report['kernel'])):
+        return report
+    if _apply_pending(interface):
+        report['skipped'] = 'an apply is pending for this interface'
+        return report
+
+    for source in ('config', 'kernel'):
+        for kind, entries in (report[source] or {}).items():
+            if entries:
+                RECONCILE_DRIFT.inc(len(entries), interface=interface, source=source, kind=kind)
+
+    if _drift_count(report['kernel']):
+        try:
+            _repair_kernel(wg_manager, desired, report['kernel'])
+        except Exception as e:
+            report['errors'].append(f'Could not repair {interface}: {e}')
+            # Let the regular apply, with its retries, bring the interface in line
+            enqueue_apply(interface)
+            return report
+
+    # An unreadable config was only reported above; its drift is None
+    if _drift_count(report['config']) and not wg_manager.save_server_config(force=True):
+        report['errors'].append(f'Could not write {wg_manager.config_path}')
+        enqueue_apply(interface)
+        return report
+
+    report['repaired'] = True
+    return report
+
+def reconcile(interface=None, dry_run=True):
+    """reconcile_interface() for one interface, or every configured one"""
+    if interface is not None and interface not in interface_names():
+        raise ValueError(f'No interface named {interface}')
+    return [reconcile_interface(name, dry_run) for name in ([interface] if interface else interface_names())]
+
+class Reconciler:
+    """Repairs drift on every interface every `interval` seconds, from one process per host"""
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._host_lock = None
+        self.app = None
+
+    def start(self):
+        """Start the reconcile thread once per process"""
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._host_lock = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='wg-reconciler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._is_reconciler():
+                continue
+            try:
+                with self.app.app_context():
+                    for report in reconcile(dry_run=False):
+                        self._log(report)
+            except Exception as e:
+                print(f"Error reconciling interfaces: {e}")
+
+    def _is_reconciler(self):
+        """Only one process per host reconciles; the first to lock the file wins"""
+        if self._host_lock is not None:
+            return True
+
+        lock_path = os.path.join(self.app.instance_path, 'reconcile.lock')
+        lock_file = None
+        try:
+            os.makedirs(self.app.instance_path, exist_ok=True)
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if lock_file:
+                lock_file.close()
+            return False
+
+        self._host_lock = lock_file
+        return True
+
+    def _log(self, report):
+        for error in report['errors']:
+            print(f"Error reconciling {report['interface']}: {error}")
+        if report['repaired']:
+            print(f"Reconciled {report['interface']}: repaired {_drift_count(report['kernel'])} peers "
+                  f"on the interface and {_drift_count(report['config'])} in its config")
+
+reconciler = Reconciler()
+
+def init_reconciler(app):
+    """Start reconciling in the background on each worker's first request, if RECONCILE_INTERVAL is set"""
+    interval = app.config.get('RECONCILE_INTERVAL')
+    if not interval:
+        return
+
+    @app.before_request
+    def start_reconciler():
+        reconciler.app = app
+        reconciler.interval = interval
+        reconciler.start()
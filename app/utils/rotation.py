@@ -0,0 +1,195 @@
+"""Staged rotation of peers' preshared keys and, optionally, keypairs
+
+A rotation runs in two background jobs:
+
+1. stage_key_rotation generates new keys for the selected peers and stores
+   them as pending, due at the end of the window. The server keeps using the
+   current keys until then, and so do downloaded configs, QR codes and
+   exports unless they ask for the pending ones (?pending=1).
+2. promote_keys runs when peers fall due. It makes their pending keys
+   current and updates only those peers on the running interface.
+
+This is a scheduled cut-over, not an overlap: WireGuard accepts one key per
+peer, so a client on the pending keys only connects after step 2, and one
+still on the old keys stops connecting then.
+
+Both jobs work in batches and report progress, so rotating thousands of
+peers doesn't block requests or hold long write transactions.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy.orm import undefer_group
+from app import db
+from app.models.interface import Interface
+from app.models.job import Job
+from app.models.peer import Peer
+from app.utils.ipam import host_cidr
+from app.utils.jobs import job_handler, get_job_queue, enqueue_apply, report_progress
+
+# Peers given new keys, or switched over, per transaction
+ROTATION_BATCH = 200
+
+# Above this many enabled peers per batch, one sync of the interface beats a
+# `wg set` per peer; the sync still only touches peers whose keys changed
+PER_PEER_APPLY_MAX = 50
+
+PromotedPeer = namedtuple('PromotedPeer', 'peer_id enabled ip_address old_public_key public_key preshared_key')
+
+def _select_peers(interface=None, peer_ids=None):
+    query = Peer.query
+    if interface:
+        query = query.join(Interface, Peer.interface_id == Interface.id).filter(Interface.name == interface)
+    if peer_ids is not None:
+        query = query.filter(Peer.id.in_(peer_ids))
+    return query
+
+def enqueue_rotation(interface=None, peer_ids=None, keypair=False, window_hours=None):
+    """Queue a rotation of the selected peers' keys (every peer by default); returns its job"""
+    from flask import current_app
+
+    if window_hours is None:
+        window_hours = current_app.config.get('KEY_ROTATION_WINDOW_HOURS', 24)
+    if window_hours < 0:
+        raise ValueError('The rotation window cannot be negative')
+    if interface and Interface.query.filter_by(name=interface).first() is None:
+        raise ValueError(f'No interface named {interface}')
+
+    due = datetime.utcnow() + timedelta(hours=window_hours)
+    return get_job_queue().enqueue('stage_key_rotation', payload={
+        'interface': interface,
+        'peer_ids': peer_ids,
+        'keypair': bool(keypair),
+        'due': due.isoformat()
+    }, delay=0)
+
+@job_handler('stage_key_rotation')
+def stage_key_rotation(due, interface=None, peer_ids=None, keypair=False, retry=False):
+    """Give the selected peers pending keys that the server switches to at `due`"""
+    from app.utils.wireguard import WireGuardManager
+
+    wg_manager = WireGuardManager()
+    due = datetime.fromisoformat(due)
+    query = _select_peers(interface, peer_ids)
+    total = query.count()
+    report_progress(0, total)
+
+    staged = 0
+    last_id = 0
+    while True:
+        peers = query.filter(Peer.id > last_id).order_by(Peer.id).limit(ROTATION_BATCH).all()
+        if not peers:
+            break
+
+        for peer in peers:
+            if retry and peer.key_rotation_due == due:
+                # Staged by the failed attempt; clients may already have these keys
+                continue
+            keys = wg_manager.generate_keys()
+            if not keys:
+                raise RuntimeError('Failed to generate keys')
+            # Restaging replaces keys from an earlier rotation that hasn't switched over yet
+            peer.pending_preshared_key = keys['preshared_key']
+            peer.pending_private_key = keys['private_key'] if keypair else None
+            peer.pending_public_key = keys['public_key'] if keypair else None
+            peer.key_rotation_due = due
+
+        last_id = peers[-1].id
+        db.session.commit()
+        staged += len(peers)
+        report_progress(staged, total)
+
+    schedule_promotion()
+
+def schedule_promotion():
+    """Make sure a promote_keys job is queued for the earliest staged rotation"""
+    due = db.session.query(db.func.min(Peer.key_rotation_due)).scalar()
+    if due is None:
+        return None
+
+    delay = max((due - datetime.utcnow()).total_seconds(), 0)
+    job = get_job_queue().enqueue('promote_keys', key='peers', delay=delay)
+    if job.run_after > due:
+        # An already queued promotion was due later than this rotation
+        Job.query.filter_by(id=job.id, status='queued').update({Job.run_after: due}, synchronize_session=False)
+        db.session.commit()
+    return job
+
+def _promote(peer, now):
+    """Make a peer's pending keys current; returns what the interface needs to switch it over"""
+    old_public_key = peer.public_key
+    if peer.pending_public_key:
+        peer.public_key = peer.pending_public_key
+        peer.private_key = peer.pending_private_key
+    peer.preshared_key = peer.pending_preshared_key
+    peer.pending_private_key = None
+    peer.pending_public_key = None
+    peer.pending_preshared_key = None
+    peer.key_rotation_due = None
+    peer.keys_rotated_at = now
+    return PromotedPeer(peer.id, peer.enabled, peer.ip_address, old_public_key, peer.public_key, peer.preshared_key)
+
+def _apply_promoted(wg_manager, peers):
+    """Update just the promoted peers on the running interface, then write its config"""
+    # Disabled peers aren't on the interface; they get the new keys when enabled again
+    peers = [peer for peer in peers if peer.enabled]
+    if len(peers) > PER_PEER_APPLY_MAX:
+        if not (wg_manager.save_server_config() and wg_manager.sync_wireguard()):
+            enqueue_apply(wg_manager.interface)
+        return
+
+    failed = False
+    for peer in peers:
+        try:
+            if peer.old_public_key != peer.public_key:
+                wg_manager.backend.remove_peer(wg_manager.interface, peer.old_public_key)
+            wg_manager.backend.set_peer(
+                wg_manager.interface, peer.public_key, [host_cidr(peer.ip_address)], peer.preshared_key
+            )
+        except Exception as e:
+            print(f"Error applying rotated keys for peer {peer.peer_id}: {e}")
+            failed = True
+            break
+
+    if failed or not wg_manager.save_server_config():
+        # Let the regular apply, with its retries, bring the interface in line
+        enqueue_apply(wg_manager.interface)
+
+@job_handler('promote_keys')
+def promote_keys(retry=False):
+    """Switch every peer whose rotation is due over to its pending keys"""
+    from app.utils.wireguard import WireGuardManager
+
+    now = datetime.utcnow()
+    query = Peer.query.options(undefer_group('keys')).filter(Peer.key_rotation_due <= now)
+    total = query.count()
+    report_progress(0, total)
+
+    promoted = 0
+    while True:
+        peers = query.order_by(Peer.id).limit(ROTATION_BATCH).all()
+        if not peers:
+            break
+
+        by_interface = {}
+        for peer in peers:
+            wg_manager = WireGuardManager.for_peer(peer)
+            by_interface.setdefault(wg_manager.interface, (wg_manager, []))[1].append(_promote(peer, now))
+        db.session.commit()
+
+        for wg_manager, promoted_peers in by_interface.values():
+            _apply_promoted(wg_manager, promoted_peers)
+
+        promoted += len(peers)
+        report_progress(promoted, total)
+
+    # Rotations staged with a later window
+    schedule_promotion()
+
+def rotation_status(interface=None):
+    """Counts of peers with a staged rotation, and when the next one is due"""
+    query = _select_peers(interface).filter(Peer.key_rotation_due.isnot(None))
+    next_due = query.with_entities(db.func.min(Peer.key_rotation_due)).scalar()
+    return {
+        'pending': query.count(),
+        'next_due': next_due.isoformat() if next_due else None
+    }
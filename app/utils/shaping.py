@@ -0,0 +1,247 @@
+"""Per-peer bandwidth limits with tc
+
+Downloads (server to peer) are shaped by an HTB class per peer on the
+WireGuard device's egress. Uploads can't be queued on ingress, so they are
+redirected to an IFB device and shaped by the same HTB classes on its egress.
+Unclassified traffic takes HTB's direct queue and is never limited.
+
+Each peer's filter sits in a u32 hash table bucketed on the last byte of its
+address, so classifying a packet is one hash lookup rather than a walk over
+every peer's filter. A peer's class id is its database id, and its filter
+handle is derived from its address, so a single peer can be added, changed
+or removed without rebuilding the rest.
+"""
+import fcntl
+import ipaddress
+import json
+import os
+from collections import namedtuple
+from app.utils.metrics import run_command
+
+TC = ['/usr/bin/sudo', '/usr/sbin/tc']
+IP = ['/usr/bin/sudo', '/usr/bin/ip']
+
+# HTB minor ids 1..0xfffe are free for peer classes
+MAX_CLASS_ID = 0xfffe
+
+# family -> (filter prio, hash table id, tc protocol, address match, offset of
+# the destination's last 32 bits, offset of the source's last 32 bits)
+FAMILIES = {
+    4: (10, 0x2, 'ip', 'ip', 16, 12),
+    6: (20, 0x3, 'ipv6', 'ip6', 36, 20)
+}
+
+# Bumped when filter handles are computed differently, so existing rules
+# are rebuilt rather than patched under handles they don't have
+STATE_VERSION = 2
+
+PeerLimit = namedtuple('PeerLimit', 'peer_id ip_address download upload')
+
+def parse_limit(value):
+    """A bandwidth limit in kbit/s from user input; None (unlimited) for empty or 0"""
+    if value is None or value == '':
+        return None
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid bandwidth limit: {value!r}')
+    if limit < 0:
+        raise ValueError(f'Invalid bandwidth limit: {value!r}')
+    return limit or None
+
+def ifb_device(interface):
+    """The IFB device that carries an interface's uploads; names max out at 15 characters"""
+    return f'ifb-{interface}'[:15]
+
+def filter_handle(address):
+    """u32 handle of a peer's filter: (hash table, bucket, node)
+
+    The bucket is the address's last byte and the node the 11 bits above it
+    (plus one, as node 0 isn't a valid handle), which is unique for every
+    address in pools up to /13 (IPv4) or /109 (IPv6). Addresses further apart
+    can collide; sync() refuses to shape the second peer of a collision.
+    """
+    address = ipaddress.ip_address(address)
+    table = FAMILIES[address.version][1]
+    value = int(address)
+    return f'{table:x}:{value & 0xff:x}:{((value >> 8) & 0x7ff) + 1:x}'
+
+class TrafficShaper:
+    """Keeps an interface's tc classes and filters in line with its peers' limits
+
+    What was last applied is kept in a small state file next to the
+    interface's device index, so a sync only issues commands for peers whose
+    limits changed. A new device index (the interface was recreated and its
+    qdiscs went with it) or a failed apply means a full rebuild next time.
+    """
+
+    def __init__(self, interface, state_dir, tc=None, ip=None):
+        self.interface = interface
+        self.ifb = ifb_device(interface)
+        self.state_path = os.path.join(state_dir, f'shaping-{interface}.json')
+        self.tc = tc or TC
+        self.ip = ip or IP
+
+    def device_index(self):
+        """The interface's ifindex, or None if it isn't up"""
+        try:
+            with open(f'/sys/class/net/{self.interface}/ifindex') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state.get('version') != STATE_VERSION:
+                return None, {}
+            peers = {int(peer_id): PeerLimit(int(peer_id), *values) for peer_id, values in state['peers'].items()}
+            return state['ifindex'], peers
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, {}
+
+    def _save_state(self, ifindex, peers):
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': STATE_VERSION,
+                'ifindex': ifindex,
+                'peers': {str(limit.peer_id): list(limit[1:]) for limit in peers.values()}
+            }, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _clear_state(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def _tc_batch(self, commands, ignore_errors=False):
+        if not commands:
+            return
+        result = run_command(
+            [*self.tc, '-force', '-batch', '-'],
+            input='\n'.join(commands) + '\n',
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0 and not ignore_errors:
+            raise RuntimeError(f'tc failed on {self.interface}: {result.stderr.strip()}')
+
+    def _setup_commands(self):
+        """Root HTB qdiscs, the upload redirect and the per-family hash tables"""
+        commands = [
+            f'qdisc add dev {self.interface} root handle 1: htb default 0',
+            f'qdisc add dev {self.interface} handle ffff: ingress',
+            f'filter add dev {self.interface} parent ffff: protocol all prio 1 u32 '
+            f'match u32 0 0 action mirred egress redirect dev {self.ifb}',
+            f'qdisc add dev {self.ifb} root handle 1: htb default 0'
+        ]
+        for device, direction in ((self.interface, 'dst'), (self.ifb, 'src')):
+            for version, (prio, table, protocol, match, dst_offset, src_offset) in FAMILIES.items():
+                offset = dst_offset if direction == 'dst' else src_offset
+                any_address = '0.0.0.0/0' if version == 4 else '::/0'
+                commands += [
+                    f'filter add dev {device} parent 1: prio {prio} handle {table:x}: protocol {protocol} u32 divisor 256',
+                    f'filter add dev {device} parent 1: prio {prio} protocol {protocol} u32 '
+                    f'match {match} {direction} {any_address} hashkey mask 0x000000ff at {offset} link {table:x}:'
+                ]
+        return commands
+
+    def _rebuild(self):
+        """Start from empty qdiscs on the interface and a fresh IFB device"""
+        # The device may already exist and there may be nothing to delete
+        run_command([*self.ip, 'link', 'add', self.ifb, 'type', 'ifb'], capture_output=True)
+        run_command([*self.ip, 'link', 'set', self.ifb, 'up'], capture_output=True, check=True)
+        self._tc_batch([
+            f'qdisc del dev {self.interface} root',
+            f'qdisc del dev {self.interface} ingress',
+            f'qdisc del dev {self.ifb} root'
+        ], ignore_errors=True)
+        return self._setup_commands()
+
+    def _peer_commands(self, old, new):
+        """Commands taking one peer from limits `old` to `new`; either may be None"""
+        commands = []
+        for device, direction, field in ((self.interface, 'dst', 'download'), (self.ifb, 'src', 'upload')):
+            old_rate = getattr(old, field) if old else None
+            new_rate = getattr(new, field) if new else None
+            peer_id = (new or old).peer_id
+
+            if old_rate and not (new_rate and old.ip_address == new.ip_address):
+                version = ipaddress.ip_address(old.ip_address).version
+                prio, _, protocol, *_ = FAMILIES[version]
+                commands.append(f'filter del dev {device} parent 1: prio {prio} protocol {protocol} '
+                                f'handle {filter_handle(old.ip_address)} u32')
+
+            if new_rate:
+                address = ipaddress.ip_address(new.ip_address)
+                prio, _, protocol, match, *_ = FAMILIES[address.version]
+                handle = filter_handle(address)
+                bucket = handle.rsplit(':', 1)[0]
+                commands += [
+                    f'class replace dev {device} parent 1: classid 1:{peer_id:x} htb rate {new_rate}kbit ceil {new_rate}kbit',
+                    f'filter replace dev {device} parent 1: prio {prio} protocol {protocol} handle {handle} u32 '
+                    f'ht {bucket}: match {match} {direction} {address}/{address.max_prefixlen} flowid 1:{peer_id:x}'
+                ]
+            elif old_rate:
+                commands.append(f'class del dev {device} classid 1:{peer_id:x}')
+        return commands
+
+    def sync(self, limits):
+        """Apply `limits` ([PeerLimit]); returns how many peers' rules changed
+
+        Peers with neither limit should be left out. Raises if tc fails, in
+        which case the next sync rebuilds from scratch.
+        """
+        desired = {}
+        handles = {}
+        for limit in sorted(limits):
+            if limit.peer_id > MAX_CLASS_ID:
+                print(f"Error shaping peer {limit.peer_id}: ids above {MAX_CLASS_ID} have no tc class")
+                continue
+            handle = filter_handle(limit.ip_address)
+            if handle in handles:
+                # A `filter replace` would take over the other peer's filter
+                print(f"Error shaping peer {limit.peer_id}: its filter handle {handle} is taken by peer "
+                      f"{handles[handle]}; shaped pools can be at most /13 (IPv4) or /109 (IPv6)")
+                continue
+            handles[handle] = limit.peer_id
+            desired[limit.peer_id] = limit
+
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(f'{self.state_path}.lock', 'a') as lock_file:
+            # One apply per interface at a time, across processes
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            ifindex = self.device_index()
+            if ifindex is None:
+                # Nothing to shape; the qdiscs go away with the device
+                self._clear_state()
+                return 0
+
+            applied_ifindex, applied = self._load_state()
+            commands = []
+            if applied_ifindex != ifindex:
+                if not desired:
+                    # Never touch the qdiscs of an interface nobody limits
+                    return 0
+                commands += self._rebuild()
+                applied = {}
+
+            changed = 0
+            for peer_id in applied.keys() | desired.keys():
+                old, new = applied.get(peer_id), desired.get(peer_id)
+                if old != new:
+                    commands += self._peer_commands(old, new)
+                    changed += 1
+
+            try:
+                self._tc_batch(commands)
+            except Exception:
+                self._clear_state()
+                raise
+
+            self._save_state(ifindex, desired)
+            return changed
@@ -0,0 +1,321 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from sqlalchemy import bindparam, or_, update
+from app import db
+from app.utils.traffic import TrafficRecorder
+from app.utils.wireguard import WireGuardManager
+from app.utils.interfaces import interface_names, DEFAULT_INTERFACE
+from app.utils.metrics import STATS_SAMPLE_DURATION
+
+# Samples of changes kept for stream clients that fall behind
+CHANGE_HISTORY = 32
+
+# A shared sample older than this many intervals means the sampling process is gone
+STALE_INTERVALS = 3
+
+class PeerStatsWriter:
+    """Persists last_seen and byte totals for peers whose values changed
+
+    last_seen is the latest handshake time, so an active peer's row changes
+    about every two minutes rather than on every sample.
+    """
+
+    def __init__(self):
+        self._written = None
+
+    def _load(self):
+        from app.models.peer import Peer
+
+        return {
+            public_key: (last_seen, total_rx, total_tx)
+            for public_key, last_seen, total_rx, total_tx in db.session.query(
+                Peer.public_key, Peer.last_seen, Peer.total_rx, Peer.total_tx
+            )
+        }
+
+    def persist(self, stats):
+        """Write changed peers with one executemany UPDATE; returns the number of rows sent"""
+        from app.models.peer import Peer
+
+        if self._written is None:
+            # Compare against what is already stored so a restart doesn't rewrite every row
+            self._written = self._load()
+
+        rows = []
+        for public_key, peer_stats in stats.items():
+            written = self._written.get(public_key)
+            last_seen = written[0] if written else None
+            if peer_stats['latest_handshake']:
+                last_seen = datetime.utcfromtimestamp(peer_stats['latest_handshake'])
+
+            values = (last_seen, peer_stats['rx_bytes'], peer_stats['tx_bytes'])
+            if values != written:
+                rows.append({
+                    'b_public_key': public_key,
+                    'b_last_seen': values[0],
+                    'b_total_rx': values[1],
+                    'b_total_tx': values[2]
+                })
+                self._written[public_key] = values
+
+        if not rows:
+            return 0
+
+        peers = Peer.__table__
+        statement = (
+            update(peers)
+            .where(peers.c.public_key == bindparam('b_public_key'))
+            # Rows another process already brought up to date are left alone
+            .where(or_(
+                peers.c.last_seen.is_distinct_from(bindparam('b_last_seen')),
+                peers.c.total_rx.is_distinct_from(bindparam('b_total_rx')),
+                peers.c.total_tx.is_distinct_from(bindparam('b_total_tx'))
+            ))
+            .values(
+                last_seen=bindparam('b_last_seen'),
+                total_rx=bindparam('b_total_rx'),
+                total_tx=bindparam('b_total_tx')
+            )
+        )
+        try:
+            db.session.execute(statement, rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Reload on the next write rather than trusting what we think is stored
+            self._written = None
+            raise
+        return len(rows)
+
+class StatsCollector:
+    """Samples every interface's peers on a fixed interval into a shared in-memory snapshot
+
+    Each sample also records which peers changed in a way worth telling
+    stream clients about, so that work is done once per sample rather than
+    once per viewer.
+
+    Only the writer process samples the interfaces; it shares each sample
+    through a file in the instance dir, which the other workers load
+    instead of dumping the interfaces themselves.
+    """
+
+    def __init__(self, interval=5, byte_threshold=64 * 1024, persist_interval=30):
+        self.interval = interval
+        self.byte_threshold = byte_threshold
+        self.persist_interval = persist_interval
+        self._lock = threading.Lock()
+        self._updated = threading.Condition(self._lock)
+        self._stats = {}
+        self._sampled_at = None
+        self._version = 0
+        self._reported = {}
+        self._changes = deque(maxlen=CHANGE_HISTORY)
+        self._thread = None
+        self._pid = None
+        self._recorder = TrafficRecorder()
+        self._peer_writer = PeerStatsWriter()
+        self._persisted_at = 0
+        self._writer_lock = None
+        self._published_mtime = None
+        self.app = None
+
+    def start(self):
+        """Start the sampler thread once per process"""
+        with self._lock:
+            # A thread started before a gunicorn fork does not exist in the worker
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # An inherited lock file descriptor doesn't make a forked worker the writer
+                self._writer_lock = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='wg-stats-collector', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # The first sample is taken synchronously by snapshot()
+        while True:
+            time.sleep(self.interval)
+            if self.app is not None and self._is_writer():
+                stats = self.sample()
+                self._publish()
+                self._persist(stats)
+            elif not self._load_published():
+                # No writer has shared a recent sample; don't serve stale stats
+                self.sample()
+
+    def _is_writer(self):
+        """Only one process per host persists stats; the first to lock the file wins"""
+        if self._writer_lock is not None:
+            return True
+
+        lock_path = os.path.join(self.app.instance_path, 'stats-writer.lock')
+        lock_file = None
+        try:
+            os.makedirs(self.app.instance_path, exist_ok=True)
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if lock_file:
+                lock_file.close()
+            return False
+
+        self._writer_lock = lock_file
+        return True
+
+    def _snapshot_path(self):
+        return os.path.join(self.app.instance_path, 'stats-snapshot.json')
+
+    def _publish(self):
+        """Share the latest sample with the other workers"""
+        path = self._snapshot_path()
+        with self._lock:
+            published = {'sampled_at': self._sampled_at, 'stats': self._stats}
+        try:
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(published, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            print(f"Error sharing peer stats: {e}")
+
+    def _load_published(self):
+        """Adopt the writer's latest sample; False if there's none recent enough"""
+        if self.app is None:
+            return False
+        path = self._snapshot_path()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != self._published_mtime:
+                with open(path) as f:
+                    published = json.load(f)
+                if self._sampled_at is None or published['sampled_at'] > self._sampled_at:
+                    self._update(published['stats'], published['sampled_at'])
+                self._published_mtime = mtime
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return self._sampled_at is not None and time.time() - self._sampled_at <= STALE_INTERVALS * self.interval
+
+    def _persist(self, stats):
+        """Record bandwidth history for the latest sample, and peer totals every persist_interval"""
+        try:
+            with self.app.app_context():
+                self._recorder.record(stats)
+                self._recorder.prune(self.app.config.get('TRAFFIC_RETENTION', {}))
+        except Exception as e:
+            print(f"Error recording traffic history: {e}")
+
+        now = time.monotonic()
+        if now - self._persisted_at < self.persist_interval:
+            return
+        self._persisted_at = now
+        try:
+            with self.app.app_context():
+                self._peer_writer.persist(stats)
+        except Exception as e:
+            print(f"Error saving peer stats: {e}")
+
+    def _interface_names(self):
+        if self.app is None:
+            return [DEFAULT_INTERFACE]
+        try:
+            with self.app.app_context():
+                return interface_names()
+        except Exception as e:
+            print(f"Error listing interfaces: {e}")
+            return [DEFAULT_INTERFACE]
+
+    def sample(self):
+        """Scrape each interface once and publish the result"""
+        stats = {}
+        with STATS_SAMPLE_DURATION.time():
+            for interface in self._interface_names():
+                stats.update(WireGuardManager(interface).get_peer_stats())
+        self._update(stats, time.time())
+        return stats
+
+    def _update(self, stats, sampled_at):
+        with self._lock:
+            changes = self._diff(stats)
+            self._stats = stats
+            self._sampled_at = sampled_at
+            self._version += 1
+            self._changes.append((self._version, changes))
+            self._updated.notify_all()
+
+    def _diff(self, stats):
+        """Peers whose handshake or online state changed, or whose counters
+        moved by at least byte_threshold since they were last reported.
+        Removed peers map to None.
+        """
+        changes = {}
+        for public_key, peer_stats in stats.items():
+            reported = self._reported.get(public_key)
+            if (reported is None
+                    or peer_stats['online'] != reported['online']
+                    or peer_stats['latest_handshake'] != reported['latest_handshake']
+                    or abs(peer_stats['rx_bytes'] - reported['rx_bytes']) >= self.byte_threshold
+                    or abs(peer_stats['tx_bytes'] - reported['tx_bytes']) >= self.byte_threshold):
+                changes[public_key] = peer_stats
+                self._reported[public_key] = peer_stats
+
+        for public_key in self._reported.keys() - stats.keys():
+            changes[public_key] = None
+            del self._reported[public_key]
+
+        return changes
+
+    def snapshot(self):
+        """Return the latest stats and their age in seconds"""
+        if self._sampled_at is None and not self._load_published():
+            # Nothing sampled yet in this process, don't serve an empty page
+            self.sample()
+
+        with self._lock:
+            return self._stats, time.time() - self._sampled_at
+
+    def versioned_snapshot(self):
+        """Return the latest stats and the version to pass to wait_for_changes()"""
+        self.snapshot()
+        with self._lock:
+            return self._stats, self._version
+
+    def wait_for_changes(self, since, timeout):
+        """Block until a sample newer than `since` exists or `timeout` passes
+
+        Returns (version, changes). changes is empty on timeout, and None if
+        the caller fell too far behind and should reload a full snapshot.
+        """
+        with self._updated:
+            self._updated.wait_for(lambda: self._version > since, timeout)
+            if self._version <= since:
+                return since, {}
+            if self._changes[0][0] > since + 1:
+                return self._version, None
+
+            merged = {}
+            for version, changes in self._changes:
+                if version > since:
+                    merged.update(changes)
+            return self._version, merged
+
+    def online_count(self):
+        with self._lock:
+            return sum(1 for peer_stats in self._stats.values() if peer_stats['online'])
+
+collector = StatsCollector()
+
+def get_stats_collector():
+    """Return the process-wide collector, starting it on first use"""
+    from flask import current_app
+
+    collector.app = current_app._get_current_object()
+    collector.interval = current_app.config.get('STATS_INTERVAL', 5)
+    collector.byte_threshold = current_app.config.get('STATS_STREAM_BYTE_THRESHOLD', 64 * 1024)
+    collector.persist_interval = current_app.config.get('STATS_PERSIST_INTERVAL', 30)
+    collector.start()
+    return collector
@@ -0,0 +1,138 @@
+import time
+from sqlalchemy import text
+from app import db
+
+# Resolution name -> bucket width in seconds
+RESOLUTIONS = {
+    '1m': 60,
+    '1h': 3600,
+    '1d': 86400
+}
+
+# How often expired buckets are pruned, in seconds
+PRUNE_INTERVAL = 3600
+
+# Peers looked up per query, well under SQLite's bound parameter limit
+LOOKUP_CHUNK = 500
+
+UPSERT_SQL = text("""
+    INSERT INTO peer_traffic (peer_id, resolution, bucket, rx_bytes, tx_bytes)
+    VALUES (:peer_id, :resolution, :bucket, :rx_bytes, :tx_bytes)
+    ON CONFLICT (peer_id, resolution, bucket) DO UPDATE SET
+        rx_bytes = rx_bytes + excluded.rx_bytes,
+        tx_bytes = tx_bytes + excluded.tx_bytes
+""")
+
+def counter_delta(current, previous):
+    """Bytes since the previous sample; a smaller counter means wg was restarted"""
+    if current >= previous:
+        return current - previous
+    return current
+
+class TrafficRecorder:
+    """Turns cumulative wg counters into per-peer bandwidth history
+
+    Only peers whose counters moved since the last sample cost a write.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._pruned_at = 0
+
+    def record(self, stats, now=None):
+        """Add the traffic since the previous sample to every resolution"""
+        from app.models.peer import Peer
+
+        now = int(now or time.time())
+
+        deltas = {}
+        # Only peers in this sample keep a baseline, so deleted peers and
+        # rotated keys don't pile up
+        previous_counters, self._counters = self._counters, {}
+        for public_key, peer_stats in stats.items():
+            counters = (peer_stats['rx_bytes'], peer_stats['tx_bytes'])
+            previous = previous_counters.get(public_key)
+            self._counters[public_key] = counters
+
+            # The first sample after startup is only a baseline
+            if previous is None:
+                continue
+
+            rx_bytes = counter_delta(counters[0], previous[0])
+            tx_bytes = counter_delta(counters[1], previous[1])
+            if rx_bytes or tx_bytes:
+                deltas[public_key] = (rx_bytes, tx_bytes)
+
+        if not deltas:
+            return 0
+
+        public_keys = list(deltas)
+        peer_ids = {}
+        for i in range(0, len(public_keys), LOOKUP_CHUNK):
+            chunk = public_keys[i:i + LOOKUP_CHUNK]
+            peer_ids.update(
+                db.session.query(Peer.public_key, Peer.id).filter(Peer.public_key.in_(chunk))
+            )
+
+        rows = []
+        for public_key, (rx_bytes, tx_bytes) in deltas.items():
+            peer_id = peer_ids.get(public_key)
+            if peer_id is None:
+                continue
+            for resolution in RESOLUTIONS.values():
+                rows.append({
+                    'peer_id': peer_id,
+                    'resolution': resolution,
+                    'bucket': now - now % resolution,
+                    'rx_bytes': rx_bytes,
+                    'tx_bytes': tx_bytes
+                })
+
+        if rows:
+            db.session.execute(UPSERT_SQL, rows)
+            db.session.commit()
+
+        return len(rows)
+
+    def prune(self, retention, now=None):
+        """Drop buckets older than their resolution's retention, at most once per PRUNE_INTERVAL"""
+        from app.models.traffic import PeerTraffic
+
+        now = int(now or time.time())
+        if now - self._pruned_at < PRUNE_INTERVAL:
+            return
+
+        for name, resolution in RESOLUTIONS.items():
+            keep = retention.get(name)
+            if keep:
+                PeerTraffic.query.filter(
+                    PeerTraffic.resolution == resolution,
+                    PeerTraffic.bucket < now - keep
+                ).delete(synchronize_session=False)
+        db.session.commit()
+        self._pruned_at = now
+
+def query_traffic(peer_id, resolution, start, end, session=None):
+    """Return the buckets for one peer in [start, end) at the given resolution"""
+    from app.models.traffic import PeerTraffic
+
+    rows = (
+        (session or db.session).query(PeerTraffic.bucket, PeerTraffic.rx_bytes, PeerTraffic.tx_bytes)
+        .filter(
+            PeerTraffic.peer_id == peer_id,
+            PeerTraffic.resolution == RESOLUTIONS[resolution],
+            PeerTraffic.bucket >= start,
+            PeerTraffic.bucket < end
+        )
+        .order_by(PeerTraffic.bucket)
+    )
+    return [
+        {'time': bucket, 'rx_bytes': rx_bytes, 'tx_bytes': tx_bytes}
+        for bucket, rx_bytes, tx_bytes in rows
+    ]
+
+def delete_traffic(peer_id):
+    """Remove a deleted peer's history"""
+    from app.models.traffic import PeerTraffic
+
+    PeerTraffic.query.filter_by(peer_id=peer_id).delete(synchronize_session=False)
@@ -1,82 +1,256 @@
-import subprocess
 import os
-import qrcode
+import base64
+import hashlib
+import json
+import tempfile
 import time
 from app import db
+from app.utils.ipam import get_allocator, host_cidr
+from app.utils.identity import file_fact, host_fact, default_route_interface
+from app.utils.backends import get_backend
+from app.utils.firewall import get_firewall
+from app.utils.metrics import run_command, CONFIG_RENDER_DURATION
+
+_x25519_module = None
+
+# sha256 of a private key -> its public key; without cryptography deriving forks `wg pubkey`
+_public_keys = {}
+
+def _public_key_of(wg_manager, private_key):
+    # Hashed so decrypted private keys don't linger in memory
+    digest = hashlib.sha256(private_key.encode('ascii')).digest()
+    public_key = _public_keys.get(digest)
+    if public_key is None:
+        public_key = _public_keys[digest] = wg_manager.derive_public_key(private_key)
+    return public_key
+
+def _x25519():
+    """cryptography's x25519 module, imported on first use; None without cryptography
+
+    Without cryptography keys are generated by the wg binary.
+    """
+    global _x25519_module
+    if _x25519_module is None:
+        try:
+            from cryptography.hazmat.primitives.asymmetric import x25519
+            _x25519_module = x25519
+        except ImportError:
+            _x25519_module = False
+    return _x25519_module or None
+
+def write_file_atomic(path, content):
+    """Atomically replace a root-owned file through a private temp file"""
+    directory = os.path.dirname(path)
+
+    if os.access(directory, os.W_OK):
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', dir=directory)
+        try:
+            # mkstemp creates the file with mode 600
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return
+
+    # No write access: do the same with a single sudo call, content on stdin
+    script = (
+        'umask 077; tmp=$(mktemp "$1.XXXXXX") || exit 1; '
+        'if cat > "$tmp" && mv -f "$tmp" "$1"; then exit 0; fi; '
+        'rm -f "$tmp"; exit 1'
+    )
+    run_command(
+        ['/usr/bin/sudo', '/bin/sh', '-c', script, 'sh', path],
+        input=content,
+        capture_output=True,
+        text=True,
+        check=True
+    )
 
 class WireGuardManager:
-    def __init__(self):
-        self.interface = 'wg0'
-        self.config_path = '/etc/wireguard/wg0.conf'
+    def __init__(self, interface='wg0'):
+        self.interface = interface
+        self.config_path = f'/etc/wireguard/{interface}.conf'
+        self.config_changed = False
+        self._row = None
+
+    @classmethod
+    def for_peer(cls, peer):
+        """Manager for the interface a peer lives on"""
+        if peer.interface is not None:
+            return cls(peer.interface.name)
+        return cls()
+
+    def interface_row(self):
+        """The Interface model for this device, or None before one exists"""
+        if self._row is None:
+            from app.models.interface import Interface
+            self._row = Interface.query.filter_by(name=self.interface).first()
+        return self._row
+
+    def address_pools(self):
+        row = self.interface_row()
+        if row is not None:
+            return row.pools
+
+        from flask import current_app
+        return current_app.config.get('WG_ADDRESS_POOLS', ['10.0.0.0/24'])
+
+    def allocator(self):
+        """Address allocator for this interface's pools"""
+        return get_allocator(self.address_pools())
+
+    @property
+    def backend(self):
+        """Backend that reads and changes the running interface (WG_BACKEND)"""
+        return get_backend()
 
     def get_server_private_key(self):
-        """Get the server's private key"""
+        """Get the server's private key, or None if there isn't one"""
         try:
-            with open(self.config_path, 'r') as f:
-                for line in f:
-                    if line.strip().startswith('PrivateKey'):
-                        key = line.split('=')[1].strip()
-                        if key and key != 'None':
-                            return key
+            row = self.interface_row()
+            if row is not None and row.private_key:
+                return row.private_key
+
+            # Cached until wg0.conf changes
+            key = file_fact(self.config_path, 'private_key', self._read_server_private_key)
+            if key:
+                return key
         except Exception as e:
             print(f"Error reading server private key: {e}")
-        
-        # Return hardcoded key as fallback
-        return 'mKflGnS9IJcGhXxoUTh6JurgjyF1cAfVB2HwwbQWpUE='
+        return None
+
+    def _read_server_private_key(self):
+        with open(self.config_path, 'r') as f:
+            for line in f:
+                if line.strip().startswith('PrivateKey'):
+                    key = line.split('=', 1)[1].strip()
+                    if key and key != 'None':
+                        return key
+        return None
 
     def get_server_public_key(self):
         """Get the server's public key"""
         try:
-            # First try to get it from wg show
-            result = subprocess.run(
-                ['/usr/bin/sudo', '/usr/bin/wg', 'show', self.interface, 'public-key'],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            pubkey = result.stdout.strip()
-            if pubkey:
-                return pubkey
-        except:
-            pass
-        
-        # Fallback: derive from private key
-        try:
-            private_key = self.get_server_private_key()
-            if private_key:
-                result = subprocess.run(
-                    ['/usr/bin/wg', 'pubkey'],
-                    input=private_key,
-                    capture_output=True,
-                    text=True,
-                    check=True
-                )
-                return result.stdout.strip()
+            row = self.interface_row()
+            if row is not None and row.private_key:
+                # Keyed by the private key itself, so a new key is never served stale
+                return _public_key_of(self, row.private_key)
+
+            # Cached until wg0.conf changes
+            return file_fact(self.config_path, 'public_key', self._read_server_public_key)
         except Exception as e:
             print(f"Error getting server public key: {e}")
         
         return None
 
+    def _read_server_public_key(self):
+        try:
+            private_key = file_fact(self.config_path, 'private_key', self._read_server_private_key)
+        except OSError:
+            private_key = None
+
+        # Deriving it in-process is cheapest when the config is readable
+        if private_key and _x25519() is not None:
+            return self.derive_public_key(private_key)
+
+        try:
+            pubkey = self.backend.public_key(self.interface)
+            if pubkey:
+                return pubkey
+        except Exception:
+            pass
+
+        if private_key:
+            return self.derive_public_key(private_key)
+        return None
+
+    def derive_public_key(self, private_key):
+        """Derive the public key for a base64 private key"""
+        x25519 = _x25519()
+        if x25519 is not None:
+            key = x25519.X25519PrivateKey.from_private_bytes(base64.b64decode(private_key))
+            return base64.b64encode(key.public_key().public_bytes_raw()).decode('ascii')
+
+        result = run_command(
+            ['/usr/bin/wg', 'pubkey'],
+            input=private_key,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return result.stdout.strip()
+
     def get_main_interface(self):
         """Get the main network interface"""
         try:
-            result = subprocess.run(
-                ['/usr/bin/ip', 'route', 'show', 'default'],
+            # Cached until the routing table changes
+            interface = host_fact('main_interface', self._read_main_interface)
+            if interface:
+                return interface
+        except Exception as e:
+            print(f"Error getting main interface: {e}")
+        return 'eth0'
+
+    def _read_main_interface(self):
+        try:
+            interface = default_route_interface()
+            if interface:
+                return interface
+        except OSError:
+            pass
+
+        # No IPv4 default route in /proc, ask ip (also covers IPv6-only hosts)
+        result = run_command(
+            ['/usr/bin/ip', 'route', 'show', 'default'],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        if not result.stdout.strip():
+            result = run_command(
+                ['/usr/bin/ip', '-6', 'route', 'show', 'default'],
                 capture_output=True,
                 text=True,
                 check=True
             )
-            interface = result.stdout.split()[4]
-            return interface
-        except Exception as e:
-            print(f"Error getting main interface: {e}")
-            return 'eth0'
+        fields = result.stdout.split()
+        return fields[fields.index('dev') + 1] if 'dev' in fields else None
 
     def generate_keys(self):
         """Generate WireGuard key pair"""
+        if _x25519() is not None:
+            try:
+                return self._generate_keys_native()
+            except Exception as e:
+                print(f"Error generating keys natively, falling back to wg: {e}")
+
+        return self._generate_keys_subprocess()
+
+    def _generate_keys_native(self):
+        """Generate keys in-process, equivalent to `wg genkey | wg pubkey` and `wg genpsk`"""
+        private_bytes = bytearray(os.urandom(32))
+
+        # Clamp the scalar the same way `wg genkey` does
+        private_bytes[0] &= 248
+        private_bytes[31] = (private_bytes[31] & 127) | 64
+        private_key = base64.b64encode(bytes(private_bytes)).decode('ascii')
+
+        return {
+            'private_key': private_key,
+            'public_key': self.derive_public_key(private_key),
+            'preshared_key': base64.b64encode(os.urandom(32)).decode('ascii')
+        }
+
+    def _generate_keys_subprocess(self):
+        """Generate keys by calling the wg binary"""
         try:
             # Generate private key
-            private_result = subprocess.run(
+            private_result = run_command(
                 ['/usr/bin/wg', 'genkey'],
                 capture_output=True,
                 text=True,
@@ -85,7 +259,7 @@ class WireGuardManager:
             private_key = private_result.stdout.strip()
 
             # Generate public key from private key
-            public_result = subprocess.run(
+            public_result = run_command(
                 ['/usr/bin/wg', 'pubkey'],
                 input=private_key,
                 capture_output=True,
@@ -95,7 +269,7 @@ class WireGuardManager:
             public_key = public_result.stdout.strip()
 
             # Generate preshared key
-            preshared_result = subprocess.run(
+            preshared_result = run_command(
                 ['/usr/bin/wg', 'genpsk'],
                 capture_output=True,
                 text=True,
@@ -114,66 +288,130 @@ class WireGuardManager:
 
     def generate_server_config(self):
         """Generate WireGuard server configuration"""
-        from app.models.peer import Peer
+        with CONFIG_RENDER_DURATION.time(interface=self.interface):
+            return self._render_server_config()
 
-        # Only get enabled peers
-        peers = Peer.query.filter_by(enabled=True).all()
+    def _render_server_config(self):
+        from app.models.peer import Peer
 
-        config = f"""[Interface]
-Address = 10.0.0.1/24
-ListenPort = 51820
-PrivateKey = {self.get_server_private_key()}
-PostUp = iptables -A FORWARD -i wg0 -j ACCEPT; iptables -t nat -A POSTROUTING -o {self.get_main_interface()} -j MASQUERADE
-PostDown = iptables -D FORWARD -i wg0 -j ACCEPT; iptables -t nat -D POSTROUTING -o {self.get_main_interface()} -j MASQUERADE
+        # Only get enabled peers, in a stable order so unchanged configs hash the same
+        peers = (
+            db.session.query(Peer.name, Peer.public_key, Peer.ip_address, Peer.preshared_key)
+            .filter(Peer.enabled.is_(True))
+            .order_by(Peer.id)
+        )
+
+        row = self.interface_row()
+        listen_port = 51820
+        if row is not None:
+            peers = peers.filter(Peer.interface_id == row.id)
+            listen_port = row.listen_port
+
+        private_key = self.get_server_private_key()
+        if not private_key:
+            # Never write a config that would take the interface down or use a made-up key
+            raise RuntimeError(f'No private key for {self.interface} in the database or {self.config_path}')
+
+        main_interface = self.get_main_interface()
+        firewall = get_firewall()
+        lines = [
+            '[Interface]',
+            f"Address = {', '.join(self.allocator().server_addresses())}",
+            f'ListenPort = {listen_port}',
+            f'PrivateKey = {private_key}'
+        ]
+        for key, command in (('PostUp', firewall.post_up(self.interface, main_interface)),
+                             ('PostDown', firewall.post_down(self.interface, main_interface))):
+            if command:
+                lines.append(f'{key} = {command}')
+        lines.append('')
+
+        for name, public_key, ip_address, preshared_key in peers:
+            lines += [
+                f'# Peer: {name}',
+                '[Peer]',
+                f'PublicKey = {public_key}',
+                f'AllowedIPs = {host_cidr(ip_address)}'
+            ]
+            if preshared_key:
+                lines.append(f'PresharedKey = {preshared_key}')
+            lines.append('')
+
+        lines.append('')
+        return '\n'.join(lines)
+
+    def save_server_config(self, force=False):
+        """Save the server configuration to file
+
+        Skips the write when the rendered config matches what was last
+        written, unless force; config_changed tells callers whether anything
+        needs applying.
+        """
+        self.config_changed = False
+        try:
+            config = self.generate_server_config()
+            digest = hashlib.sha256(config.encode('utf-8')).hexdigest()
 
-"""
+            if not force and digest == self._written_digest():
+                return True
 
-        for peer in peers:
-            config += f"""# Peer: {peer.name}
-[Peer]
-PublicKey = {peer.public_key}
-AllowedIPs = {peer.ip_address}/32
-"""
-            if peer.preshared_key:
-                config += f"PresharedKey = {peer.preshared_key}\n"
-            config += "\n"
+            self._write_config(config)
+            self._remember_digest(digest)
+            self.config_changed = True
 
-        return config
+            return True
+        except Exception as e:
+            print(f"Error saving server config: {e}")
+            return False
 
-    def save_server_config(self):
-        """Save the server configuration to file"""
+    def _config_stat(self):
+        """(mtime, size) of the config file, or None if we can't stat it"""
         try:
-            config = self.generate_server_config()
+            stat = os.stat(self.config_path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
 
-            # Write to temporary file
-            temp_path = '/tmp/wg0.conf'
-            with open(temp_path, 'w') as f:
-                f.write(config)
+    def _digest_path(self):
+        from flask import current_app
 
-            # Move to proper location with sudo
-            subprocess.run(
-                ['/usr/bin/sudo', 'cp', temp_path, self.config_path],
-                check=True
-            )
+        return os.path.join(current_app.instance_path, f'config-{self.interface}.json')
 
-            # Set proper permissions
-            subprocess.run(
-                ['/usr/bin/sudo', 'chmod', '600', self.config_path],
-                check=True
-            )
+    def _written_digest(self):
+        """Digest of the config last written, by any worker, if the file hasn't been touched since
+
+        It is kept in the instance dir, which every worker can read even
+        when /etc/wireguard is root-only. Without a stat of the config
+        only writes through here are seen; force rewrites regardless.
+        """
+        try:
+            with open(self._digest_path()) as f:
+                written = json.load(f)
+            stat = tuple(written['stat']) if written['stat'] is not None else None
+            if stat != self._config_stat():
+                return None
+            return written['digest']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
 
-            # Clean up
-            os.remove(temp_path)
+    def _remember_digest(self, digest):
+        path = self._digest_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump({'digest': digest, 'stat': self._config_stat()}, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            # Only costs a rewrite on the next apply
+            print(f"Error saving config digest: {e}")
 
-            return True
-        except Exception as e:
-            print(f"Error saving server config: {e}")
-            return False
+    def _write_config(self, config):
+        write_file_atomic(self.config_path, config)
 
     def reload_wireguard(self):
         """Reload WireGuard configuration"""
         try:
-            subprocess.run(
+            run_command(
                 ['/usr/bin/sudo', 'systemctl', 'restart', f'wg-quick@{self.interface}'],
                 check=True
             )
@@ -182,16 +420,75 @@ AllowedIPs = {peer.ip_address}/32
             print(f"Error reloading WireGuard: {e}")
             return False
 
-    def generate_peer_config(self, peer):
-        """Generate client configuration for a peer"""
-        from flask import current_app
+    def sync_wireguard(self):
+        """Apply the server config to the running interface without restarting it"""
+        try:
+            # Like `wg syncconf wg0 <(wg-quick strip wg0)`: only changed peers are touched
+            self.backend.sync(self.interface, self.generate_server_config())
+            return True
+        except Exception as e:
+            print(f"Error syncing WireGuard: {e}")
+            return False
 
-        server_public_key = self.get_server_public_key()
-        endpoint = current_app.config.get('WG_SERVER_ENDPOINT', 'your-server-ip:51820')
+    def apply_shaping(self):
+        """Bring the interface's tc rules in line with its peers' bandwidth limits
+
+        Returns how many peers' rules changed; raises if tc fails.
+        """
+        from flask import current_app
+        from sqlalchemy import or_
+        from app.models.peer import Peer
+        from app.utils.shaping import PeerLimit, TrafficShaper
+
+        limits = (
+            db.session.query(Peer.id, Peer.ip_address, Peer.download_limit, Peer.upload_limit)
+            .filter(Peer.enabled.is_(True))
+            .filter(or_(Peer.download_limit.isnot(None), Peer.upload_limit.isnot(None)))
+        )
+        row = self.interface_row()
+        if row is not None:
+            limits = limits.filter(Peer.interface_id == row.id)
+
+        shaper = TrafficShaper(self.interface, current_app.instance_path)
+        return shaper.sync([PeerLimit(*limit) for limit in limits])
+
+    def apply_firewall(self):
+        """Bring the firewall's peer sets in line with the database
+
+        The nftables rules cover every interface at once. Returns how many
+        peers' rules changed; raises if nft fails.
+        """
+        from app.models.interface import Interface
+        from app.models.peer import Peer
+        from app.utils.firewall import FirewallPeer
+
+        interfaces = [name for (name,) in db.session.query(Interface.name)] or [self.interface]
+        peers = db.session.query(Peer.id, Peer.ip_address, Peer.enabled)
+        return get_firewall().sync(
+            interfaces,
+            self.get_main_interface(),
+            [FirewallPeer(peer_id, ip_address, bool(enabled)) for peer_id, ip_address, enabled in peers]
+        )
+
+    def generate_peer_config(self, peer, server_public_key=None, pending=False):
+        """Generate client configuration for a peer
+
+        The config has the keys the server accepts now. With pending=True it
+        has the keys of a staged rotation instead, which only work once the
+        server switches over to them.
+        """
+        if server_public_key is None:
+            server_public_key = self.get_server_public_key()
+        endpoint = self.endpoint()
+        private_key = peer.private_key
+        preshared_key = peer.preshared_key
+        if pending and peer.key_rotation_due is not None:
+            private_key = peer.pending_private_key or private_key
+            preshared_key = peer.pending_preshared_key or preshared_key
 
         config = f"""[Interface]
-PrivateKey = {peer.private_key}
-Address = {peer.ip_address}/32
+PrivateKey = {private_key}
+Address = {host_cidr(peer.ip_address)}
 DNS = 1.1.1.1, 8.8.8.8
 
 [Peer]
@@ -199,141 +496,78 @@ PublicKey = {server_public_key}
 Endpoint = {endpoint}
 AllowedIPs = 0.0.0.0/0, ::/0
 """
-        if peer.preshared_key:
-            config += f"PresharedKey = {peer.preshared_key}\n"
+        if preshared_key:
+            config += f"PresharedKey = {preshared_key}\n"
 
         config += "PersistentKeepalive = 25\n"
 
         return config
 
-    def save_peer_config(self, peer, config_content):
-        """Save peer configuration to file"""
-        try:
-            from flask import current_app
-            config_dir = current_app.config.get('CONFIG_DIR')
-
-            if not os.path.exists(config_dir):
-                os.makedirs(config_dir)
-
-            config_path = os.path.join(config_dir, f'peer_{peer.id}.conf')
-            with open(config_path, 'w') as f:
-                f.write(config_content)
-
-            return config_path
-        except Exception as e:
-            print(f"Error saving peer config: {e}")
-            return None
-
-    def generate_qrcode(self, config_content, peer_id):
-        """Generate QR code for peer configuration"""
-        try:
-            from flask import current_app
-            qrcode_dir = current_app.config.get('QRCODE_DIR')
-
-            if not os.path.exists(qrcode_dir):
-                os.makedirs(qrcode_dir, mode=0o755)
-
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(config_content)
-            qr.make(fit=True)
-
-            img = qr.make_image(fill_color="black", back_color="white")
-
-            qr_path = os.path.join(qrcode_dir, f'peer_{peer_id}.png')
-            img.save(qr_path)
-
-            # Set proper permissions
-            os.chmod(qr_path, 0o644)
+    def endpoint(self):
+        """Public host:port clients connect to for this interface"""
+        from flask import current_app
 
-            return qr_path
-        except Exception as e:
-            print(f"Error generating QR code: {e}")
-            return None
+        endpoint = current_app.config.get('WG_SERVER_ENDPOINT', 'your-server-ip:51820')
+        row = self.interface_row()
+        if row is None:
+            return endpoint
+        if row.endpoint:
+            return row.endpoint
+        # Same host as the configured endpoint, on this interface's port
+        host = endpoint.rsplit(':', 1)[0] if ':' in endpoint else endpoint
+        return f'{host}:{row.listen_port}'
 
     def get_next_ip(self):
         """Get the next available IP address"""
-        from app.models.peer import Peer
-
-        peers = Peer.query.all()
-        used_ips = [peer.ip_address for peer in peers]
-
-        # Start from 10.0.0.2 (server uses 10.0.0.1)
-        for i in range(2, 255):
-            ip = f'10.0.0.{i}'
-            if ip not in used_ips:
-                return ip
-
-        return None
+        ips = self.allocator().allocate(1)
+        return ips[0] if ips else None
 
     def get_peer_stats(self):
         """Get statistics for all peers from WireGuard"""
         try:
-            result = subprocess.run(
-                ['/usr/bin/sudo', '/usr/bin/wg', 'show', self.interface, 'dump'],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-
-            stats = {}
-            lines = result.stdout.strip().split('\n')
-
-            # Skip header line
-            for line in lines[1:]:
-                parts = line.split('\t')
-                if len(parts) >= 6:
-                    public_key = parts[0]
-                    endpoint = parts[2] if parts[2] != '(none)' else None
-                    latest_handshake = int(parts[4]) if parts[4] else 0
-                    rx_bytes = int(parts[5]) if parts[5] else 0
-                    tx_bytes = int(parts[6]) if parts[6] else 0
-
-                    # Peer is online if handshake was within last 3 minutes (180 seconds)
-                    current_time = int(time.time())
-                    is_online = latest_handshake > 0 and (current_time - latest_handshake) < 180
-
-                    stats[public_key] = {
-                        'endpoint': endpoint,
-                        'latest_handshake': latest_handshake,
-                        'rx_bytes': rx_bytes,
-                        'tx_bytes': tx_bytes,
-                        'online': is_online
-                    }
-
-            return stats
-        except subprocess.CalledProcessError as e:
-            print(f"Error getting peer stats: {e}")
-            return {}
+            peers = self.backend.dump(self.interface)
         except Exception as e:
-            print(f"Error parsing peer stats: {e}")
+            print(f"Error getting peer stats: {e}")
             return {}
 
+        current_time = int(time.time())
+        stats = {}
+        for public_key, peer in peers.items():
+            latest_handshake = peer['latest_handshake']
+
+            # Peer is online if handshake was within last 3 minutes (180 seconds)
+            is_online = latest_handshake > 0 and (current_time - latest_handshake) < 180
+
+            stats[public_key] = {
+                'endpoint': peer['endpoint'],
+                'latest_handshake': latest_handshake,
+                'rx_bytes': peer['rx_bytes'],
+                'tx_bytes': peer['tx_bytes'],
+                'online': is_online
+            }
+
+        return stats
+
     def toggle_peer(self, peer_id, enabled):
-        """Enable or disable a peer by updating WireGuard config"""
+        """Enable or disable a peer; returns the job that applies the change"""
         try:
             from app.models.peer import Peer
+            from app.utils.jobs import enqueue_apply
             peer = Peer.query.get(peer_id)
             if not peer:
-                return False
+                return None
 
             # Update database
             peer.enabled = enabled
             db.session.commit()
 
-            # Regenerate WireGuard config (will only include enabled peers)
-            self.save_server_config()
-            self.reload_wireguard()
-
-            return True
+            # Regenerate WireGuard config (will only include enabled peers) in
+            # the background; toggles in quick succession share one apply
+            return enqueue_apply(self.interface)
         except Exception as e:
             print(f"Error toggling peer: {e}")
             db.session.rollback()
-            return False
+            return None
 
     def delete_peer_files(self, peer_id):
         """Delete peer configuration and QR code files"""
@@ -346,7 +580,7 @@ AllowedIPs = 0.0.0.0/0, ::/0
             if os.path.exists(config_path):
                 os.remove(config_path)
 
-            # Delete QR code
+            # Delete QR code left over from when PNGs were written at creation time
             qrcode_dir = current_app.config.get('QRCODE_DIR')
             qr_path = os.path.join(qrcode_dir, f'peer_{peer_id}.png')
             if os.path.exists(qr_path):
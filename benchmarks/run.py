@@ -0,0 +1,325 @@
+"""Benchmarks for the hot paths: config rendering, address allocation, stats
+parsing, drift detection, dashboard and stats API latency, and QR rendering.
+
+Each peer count runs in a fresh process against a temporary SQLite database
+seeded with that many peers. `sudo`, `wg`, `wg-quick` and `systemctl` are
+never run: subprocess.run is stubbed and the interface is the in-memory fake
+backend. The *_cold variants clear the decrypted key cache before each run,
+so they show the cost of the encrypted key columns.
+
+    python -m benchmarks.run --peers 100,1000,10000 --output bench.json
+    python -m benchmarks.run --compare bench.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DEFAULT_PEERS = (100, 1000, 10000)
+DEFAULT_REPEAT = 20
+
+class StubSubprocess:
+    """Stands in for subprocess.run; `wg show ... dump` returns a synthetic dump"""
+
+    def __init__(self, dump=''):
+        self.dump = dump
+        self.calls = []
+
+    def run(self, command, input=None, capture_output=False, text=False, check=False, **kwargs):
+        self.calls.append(command)
+        stdout = self.dump if 'dump' in command else ''
+        return subprocess.CompletedProcess(command, 0, stdout=stdout, stderr='')
+
+def _key():
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+def _peer_address(index):
+    # Offsets 2.. of 10.0.0.0/16, as the allocator would hand them out
+    offset = index + 2
+    return f'10.0.{offset >> 8}.{offset & 0xff}'
+
+def seed_peers(count):
+    """Insert `count` peers on wg0 and return their public keys"""
+    from app import db
+    from app.models.peer import Peer
+
+    now = datetime.utcnow()
+    rows = []
+    for index in range(count):
+        rows.append({
+            'name': f'peer-{index:05d}',
+            'ip_address': _peer_address(index),
+            'public_key': _key(),
+            'private_key': _key(),
+            'preshared_key': _key(),
+            'interface_id': 1,
+            'created_at': now - timedelta(minutes=index),
+            'enabled': index % 10 != 0,
+            'last_seen': now - timedelta(minutes=index % 60) if index % 2 else None,
+            'total_rx': index * 1000,
+            'total_tx': index * 500
+        })
+    db.session.execute(Peer.__table__.insert(), rows)
+    db.session.commit()
+    return [row['public_key'] for row in rows]
+
+def synthetic_dump(public_keys):
+    """`wg show wg0 dump` output for the given peers"""
+    now = int(time.time())
+    lines = [f'{_key()}\t{_key()}\t51820\toff']
+    for index, public_key in enumerate(public_keys):
+        handshake = now - index % 600 if index % 2 else 0
+        lines.append(
+            f'{public_key}\t{_key()}\t198.51.100.{index % 250 + 1}:{40000 + index % 20000}\t'
+            f'{_peer_address(index)}/32\t{handshake}\t{index * 1000}\t{index * 500}\t25'
+        )
+    return '\n'.join(lines) + '\n'
+
+def synthetic_netlink_dump(public_keys, peers_per_message=32):
+    """WG_CMD_GET_DEVICE dump messages for the given peers, as the kernel splits them"""
+    from app.utils import backends as nl
+
+    now = int(time.time())
+    messages = []
+    for start in range(0, len(public_keys), peers_per_message):
+        peers = []
+        for index in range(start, min(start + peers_per_message, len(public_keys))):
+            endpoint = struct.pack('=H', socket.AF_INET) + struct.pack('!H', 51820) + bytes([198, 51, 100, index % 250 + 1]) + bytes(8)
+            allowed_ip = [
+                nl.nl_attr(nl.WGALLOWEDIP_A_FAMILY, struct.pack('=H', socket.AF_INET)),
+                nl.nl_attr(nl.WGALLOWEDIP_A_IPADDR, socket.inet_aton(_peer_address(index))),
+                nl.nl_attr(nl.WGALLOWEDIP_A_CIDR_MASK, struct.pack('=B', 32))
+            ]
+            peers.append(nl.nl_nest(index - start, [
+                nl.nl_attr(nl.WGPEER_A_PUBLIC_KEY, base64.b64decode(public_keys[index])),
+                nl.nl_attr(nl.WGPEER_A_PRESHARED_KEY, os.urandom(32)),
+                nl.nl_attr(nl.WGPEER_A_ENDPOINT, endpoint),
+                nl.nl_attr(nl.WGPEER_A_LAST_HANDSHAKE_TIME, struct.pack('=qq', now, 0)),
+                nl.nl_attr(nl.WGPEER_A_RX_BYTES, struct.pack('=Q', index * 1000)),
+                nl.nl_attr(nl.WGPEER_A_TX_BYTES, struct.pack('=Q', index * 500)),
+                nl.nl_nest(nl.WGPEER_A_ALLOWEDIPS, [nl.nl_nest(0, allowed_ip)])
+            ]))
+        messages.append(nl.nl_nest(nl.WGDEVICE_A_PEERS, peers))
+    return messages
+
+def measure(name, peers, func, repeat):
+    """Time `func` after one warm-up call; times are in milliseconds"""
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'name': name,
+        'peers': peers,
+        'repeat': repeat,
+        'min_ms': round(min(times), 3),
+        'median_ms': round(statistics.median(times), 3),
+        'mean_ms': round(statistics.mean(times), 3)
+    }
+
+def run_single(peer_count, repeat):
+    """Run every benchmark against a fresh database of `peer_count` peers"""
+    from config import Config
+
+    workdir = tempfile.mkdtemp(prefix='vpn-bench-')
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        CONFIG_DIR = os.path.join(workdir, 'configs')
+        MASTER_KEY_FILE = os.path.join(workdir, 'master.key')
+        WG_ADDRESS_POOLS = ['10.0.0.0/16']
+        WG_BACKEND = 'fake'
+        STATS_INTERVAL = 3600
+        RECONCILE_INTERVAL = 0
+        SESSION_COOKIE_SECURE = False
+
+    stub = StubSubprocess()
+    subprocess.run = stub.run
+
+    from app import create_app, db
+    from app.models.interface import Interface
+    from app.utils.backends import configure_backend, decode_device
+    from app.utils.database import read_session
+    from app.utils.export import iter_export_peers, stream_peer_configs
+    from app.utils.keystore import create_master_key, get_secret_cache
+    from app.utils.migrations import migrate
+    from app.utils.qr import render_qrcode
+    from app.utils.reconcile import reconcile
+    from app.utils.wireguard import WireGuardManager
+
+    create_master_key(BenchmarkConfig.MASTER_KEY_FILE)
+    app = create_app(BenchmarkConfig)
+    results = []
+
+    try:
+        with app.app_context():
+            migrate()
+            public_keys = seed_peers(peer_count)
+            Interface.query.filter_by(name='wg0').one().private_key = _key()
+            db.session.commit()
+
+            wg_manager = WireGuardManager('wg0')
+
+            results.append(measure('generate_server_config', peer_count,
+                                   wg_manager.generate_server_config, repeat))
+
+            # Keys are stored encrypted: the same work with every key decrypted again
+            def render_cold():
+                get_secret_cache().clear()
+                wg_manager.generate_server_config()
+            results.append(measure('server_config_cold', peer_count, render_cold, repeat))
+
+            def export():
+                for _ in stream_peer_configs(iter_export_peers(read_session())):
+                    pass
+                read_session().rollback()
+            results.append(measure('export_configs', peer_count, export, max(repeat // 5, 1)))
+
+            def export_cold():
+                get_secret_cache().clear()
+                export()
+            results.append(measure('export_configs_cold', peer_count, export_cold, max(repeat // 5, 1)))
+
+            def next_ip():
+                wg_manager.allocator().release(wg_manager.get_next_ip())
+            results.append(measure('get_next_ip', peer_count, next_ip, repeat))
+            results.append(measure('allocator_seed', peer_count, wg_manager.allocator().seed, repeat))
+
+            # Parse a `wg show dump` through the subprocess backend
+            stub.dump = synthetic_dump(public_keys)
+            configure_backend('subprocess')
+            results.append(measure('get_peer_stats', peer_count, wg_manager.get_peer_stats, repeat))
+
+            messages = synthetic_netlink_dump(public_keys)
+            results.append(measure('netlink_decode_dump', peer_count,
+                                   lambda: decode_device(messages), repeat))
+
+            # The web paths read stats from the fake interface
+            backend = configure_backend('fake')
+            now = int(time.time())
+            for index, public_key in enumerate(public_keys):
+                backend.set_peer('wg0', public_key, [f'{_peer_address(index)}/32'])
+                backend.set_traffic('wg0', public_key, rx_bytes=index * 1000, tx_bytes=index * 500,
+                                    latest_handshake=now if index % 2 else 0)
+
+            # A dry-run pass: database against the fake interface's dump
+            results.append(measure('reconcile_dry_run', peer_count, reconcile, repeat))
+
+            peer_config = wg_manager.generate_peer_config(wg_manager.interface_row().peers.first())
+            results.append(measure('qrcode_svg', peer_count, lambda: render_qrcode(peer_config, 'svg'), repeat))
+            results.append(measure('qrcode_png', peer_count, lambda: render_qrcode(peer_config, 'png'), repeat))
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+            session['username'] = 'admin'
+
+        def get(url):
+            def request():
+                response = client.get(url)
+                assert response.status_code == 200, f'{url}: {response.status_code}'
+            return request
+
+        results.append(measure('dashboard', peer_count, get('/dashboard'), repeat))
+        results.append(measure('api_peer_stats', peer_count, get('/api/peer-stats'), repeat))
+        results.append(measure('api_peer_stats_page', peer_count,
+                               get('/api/peer-stats?ids=' + ','.join(str(i) for i in range(1, 51))), repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(baseline, current, threshold):
+    """Print median changes against a baseline run; returns True if any got slower than threshold"""
+    previous = {(result['name'], result['peers']): result for result in baseline['results']}
+    regressed = False
+
+    print(f"{'benchmark':<24} {'peers':>6} {'before':>10} {'after':>10} {'change':>8}")
+    for result in current['results']:
+        before = previous.get((result['name'], result['peers']))
+        if before is None:
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+        flag = '  SLOWER' if ratio > threshold else ''
+        regressed = regressed or bool(flag)
+        print(f"{result['name']:<24} {result['peers']:>6} {before['median_ms']:>8.2f}ms "
+              f"{result['median_ms']:>8.2f}ms {ratio:>7.2f}x{flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VPN Manager hot paths.')
+    parser.add_argument('--peers', default=','.join(str(count) for count in DEFAULT_PEERS),
+                        help='Comma-separated peer counts (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Timed runs per benchmark (default: %(default)s)')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Compare against a previous --output file')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Slowdown ratio reported as a regression (default: %(default)s)')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--single-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        with open(args.single_output, 'w') as f:
+            json.dump(run_single(args.single, args.repeat), f)
+        return 0
+
+    results = []
+    for peer_count in (int(count) for count in args.peers.split(',') if count.strip()):
+        # A fresh process per size: module-level caches must not carry over
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            subprocess.run(
+                [sys.executable, '-m', 'benchmarks.run', '--single', str(peer_count),
+                 '--repeat', str(args.repeat), '--single-output', output.name],
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+            with open(output.name) as f:
+                size_results = json.load(f)
+
+        for result in size_results:
+            print(f"{result['name']:<24} {result['peers']:>6} peers  "
+                  f"median {result['median_ms']:>9.3f}ms  min {result['min_ms']:>9.3f}ms")
+        results += size_results
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), report, args.threshold):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
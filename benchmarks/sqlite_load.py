@@ -0,0 +1,170 @@
+"""Mixed read/write load against SQLite, default settings vs the tuned engine.
+
+Reader processes page through peers the way the dashboard does while writer
+processes persist stats snapshots the way the stats collector does. Each mode
+gets its own database file, since the journal mode is stored in the file.
+
+    python -m benchmarks.sqlite_load --peers 5000 --readers 4 --writers 2 --duration 10
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+MODES = ('default', 'tuned')
+
+def _config(mode, workdir):
+    from config import Config
+
+    class LoadConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'load.db')
+        CONFIG_DIR = os.path.join(workdir, 'configs')
+        MASTER_KEY_FILE = os.path.join(workdir, 'master.key')
+        WG_ADDRESS_POOLS = ['10.0.0.0/16']
+        WG_BACKEND = 'fake'
+        STATS_INTERVAL = 3600
+
+    if mode == 'default':
+        # SQLite's own defaults: rollback journal, synchronous=FULL, no mmap
+        LoadConfig.SQLITE_PRAGMAS = {}
+    return LoadConfig
+
+def _make_app(mode, workdir):
+    from app import create_app
+
+    # create_app warns until the new database is migrated
+    with contextlib.redirect_stdout(io.StringIO()):
+        return create_app(_config(mode, workdir))
+
+def _is_locked(error):
+    return 'locked' in str(error) or 'busy' in str(error)
+
+def reader(mode, workdir, start, duration, results):
+    """Page through peers and count them, like a dashboard load"""
+    from sqlalchemy.exc import OperationalError
+    from app import db
+    from app.utils.database import read_session
+    from app.utils.listing import count_peers, list_peers
+
+    app = _make_app(mode, workdir)
+    reads = errors = 0
+    start.wait()
+    deadline = time.time() + duration
+    with app.app_context():
+        # Before the split every read went through the write session
+        session = read_session() if mode == 'tuned' else db.session
+        while time.time() < deadline:
+            try:
+                cursor = None
+                for _ in range(3):
+                    page = list_peers(cursor=cursor, session=session)
+                    cursor = page.next_cursor
+                count_peers(session=session)
+                reads += 1
+            except OperationalError as e:
+                if not _is_locked(e):
+                    raise
+                errors += 1
+            finally:
+                session.rollback()
+    results.put(('read', reads, errors))
+
+def writer(mode, workdir, start, duration, results):
+    """Persist a snapshot where every peer's counters moved, like the stats collector"""
+    from sqlalchemy.exc import OperationalError
+    from app import db
+    from app.models.peer import Peer
+    from app.utils.stats import PeerStatsWriter
+
+    app = _make_app(mode, workdir)
+    writes = errors = 0
+    start.wait()
+    deadline = time.time() + duration
+    with app.app_context():
+        public_keys = [public_key for public_key, in db.session.query(Peer.public_key)]
+        stats_writer = PeerStatsWriter()
+        step = 0
+        while time.time() < deadline:
+            step += 1
+            now = int(time.time())
+            stats = {
+                public_key: {'latest_handshake': now, 'rx_bytes': step * 1000 + os.getpid(), 'tx_bytes': step * 500}
+                for public_key in public_keys[step % 10::10]
+            }
+            try:
+                stats_writer.persist(stats)
+                writes += 1
+            except OperationalError as e:
+                # persist() has rolled back and will reload what is stored
+                if not _is_locked(e):
+                    raise
+                errors += 1
+    results.put(('write', writes, errors))
+
+def run_mode(mode, peer_count, readers, writers, duration):
+    from app.utils.keystore import create_master_key
+    from app.utils.migrations import migrate
+    from benchmarks.run import seed_peers
+
+    workdir = tempfile.mkdtemp(prefix='vpn-load-')
+    try:
+        create_master_key(os.path.join(workdir, 'master.key'))
+        app = _make_app(mode, workdir)
+        with app.app_context():
+            migrate()
+            seed_peers(peer_count)
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        # Every worker builds its app before the clock starts
+        start = context.Barrier(readers + writers + 1)
+        processes = [
+            context.Process(target=target, args=(mode, workdir, start, duration, results))
+            for target, count in ((reader, readers), (writer, writers))
+            for _ in range(count)
+        ]
+        for process in processes:
+            process.start()
+
+        start.wait()
+
+        totals = {'read': [0, 0], 'write': [0, 0]}
+        for _ in processes:
+            kind, done, errors = results.get()
+            totals[kind][0] += done
+            totals[kind][1] += errors
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'mode': mode,
+        'reads_per_s': round(totals['read'][0] / duration, 1),
+        'writes_per_s': round(totals['write'][0] / duration, 1),
+        'read_lock_errors': totals['read'][1],
+        'write_lock_errors': totals['write'][1]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare SQLite settings under mixed read/write load.')
+    parser.add_argument('--peers', type=int, default=5000, help='Peers to seed (default: %(default)s)')
+    parser.add_argument('--readers', type=int, default=4, help='Reader processes (default: %(default)s)')
+    parser.add_argument('--writers', type=int, default=2, help='Writer processes (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per mode (default: %(default)s)')
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'reads/s':>9} {'writes/s':>9} {'read locks':>11} {'write locks':>12}")
+    for mode in MODES:
+        result = run_mode(mode, args.peers, args.readers, args.writers, args.duration)
+        print(f"{result['mode']:<8} {result['reads_per_s']:>9} {result['writes_per_s']:>9} "
+              f"{result['read_lock_errors']:>11} {result['write_lock_errors']:>12}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
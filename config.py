@@ -7,17 +7,107 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'instance', 'vpn_manager.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Applied to every SQLite connection. WAL lets readers and the writer
+    # run concurrently; NORMAL is durable with WAL except on power loss.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # ms to wait for the write lock instead of failing
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,  # KiB
+        'temp_store': 'MEMORY'
+    }
+    SQLITE_POOL_SIZE = 5  # Read-write connections per worker process
+    SQLITE_READ_POOL_SIZE = 10  # Read-only connections per worker process
     
     # Secret key for sessions
     SECRET_KEY = 'your-secret-key-change-this-in-production'
+
+    # Master key for the private and preshared keys stored in the database;
+    # the VPN_MASTER_KEY environment variable takes precedence. Keep it out of
+    # database backups.
+    MASTER_KEY_FILE = os.path.join(BASE_DIR, 'instance', 'master.key')
+    SECRET_CACHE_SIZE = 10000  # Decrypted keys kept in memory per worker; two per peer for exports
+    SECRET_CACHE_TTL = 300  # Seconds a decrypted key stays cached
     
     # WireGuard settings
     WG_SERVER_ENDPOINT = 'your-domain.com:51820'  # Or your public IP 
+
+    # Peer address pools; the first host of each pool is the server's address.
+    # Each peer gets one address, from the first pool with room, so pools fill
+    # in order: e.g. ['10.8.0.0/16', '10.9.0.0/16'], or ['fd42:42:42::/64']
+    # for IPv6-only peers.
+    # Only read when `flask init-db` creates wg0; after that each interface's
+    # pools live in the database: `flask interfaces set-pools wg0 --pool ...`
+    WG_ADDRESS_POOLS = ['10.0.0.0/24']
+
+    # How new peers are spread over interfaces: 'least-loaded' or 'fill-first'
+    WG_PLACEMENT_POLICY = 'least-loaded'
     SECRET_KEY = 'your-secret-key'
     
     # Directories
     CONFIG_DIR = os.path.join(BASE_DIR, 'configs')
-    QRCODE_DIR = '/var/www/vpn-qrcodes'
+    QRCODE_DIR = '/var/www/vpn-qrcodes'  # Only cleaned up; QR codes are rendered on demand
+    QRCODE_CACHE_SIZE = 256  # Rendered QR codes kept in memory per worker
+
+    # How the app talks to the running interface: 'subprocess' (sudo wg),
+    # 'netlink' (needs CAP_NET_ADMIN, no sudo) or 'fake' (in-memory, for tests)
+    WG_BACKEND = 'subprocess'
+
+    # Forwarding and NAT for peers: 'iptables' (rules in wg-quick's PostUp) or
+    # 'nftables' (one table with per-peer sets, updated atomically on apply)
+    FIREWALL_BACKEND = 'iptables'
+
+    # Background jobs: how long a queued apply waits for more changes to
+    # share it, how often other processes' jobs are polled for, and retries
+    JOB_COALESCE_DELAY = 0.5
+    JOB_POLL_INTERVAL = 1.0
+    JOB_MAX_ATTEMPTS = 3
+
+    # Hours between staging new peer keys and the server switching to them,
+    # unless a rotation asks for another window
+    KEY_ROTATION_WINDOW_HOURS = 24
+
+    # Seconds between background passes that compare each interface's
+    # config and running peers with the database and repair drift; 0 or
+    # None turns them off (`flask interfaces reconcile` still works)
+    RECONCILE_INTERVAL = 60
+
+    # Seconds between background `wg show dump` samples, taken by a single
+    # process and shared with the other workers through the instance dir
+    STATS_INTERVAL = 5
+
+    # Seconds between writes of peers' last_seen and byte totals to the
+    # database, done by a single process
+    STATS_PERSIST_INTERVAL = 30
+
+    # Live dashboard updates over Server-Sent Events. Each open dashboard
+    # holds a worker for the life of its stream, so only turn this on with
+    # threaded or async workers (gunicorn -k gthread or gevent); otherwise
+    # dashboards poll /api/peer-stats every 5 seconds.
+    STATS_STREAM = False
+
+    # Seconds before a stream is closed; the browser reconnects to a new one
+    STATS_STREAM_MAX_AGE = 300
+
+    # Byte counter change that triggers a live stream update for a peer
+    STATS_STREAM_BYTE_THRESHOLD = 64 * 1024
+
+    # How long bandwidth history is kept at each resolution, in seconds
+    TRAFFIC_RETENTION = {
+        '1m': 2 * 86400,
+        '1h': 90 * 86400,
+        '1d': 3 * 365 * 86400
+    }
+    
+    # Bearer token Prometheus sends to scrape /metrics; logged-in users can
+    # always view it. e.g. os.environ.get('METRICS_TOKEN')
+    METRICS_TOKEN = None
+
+    # Seconds between each worker writing its metrics to instance/metrics/,
+    # where /metrics sums them; 0 serves only the answering worker's metrics
+    METRICS_SHARE_INTERVAL = 5
     
     # HTTPS Settings
     PREFERRED_URL_SCHEME = 'https'
@@ -0,0 +1,41 @@
+import pytest
+from app import create_app, db
+from app.utils import ipam, wireguard
+from app.utils.keystore import create_master_key
+from config import Config
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    class TestConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/vpn.db'
+        MASTER_KEY_FILE = str(tmp_path / 'master.key')
+        WG_BACKEND = 'fake'
+        WG_ADDRESS_POOLS = ['10.9.0.0/29']
+        RECONCILE_INTERVAL = 0
+        METRICS_SHARE_INTERVAL = 0
+        SESSION_COOKIE_SECURE = False
+        TESTING = True
+
+    create_master_key(TestConfig.MASTER_KEY_FILE)
+    # Allocators are per process; start each test clean
+    monkeypatch.setattr(ipam, '_allocators', {})
+
+    # Server configs go to the temp dir instead of /etc/wireguard
+    init = wireguard.WireGuardManager.__init__
+    def manager_init(self, interface='wg0'):
+        init(self, interface)
+        self.config_path = str(tmp_path / f'{interface}.conf')
+    monkeypatch.setattr(wireguard.WireGuardManager, '__init__', manager_init)
+    monkeypatch.setattr(wireguard.WireGuardManager, 'get_main_interface', lambda self: 'eth0')
+
+    app = create_app(TestConfig)
+    app.instance_path = str(tmp_path)
+    with app.app_context():
+        from app.utils.migrations import migrate
+        migrate()
+
+        from app.models.interface import Interface
+        Interface.query.filter_by(name='wg0').one().private_key = wireguard.WireGuardManager().generate_keys()['private_key']
+        db.session.commit()
+        yield app
+        db.session.remove()
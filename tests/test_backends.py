@@ -0,0 +1,68 @@
+import base64
+import os
+from app.utils.backends import NO_PRESHARED_KEY, FakeBackend
+
+def key():
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+def config(*peers):
+    lines = ['[Interface]', f'PrivateKey = {key()}', 'ListenPort = 51820']
+    for public_key, address, preshared_key in peers:
+        lines += ['', '[Peer]', f'PublicKey = {public_key}', f'AllowedIPs = {address}']
+        if preshared_key:
+            lines.append(f'PresharedKey = {preshared_key}')
+    return '\n'.join(lines) + '\n'
+
+class CountingBackend(FakeBackend):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def set_peer(self, interface, public_key, allowed_ips, preshared_key=None):
+        self.calls.append(('set', public_key))
+        super().set_peer(interface, public_key, allowed_ips, preshared_key)
+
+    def remove_peer(self, interface, public_key):
+        self.calls.append(('remove', public_key))
+        super().remove_peer(interface, public_key)
+
+def test_sync_adds_updates_and_removes_peers():
+    backend = CountingBackend()
+    kept, moved, removed, added = key(), key(), key(), key()
+    psk = key()
+    backend.set_peer('wg0', kept, ['10.0.0.2/32'], psk)
+    backend.set_peer('wg0', moved, ['10.0.0.3/32'], psk)
+    backend.set_peer('wg0', removed, ['10.0.0.4/32'], psk)
+    backend.calls.clear()
+
+    backend.sync('wg0', config((kept, '10.0.0.2/32', psk), (moved, '10.0.0.9/32', psk), (added, '10.0.0.5/32', psk)))
+
+    dump = backend.dump('wg0')
+    assert set(dump) == {kept, moved, added}
+    assert dump[moved]['allowed_ips'] == ['10.0.0.9/32']
+    assert dump[added]['preshared_key'] == psk
+    assert sorted(backend.calls) == sorted([('remove', removed), ('set', moved), ('set', added)])
+
+def test_sync_clears_a_preshared_key_once():
+    backend = CountingBackend()
+    public_key = key()
+    backend.set_peer('wg0', public_key, ['10.0.0.2/32'], key())
+    backend.calls.clear()
+
+    backend.sync('wg0', config((public_key, '10.0.0.2/32', None)))
+    assert backend.dump('wg0')[public_key]['preshared_key'] is None
+    assert backend.calls == [('set', public_key)]
+
+    backend.sync('wg0', config((public_key, '10.0.0.2/32', None)))
+    assert backend.calls == [('set', public_key)]
+
+def test_fake_backend_keeps_the_key_when_none_is_given():
+    backend = FakeBackend()
+    public_key, psk = key(), key()
+    backend.set_peer('wg0', public_key, ['10.0.0.2/32'], psk)
+
+    backend.set_peer('wg0', public_key, ['10.0.0.3/32'])
+    assert backend.dump('wg0')[public_key]['preshared_key'] == psk
+
+    backend.set_peer('wg0', public_key, ['10.0.0.3/32'], NO_PRESHARED_KEY)
+    assert backend.dump('wg0')[public_key]['preshared_key'] is None
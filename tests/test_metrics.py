@@ -0,0 +1,35 @@
+from app.utils.metrics import Registry
+
+def registry(directory):
+    registry = Registry()
+    registry.share(str(directory))
+    return registry, registry.counter('jobs_total', 'Jobs.', ('kind',)), registry.histogram('job_seconds', 'Job time.', buckets=(1, 10))
+
+def test_render_sums_every_process(tmp_path):
+    # Two registries stand in for two workers dumping to the same directory
+    first, first_jobs, first_time = registry(tmp_path)
+    second, second_jobs, second_time = registry(tmp_path)
+    first_jobs.inc(2, kind='apply')
+    first_time.observe(0.5)
+    second_jobs.inc(3, kind='apply')
+    second_jobs.inc(kind='rotate')
+    second_time.observe(5)
+    second.dump()
+
+    lines = first.render().splitlines()
+
+    assert 'jobs_total{kind="apply"} 5' in lines
+    assert 'jobs_total{kind="rotate"} 1' in lines
+    assert 'job_seconds_bucket{le="1"} 1' in lines
+    assert 'job_seconds_bucket{le="10"} 2' in lines
+    assert 'job_seconds_count 2' in lines
+    assert 'job_seconds_sum 5.5' in lines
+    assert second.render() == first.render()
+
+def test_unshared_registry_renders_its_own_metrics(tmp_path):
+    alone, jobs, _ = registry(tmp_path)
+    alone.share(None)
+    jobs.inc(kind='apply')
+
+    assert 'jobs_total{kind="apply"} 1' in alone.render().splitlines()
+    assert list(tmp_path.iterdir()) == []
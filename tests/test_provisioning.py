@@ -0,0 +1,19 @@
+from app.models.peer import Peer
+from app.utils.provisioning import create_peers
+
+def test_batch_larger_than_pool_creates_what_fits(app):
+    # A /29 has 8 addresses: network, server, 5 peers and broadcast
+    results = create_peers([f'peer{i}' for i in range(7)])
+
+    created = [result for result in results if result['status'] == 'created']
+    assert len(created) == 5
+    assert len({result['ip_address'] for result in created}) == 5
+    assert [result['error'] for result in results[5:]] == ['No available IP addresses'] * 2
+    assert Peer.query.count() == 5
+
+def test_pool_exhausted_reports_every_peer(app):
+    create_peers([f'peer{i}' for i in range(5)])
+
+    results = create_peers(['late'])
+
+    assert results == [{'name': 'late', 'status': 'error', 'error': 'No available IP addresses'}]
@@ -0,0 +1,61 @@
+from app import db
+from app.models.peer import Peer
+from app.utils.backends import get_backend
+from app.utils.ipam import host_cidr
+from app.utils.jobs import get_job_queue
+from app.utils.provisioning import create_peers
+from app.utils.reconcile import reconcile
+from app.utils.wireguard import WireGuardManager
+
+def applied_peers(count):
+    create_peers([f'peer{i}' for i in range(count)])
+    # Run the apply now; reconcile leaves interfaces with a pending apply alone
+    get_job_queue().run_due(force=True)
+    peers = Peer.query.order_by(Peer.id).all()
+    assert set(get_backend().dump('wg0')) == {peer.public_key for peer in peers}
+    return peers
+
+def drift_count(report, source):
+    return sum(len(entries) for entries in report[source].values())
+
+def test_in_sync_interface_has_no_drift(app):
+    applied_peers(3)
+
+    [report] = reconcile('wg0', dry_run=False)
+
+    assert report['errors'] == []
+    assert drift_count(report, 'kernel') == 0
+    assert drift_count(report, 'config') == 0
+    assert not report['repaired']
+
+def test_reconcile_repairs_kernel_drift(app):
+    peers = applied_peers(3)
+    backend = get_backend()
+    extra = WireGuardManager().generate_keys()['public_key']
+    backend.remove_peer('wg0', peers[0].public_key)
+    backend.set_peer('wg0', peers[1].public_key, ['10.9.0.6/32'])
+    backend.set_peer('wg0', extra, ['10.9.0.7/32'])
+
+    [report] = reconcile('wg0', dry_run=False)
+
+    assert [entry['public_key'] for entry in report['kernel']['missing']] == [peers[0].public_key]
+    assert [entry['public_key'] for entry in report['kernel']['extra']] == [extra]
+    assert report['kernel']['mismatched'][0]['fields'] == ['allowed_ips']
+    assert report['repaired']
+    dump = backend.dump('wg0')
+    assert set(dump) == {peer.public_key for peer in peers}
+    assert dump[peers[1].public_key]['allowed_ips'] == [host_cidr(peers[1].ip_address)]
+
+def test_reconcile_clears_a_removed_preshared_key(app):
+    peers = applied_peers(2)
+    peers[0].preshared_key = None
+    db.session.commit()
+    assert WireGuardManager().save_server_config()
+
+    [report] = reconcile('wg0', dry_run=False)
+    assert report['kernel']['mismatched'][0]['fields'] == ['preshared_key']
+    assert get_backend().dump('wg0')[peers[0].public_key]['preshared_key'] is None
+
+    [report] = reconcile('wg0', dry_run=False)
+    assert drift_count(report, 'kernel') == 0
+    assert not report['repaired']
@@ -0,0 +1,47 @@
+import json
+import time
+import pytest
+from app.utils.backends import get_backend
+from app.utils.stats import StatsCollector
+from app.utils.wireguard import WireGuardManager
+
+@pytest.fixture
+def collectors(app):
+    writer, reader = StatsCollector(), StatsCollector()
+    writer.app = reader.app = app
+    yield writer, reader
+    for collector in (writer, reader):
+        if collector._writer_lock is not None:
+            collector._writer_lock.close()
+
+def test_workers_share_the_writers_sample(collectors, monkeypatch):
+    writer, reader = collectors
+    public_key = WireGuardManager().generate_keys()['public_key']
+    get_backend().set_peer('wg0', public_key, ['10.9.0.2/32'])
+    get_backend().set_traffic('wg0', public_key, rx_bytes=1024, latest_handshake=int(time.time()))
+
+    assert writer._is_writer()
+    assert not reader._is_writer()
+    writer.sample()
+    writer._publish()
+
+    def no_dump(self):
+        raise AssertionError('only the writer dumps the interfaces')
+    monkeypatch.setattr(WireGuardManager, 'get_peer_stats', no_dump)
+
+    stats, age = reader.snapshot()
+    assert stats[public_key]['rx_bytes'] == 1024
+    assert stats[public_key]['online']
+    assert age < 1
+
+def test_stale_shared_sample_is_not_used(collectors):
+    writer, reader = collectors
+    writer.sample()
+    writer._publish()
+    with open(writer._snapshot_path()) as f:
+        published = json.load(f)
+    published['sampled_at'] -= 10 * writer.interval
+    with open(writer._snapshot_path(), 'w') as f:
+        json.dump(published, f)
+
+    assert not reader._load_published()
@@ -0,0 +1,48 @@
+from app import db
+from app.models.interface import Interface
+from app.utils.provisioning import create_peers
+from app.utils.wireguard import WireGuardManager
+
+def save(wg_manager):
+    assert wg_manager.save_server_config()
+    return wg_manager.config_changed
+
+def test_unchanged_config_is_not_rewritten_by_any_worker(app):
+    create_peers(['alice'])
+    assert save(WireGuardManager())
+
+    # A fresh manager stands in for another worker
+    assert not save(WireGuardManager())
+
+    create_peers(['bob'])
+    assert save(WireGuardManager())
+
+def test_skip_works_without_a_stat_of_the_config(app, monkeypatch):
+    # /etc/wireguard is usually root-only, so the app can't stat the config
+    monkeypatch.setattr(WireGuardManager, '_config_stat', lambda self: None)
+    create_peers(['alice'])
+    assert save(WireGuardManager())
+
+    assert not save(WireGuardManager())
+    assert WireGuardManager().save_server_config(force=True)
+
+def test_edited_config_is_rewritten(app):
+    create_peers(['alice'])
+    wg_manager = WireGuardManager()
+    assert save(wg_manager)
+
+    with open(wg_manager.config_path, 'a') as f:
+        f.write('# edited by hand\n')
+
+    assert save(WireGuardManager())
+
+def test_public_key_follows_a_new_interface_key(app, monkeypatch):
+    monkeypatch.setattr(WireGuardManager, '_config_stat', lambda self: None)
+    wg_manager = WireGuardManager()
+    old = wg_manager.get_server_public_key()
+
+    keys = wg_manager.generate_keys()
+    Interface.query.filter_by(name='wg0').one().private_key = keys['private_key']
+    db.session.commit()
+
+    assert WireGuardManager().get_server_public_key() == keys['public_key'] != old